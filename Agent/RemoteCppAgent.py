@@ -0,0 +1,516 @@
+#!/usr/bin/python
+#
+# RemoteCpp remote helper agent.
+#
+# RemoteCpp starts this script once per ssh session on the remote host and
+# talks to it over stdin/stdout. Both directions use the same framing:
+#
+#   [header_len: uint32 big-endian][payload_len: uint32 big-endian]
+#   [header: header_len bytes of utf-8 JSON][payload: payload_len raw bytes]
+#
+# Requests carry {'id', 'op', 'args'} in the header. Every request is served
+# in its own thread so many can be in flight at once. Responses are zero or
+# more 'data'/'file' frames followed by exactly one 'done' or 'error' frame,
+# all tagged with the request id.
+#
+# The script must run unmodified with both python2.7 and python3 because it
+# is executed by whatever interpreter the remote host has available.
+#
+# It can also be run locally without ssh for testing:
+#   python Agent/RemoteCppAgent.py
+
+import errno
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+
+VERSION = 1
+CHUNK_BYTES = 64 * 1024
+FRAME = struct.Struct('>II')
+SNAPSHOT_DIR = os.path.join('~', '.cache', 'RemoteCpp')
+# How long cancelled processes get to exit before they are killed.
+KILL_GRACE_SECS = 5
+
+
+##############################################################
+# Framing
+##############################################################
+
+class Channel(object):
+  def __init__(self, fin, fout):
+    self._in = fin
+    self._out = fout
+    self._lock = threading.Lock()
+
+  def read(self):
+    ''' Returns (header, payload) or None at the end of the stream, even when
+    it ends in the middle of a frame. '''
+    raw = self._read_exactly(FRAME.size)
+    if raw == None:
+      return None
+    header_len, payload_len = FRAME.unpack(raw)
+    raw = self._read_exactly(header_len)
+    payload = self._read_exactly(payload_len)
+    if raw == None or payload == None:
+      return None
+    return json.loads(raw.decode('utf-8')), payload
+
+  def write(self, header, payload=b''):
+    raw = json.dumps(header).encode('utf-8')
+    with self._lock:
+      self._out.write(FRAME.pack(len(raw), len(payload)))
+      self._out.write(raw)
+      self._out.write(payload)
+      self._out.flush()
+
+  def _read_exactly(self, size):
+    chunks = []
+    missing = size
+    while missing > 0:
+      chunk = self._in.read(missing)
+      if not chunk:
+        return None
+      chunks.append(chunk)
+      missing -= len(chunk)
+    return b''.join(chunks)
+
+
+##############################################################
+# Helpers
+##############################################################
+
+def resolve(cwd, path=''):
+  cwd = os.path.expanduser(cwd or '~')
+  return os.path.join(cwd, path)
+
+def stat_of(path):
+  st = os.stat(path)
+  return { 'size': st.st_size, 'mtime': st.st_mtime }
+
+def sha1_of(path):
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as fp:
+    while True:
+      chunk = fp.read(CHUNK_BYTES)
+      if not chunk:
+        return sha1.hexdigest()
+      sha1.update(chunk)
+
+def makedirs_for(path):
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+def remove_quietly(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+def normalise_path(path):
+  path = path.strip()
+  if path.startswith('./'):
+    path = path[2:]
+  return path
+
+def list_token(paths):
+  ''' Identifies one snapshot of a file list. '''
+  return hashlib.sha1('\n'.join(sorted(paths)).encode('utf-8')).hexdigest()
+
+def user_shell_args(cmd):
+  ''' Runs cmd the way 'ssh host cmd' does, with the shell of the user but no
+  login profile, so every RemoteCpp command sees the same environment and
+  prints nothing but its own output. '''
+  return [ os.environ.get('SHELL') or '/bin/sh', '-c', cmd ]
+
+def write_in_place(path, content):
+  with open(path, 'wb') as fp:
+    fp.write(content)
+
+def has_xattrs(path):
+  ''' Whether the file has extended attributes such as ACLs that a rename
+  would drop. Unknown on python2 where it returns False. '''
+  try:
+    return hasattr(os, 'listxattr') and len(os.listxattr(path)) > 0
+  except OSError:
+    return False
+
+def write_atomically(path, content):
+  ''' Writes through symlinks to their target. Files with other hardlinks or
+  extended attributes, or whose owner can not be kept, are written in place
+  instead so they keep their links, ACLs and owner. '''
+  path = os.path.realpath(path)
+  makedirs_for(path)
+  try:
+    stat = os.stat(path)
+  except OSError:
+    stat = None
+  if stat != None and (stat.st_nlink > 1 or has_xattrs(path)):
+    write_in_place(path, content)
+    return
+  tmp_path = '{0}.RemoteCpp-{1}.tmp'.format(path, os.getpid())
+  try:
+    with open(tmp_path, 'wb') as fp:
+      fp.write(content)
+    if stat != None:
+      tmp_stat = os.stat(tmp_path)
+      if (tmp_stat.st_uid, tmp_stat.st_gid) != (stat.st_uid, stat.st_gid):
+        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+      os.chmod(tmp_path, stat.st_mode & 0o7777)
+  except OSError:
+    remove_quietly(tmp_path)
+    if stat == None:
+      raise
+    # Typically the owner could not be kept.
+    write_in_place(path, content)
+    return
+  os.rename(tmp_path, path)
+
+
+##############################################################
+# Operations
+##############################################################
+
+class Agent(object):
+  def __init__(self, channel):
+    self._channel = channel
+    self._snapshot_lock = threading.Lock()
+    self._procs_lock = threading.Lock()
+    # map<request id, Popen> of the running commands.
+    self._procs = {}
+    # Ids of the requests being served.
+    self._running_ids = set()
+    # Running requests cancelled before their command was started.
+    self._cancelled_ids = set()
+    # map<request id, Event> of the running commands. The stdout of a command
+    # is only read while its Event is set.
+    self._gates = {}
+    self._ops = {
+      'cancel': self.op_cancel,
+      'exec': self.op_exec,
+      'list': self.op_list,
+      'mv': self.op_mv,
+      'patch': self.op_patch,
+      'pause': self.op_pause,
+      'read': self.op_read,
+      'rm': self.op_rm,
+      'stat': self.op_stat,
+      'touch': self.op_touch,
+      'validate': self.op_validate,
+      'write': self.op_write,
+    }
+
+  def serve(self):
+    self._channel.write({ 'id': 0, 'type': 'hello', 'version': VERSION })
+    while True:
+      frame = self._channel.read()
+      if frame == None:
+        return
+      header, payload = frame
+      thread = threading.Thread(target=self._handle, args=(header, payload))
+      thread.daemon = True
+      thread.start()
+
+  def _handle(self, header, payload):
+    id = header.get('id')
+    with self._procs_lock:
+      self._running_ids.add(id)
+    try:
+      op = self._ops[header['op']]
+      result = op(id, header.get('args', {}), payload)
+      self._channel.write({ 'id': id, 'type': 'done', 'result': result })
+    except Exception as e:
+      self._channel.write({
+        'id': id,
+        'type': 'error',
+        'error': '{0}: {1}'.format(type(e).__name__, e),
+        'trace': traceback.format_exc(),
+      })
+    finally:
+      with self._procs_lock:
+        self._running_ids.discard(id)
+        self._cancelled_ids.discard(id)
+
+  def _send(self, id, header, payload=b''):
+    header['id'] = id
+    self._channel.write(header, payload)
+
+  def _spawn(self, id, args, stdin=b''):
+    ''' Starts args['cmd'] in the shell of the user and in its own process
+    group so that op_cancel kills everything the command started. The
+    command reads stdin, or nothing when it is empty. '''
+    if sys.version_info[0] >= 3:
+      kwargs = { 'start_new_session': True }
+    else:
+      kwargs = { 'preexec_fn': os.setsid }
+    with self._procs_lock:
+      if id in self._cancelled_ids:
+        self._cancelled_ids.discard(id)
+        raise Exception('The request was cancelled.')
+      proc = subprocess.Popen(user_shell_args(args['cmd']),
+          cwd=resolve(args.get('cwd')),
+          stdin=subprocess.PIPE if len(stdin) > 0 else open(os.devnull, 'rb'),
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE,
+          **kwargs)
+      self._procs[id] = proc
+    if len(stdin) > 0:
+      def feed():
+        try:
+          proc.stdin.write(stdin)
+          proc.stdin.close()
+        except (IOError, OSError):
+          # The command exited without reading all of it.
+          pass
+      thread = threading.Thread(target=feed)
+      thread.daemon = True
+      thread.start()
+    return proc
+
+  def _reap(self, id, proc):
+    returncode = proc.wait()
+    with self._procs_lock:
+      self._procs.pop(id, None)
+    return returncode
+
+  def op_cancel(self, id, args, payload):
+    ''' Terminates the process group of the request args['id'] and kills it
+    if it is still around after KILL_GRACE_SECS. '''
+    with self._procs_lock:
+      proc = self._procs.get(args['id'])
+      gate = self._gates.get(args['id'])
+      if proc == None:
+        if args['id'] in self._running_ids:
+          self._cancelled_ids.add(args['id'])
+        return { 'cancelled': False }
+    if gate != None:
+      # Drain the output so that the command is not left blocked on it.
+      gate.set()
+    def kill(sig):
+      if proc.poll() == None:
+        try:
+          os.killpg(proc.pid, sig)
+        except OSError:
+          pass
+    kill(signal.SIGTERM)
+    timer = threading.Timer(KILL_GRACE_SECS, kill, args=(signal.SIGKILL,))
+    timer.daemon = True
+    timer.start()
+    return { 'cancelled': True }
+
+  def op_pause(self, id, args, payload):
+    ''' Stops, or resumes, reading the stdout of the request args['id']. A
+    paused command blocks as soon as its stdout pipe is full. '''
+    with self._procs_lock:
+      gate = self._gates.get(args['id'])
+    if gate == None:
+      return { 'paused': False }
+    if args.get('paused', True):
+      gate.clear()
+    else:
+      gate.set()
+    return { 'paused': not gate.is_set() }
+
+  def op_exec(self, id, args, payload):
+    gate = threading.Event()
+    gate.set()
+    with self._procs_lock:
+      self._gates[id] = gate
+    try:
+      proc = self._spawn(id, args, payload)
+      def pump(fp, stream, gate=None):
+        while True:
+          if gate != None:
+            gate.wait()
+          chunk = os.read(fp.fileno(), CHUNK_BYTES)
+          if not chunk:
+            return
+          self._send(id, { 'type': 'data', 'stream': stream }, chunk)
+      stderr_thread = threading.Thread(target=pump,
+          args=(proc.stderr, 'stderr'))
+      stderr_thread.daemon = True
+      stderr_thread.start()
+      pump(proc.stdout, 'stdout', gate)
+      stderr_thread.join()
+      return { 'exit_code': self._reap(id, proc) }
+    finally:
+      with self._procs_lock:
+        self._gates.pop(id, None)
+
+  def op_list(self, id, args, payload):
+    ''' Runs the find command and returns only the paths added and removed
+    since the snapshot identified by args['token'] when the remote still has
+    it. Otherwise the whole list is returned in the payload. '''
+    proc = self._spawn(id, args)
+    out, err = proc.communicate()
+    self._reap(id, proc)
+    if proc.returncode != 0:
+      # Whatever a failed command printed is not a list to keep.
+      return {
+        'exit_code': proc.returncode,
+        'stderr': err.decode('utf-8', 'replace'),
+      }
+    paths = set()
+    for line in out.decode('utf-8', 'replace').splitlines():
+      path = normalise_path(line)
+      if len(path) > 0:
+        paths.add(path)
+    token = list_token(paths)
+    snapshot_path = os.path.join(
+        os.path.expanduser(SNAPSHOT_DIR),
+        hashlib.md5(u'{0}\x00{1}'.format(
+            args.get('cwd'), args['cmd']).encode('utf-8')).hexdigest())
+    result = {
+      'exit_code': proc.returncode,
+      'stderr': err.decode('utf-8', 'replace'),
+      'token': token,
+    }
+    with self._snapshot_lock:
+      old_paths = None
+      if args.get('token') != None and os.path.isfile(snapshot_path):
+        with open(snapshot_path, 'rb') as fp:
+          lines = fp.read().decode('utf-8').split('\n')
+        if lines[0] == args['token']:
+          old_paths = set(lines[1:])
+      if old_paths != None:
+        result['added'] = sorted(paths - old_paths)
+        result['removed'] = sorted(old_paths - paths)
+        content = b''
+      else:
+        result['full'] = True
+        content = '\n'.join(sorted(paths)).encode('utf-8')
+      if old_paths == None or token != args['token']:
+        write_atomically(snapshot_path,
+            '\n'.join([ token ] + sorted(paths)).encode('utf-8'))
+    self._send(id, { 'type': 'data', 'stream': 'stdout' }, content)
+    return result
+
+  def op_stat(self, id, args, payload):
+    stats = []
+    for path in args['paths']:
+      try:
+        stats.append(stat_of(resolve(args.get('cwd'), path)))
+      except OSError:
+        stats.append(None)
+    return { 'stats': stats }
+
+  def op_validate(self, id, args, payload):
+    ''' Compares the remote files with the [size, mtime, sha1] cached by the
+    client. A file is only hashed when its size matches but its mtime does
+    not, and the new mtime is returned when the content turns out equal. '''
+    changed = []
+    mtimes = {}
+    for path, (size, mtime, sha1) in args['files'].items():
+      full_path = resolve(args.get('cwd'), path)
+      try:
+        stat = stat_of(full_path)
+        if stat['size'] != size:
+          changed.append(path)
+        elif stat['mtime'] != mtime:
+          if sha1_of(full_path) == sha1:
+            mtimes[path] = stat['mtime']
+          else:
+            changed.append(path)
+      except (IOError, OSError):
+        changed.append(path)
+    return { 'changed': changed, 'mtimes': mtimes }
+
+  def op_read(self, id, args, payload):
+    ''' Sends every file in args['paths']. With args['max_bytes'] the files
+    that would take the total over it are marked as skipped instead. '''
+    max_bytes = args.get('max_bytes')
+    total_bytes = 0
+    for path in args['paths']:
+      full_path = resolve(args.get('cwd'), path)
+      header = { 'type': 'file', 'path': path }
+      content = b''
+      try:
+        header.update(stat_of(full_path))
+        if max_bytes != None and total_bytes + header['size'] > max_bytes:
+          header['skipped'] = True
+        else:
+          with open(full_path, 'rb') as fp:
+            content = fp.read()
+          total_bytes += len(content)
+      except (IOError, OSError) as e:
+        header['error'] = str(e)
+      self._send(id, header, content)
+    return {}
+
+  def op_write(self, id, args, payload):
+    full_path = resolve(args.get('cwd'), args['path'])
+    write_atomically(full_path, payload)
+    return stat_of(full_path)
+
+  def op_patch(self, id, args, payload):
+    ''' Rebuilds a file from a delta against its current content. Every op
+    is a [offset, length] copy from the current content, or a [-1, length]
+    run of the next payload bytes. Nothing is written unless the current
+    content is the base the delta was computed against. '''
+    full_path = resolve(args.get('cwd'), args['path'])
+    try:
+      with open(full_path, 'rb') as fp:
+        base = fp.read()
+    except (IOError, OSError):
+      return { 'patched': False }
+    if hashlib.sha1(base).hexdigest() != args['base_sha1']:
+      return { 'patched': False }
+    chunks = []
+    literal_offset = 0
+    for offset, length in args['ops']:
+      if offset < 0:
+        chunks.append(payload[literal_offset:literal_offset + length])
+        literal_offset += length
+      else:
+        chunks.append(base[offset:offset + length])
+    content = b''.join(chunks)
+    if hashlib.sha1(content).hexdigest() != args['sha1']:
+      raise ValueError('The patched content does not have the expected sha1.')
+    write_atomically(full_path, content)
+    result = stat_of(full_path)
+    result['patched'] = True
+    return result
+
+  def op_mv(self, id, args, payload):
+    dst = resolve(args.get('cwd'), args['dst'])
+    makedirs_for(dst)
+    shutil.move(resolve(args.get('cwd'), args['src']), dst)
+    return {}
+
+  def op_rm(self, id, args, payload):
+    for path in args['paths']:
+      full_path = resolve(args.get('cwd'), path)
+      if os.path.lexists(full_path):
+        os.remove(full_path)
+    return {}
+
+  def op_touch(self, id, args, payload):
+    full_path = resolve(args.get('cwd'), args['path'])
+    makedirs_for(full_path)
+    with open(full_path, 'ab'):
+      pass
+    return stat_of(full_path)
+
+
+def main():
+  fin = getattr(sys.stdin, 'buffer', sys.stdin)
+  fout = getattr(sys.stdout, 'buffer', sys.stdout)
+  # Nothing else is allowed to write into the protocol stream.
+  sys.stdout = sys.stderr
+  Agent(Channel(fin, fout)).serve()
+
+
+if __name__ == '__main__':
+  main()
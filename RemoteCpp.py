@@ -3,20 +3,35 @@
 import sublime
 import sublime_plugin
 
+import array
+import bisect
 import bz2
+import codecs
+import collections
 import datetime
+import getpass
 import hashlib
+import heapq
+import itertools
 import json
+import math
 import os
 import os.path
+import random
 import re
 import select
+import shlex
 import shutil
+import string
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
 import threading
 import time
 import traceback
+import zlib
 
 from subprocess import PIPE
 
@@ -26,44 +41,123 @@ from subprocess import PIPE
 ##############################################################
 
 def _get_or_default(setting, default, view=None):
-  if view == None:
-    view = sublime.active_window().active_view()
-  return view.settings().get(setting, default)
+  ''' view is a View or the SettingsSnapshot of its window. Without it the
+  settings of the active view are read. '''
+  return settings_snapshot(view).get(setting, default)
 
 def s_cwd(view=None):
   return _get_or_default('remote_cpp_cwd', 'cwd', view)
 
-def s_ssh():
-  return _get_or_default('remote_cpp_ssh', 'ssh')
+def s_ssh(view=None):
+  return _get_or_default('remote_cpp_ssh', 'ssh', view)
+
+def s_ssh_hostname(view=None):
+  return _get_or_default('remote_cpp_ssh_hostname', 'localhost', view)
 
-def s_ssh_hostname():
-  return _get_or_default('remote_cpp_ssh_hostname', 'localhost')
+def s_ssh_port(view=None):
+  return int(_get_or_default('remote_cpp_ssh_port', 8888, view))
 
-def s_ssh_port():
-  return int(_get_or_default('remote_cpp_ssh_port', 8888))
+def s_scp(view=None):
+  return _get_or_default('remote_cpp_scp', 'scp', view)
 
-def s_scp():
-  return _get_or_default('remote_cpp_scp', 'scp')
+def s_build_cmd(view=None):
+  return _get_or_default('remote_cpp_build_cmd', 'buck build', view)
 
-def s_build_cmd():
-  return _get_or_default('remote_cpp_build_cmd', 'buck build')
+def s_build_path(view=None):
+  return _get_or_default('remote_cpp_build_path', 'root', view)
 
-def s_find_cmd():
+def s_find_cmd(view=None):
   return _get_or_default('remote_cpp_find_cmd',
       ("find . -maxdepth 5 -not -path '*/\\.*' -type f "
-          "-not -path '*buck-cache*' -not -path '*buck-out*' -print"))
-
-def s_grep_cmd():
-  return _get_or_default('remote_cpp_grep_cmd', 'grep  -R -n \'{pattern}\' .')
-
-def s_single_file_list_view():
-  return _get_or_default('remote_cpp_single_file_list_view', True)
-
-def s_single_build_view():
-  return _get_or_default('remote_cpp_single_build_view', True)
-
-def s_save_all_on_remote_build():
-  return _get_or_default('remote_cpp_save_all_on_remote_build', False)
+          "-not -path '*buck-cache*' -not -path '*buck-out*' -print"), view)
+
+def s_grep_cmd(view=None):
+  return _get_or_default('remote_cpp_grep_cmd', DEFAULT_GREP_CMD, view)
+
+def s_grep_engine(view=None):
+  return _get_or_default('remote_cpp_grep_engine', 'auto', view)
+
+def s_grep_max_matches(view=None):
+  return int(_get_or_default('remote_cpp_grep_max_matches', 1000, view))
+
+def s_grep_max_matches_per_file(view=None):
+  return int(_get_or_default('remote_cpp_grep_max_matches_per_file', 100,
+      view))
+
+def s_single_file_list_view(view=None):
+  return _get_or_default('remote_cpp_single_file_list_view', True, view)
+
+def s_single_build_view(view=None):
+  return _get_or_default('remote_cpp_single_build_view', True, view)
+
+def s_save_all_on_remote_build(view=None):
+  return _get_or_default('remote_cpp_save_all_on_remote_build', False, view)
+
+def s_ssh_multiplexing(view=None):
+  return _get_or_default('remote_cpp_ssh_multiplexing', True, view)
+
+def s_agent(view=None):
+  return _get_or_default('remote_cpp_agent', True, view)
+
+def s_agent_python(view=None):
+  return _get_or_default('remote_cpp_agent_python', '', view)
+
+def s_include_roots(view=None):
+  return _get_or_default('remote_cpp_include_roots', [], view)
+
+def s_quick_open_max_results(view=None):
+  return int(_get_or_default('remote_cpp_quick_open_max_results', 100, view))
+
+def s_file_list_refresh_secs(view=None):
+  return int(_get_or_default('remote_cpp_file_list_refresh_secs', 300, view))
+
+def s_max_view_lines(view=None):
+  return int(_get_or_default('remote_cpp_max_view_lines', 50000, view))
+
+def s_prefetch_max_bytes(view=None):
+  return int(_get_or_default('remote_cpp_prefetch_max_bytes', 4 * 1024 * 1024,
+      view))
+
+def s_cache_max_bytes(view=None):
+  return int(_get_or_default('remote_cpp_cache_max_bytes', 1024 * 1024 * 1024,
+      view))
+
+def s_cache_max_files(view=None):
+  return int(_get_or_default('remote_cpp_cache_max_files', 100000, view))
+
+def s_thread_pool_threads(view=None):
+  return int(_get_or_default('remote_cpp_thread_pool_threads', 4, view))
+
+# Every setting read by the s_*() functions above. A SettingsSnapshot reads
+# all of them at once.
+SETTING_NAMES = frozenset((
+  'remote_cpp_cwd',
+  'remote_cpp_ssh',
+  'remote_cpp_ssh_hostname',
+  'remote_cpp_ssh_port',
+  'remote_cpp_scp',
+  'remote_cpp_build_cmd',
+  'remote_cpp_build_path',
+  'remote_cpp_find_cmd',
+  'remote_cpp_grep_cmd',
+  'remote_cpp_grep_engine',
+  'remote_cpp_grep_max_matches',
+  'remote_cpp_grep_max_matches_per_file',
+  'remote_cpp_single_file_list_view',
+  'remote_cpp_single_build_view',
+  'remote_cpp_save_all_on_remote_build',
+  'remote_cpp_ssh_multiplexing',
+  'remote_cpp_agent',
+  'remote_cpp_agent_python',
+  'remote_cpp_include_roots',
+  'remote_cpp_quick_open_max_results',
+  'remote_cpp_file_list_refresh_secs',
+  'remote_cpp_max_view_lines',
+  'remote_cpp_prefetch_max_bytes',
+  'remote_cpp_cache_max_bytes',
+  'remote_cpp_cache_max_files',
+  'remote_cpp_thread_pool_threads',
+))
 
 
 ##############################################################
@@ -71,6 +165,7 @@ def s_save_all_on_remote_build():
 ##############################################################
 
 LOG_TYPES = set(('', 'RemoteCppGotoBuildErrorCommand'))
+PREFERENCES_FILE = 'Preferences.sublime-settings'
 CPP_EXTENSIONS = set([
     '.c',
     '.cpp',
@@ -78,6 +173,67 @@ CPP_EXTENSIONS = set([
     '.h',
     '.hpp',
 ])
+# Preferred toggle counterparts, best first.
+HEADER_EXTENSIONS = ('.h', '.hpp')
+IMPLEMENTATION_EXTENSIONS = ('.cpp', '.cc', '.c')
+# Conventional directory names that split headers from implementations.
+SOURCE_DIRS = set([
+    'include',
+    'inc',
+    'src',
+    'source',
+    'lib',
+])
+# Size of the reads from, and of the batches of lines handed to the listener
+# of, the pipes of local commands.
+RUN_CMD_CHUNK_BYTES = 256 * 1024
+RUN_CMD_BATCH_BYTES = 1024 * 1024
+# Longest a line read from a local command waits before reaching the listener.
+RUN_CMD_BATCH_SECS = 0.05
+# How long the full outputs of commands are kept.
+OUTPUT_MAX_AGE_SECS = 7 * 24 * 3600
+# Default of 'remote_cpp_grep_cmd'. Any other value selects the 'custom'
+# grep engine unless 'remote_cpp_grep_engine' names another one.
+DEFAULT_GREP_CMD = 'grep  -R -n \'{pattern}\' .'
+# Prints the grep tools available in the remote cwd, one per line.
+GREP_PROBE_CMD = ('command -v rg >/dev/null 2>&1 && echo rg; '
+    'if git rev-parse --is-inside-work-tree >/dev/null 2>&1; then '
+    'git grep --column -q -e x -- RemoteCpp-probe >/dev/null 2>&1; '
+    '[ $? -ne 129 ] && echo git; fi; true')
+# Printed on stderr by remote commands started over plain ssh to report the
+# id of their process group.
+REMOTE_PGID_MARKER = 'RemoteCpp-pgid:'
+# Block size bounds of the rsync-style upload deltas.
+DELTA_MIN_BLOCK_BYTES = 512
+DELTA_MAX_BLOCK_BYTES = 16 * 1024
+# Smaller files are written whole as a delta would not save a round trip.
+DELTA_MIN_FILE_BYTES = 64 * 1024
+# Rolling checksum steps, of about 0.3 micros of CPU each on the INTERACTIVE
+# upload path, after which the rest of the changed bytes are sent as they are
+# instead of being matched against the blocks of the base. Runs of blocks
+# that follow a match are compared directly and do not take any steps.
+DELTA_MAX_SCAN_STEPS = 256 * 1024
+# Number of distinct files of the first grep matches and build errors that
+# are prefetched.
+PREFETCH_TOP_HITS = 10
+# Number of #include'd files of an opened file that are prefetched.
+PREFETCH_MAX_INCLUDES = 32
+# Eviction shrinks the local cache to this fraction of its caps so that it
+# does not run again as soon as the next file is downloaded.
+CACHE_EVICTION_TARGET = 0.9
+CACHE_EVICTION_SECS = 600
+INCLUDE_REGEX = re.compile(r'^\s*#\s*(?:include|import)\s*["<]([^">]+)[">]',
+    re.MULTILINE)
+# '<path>:<line>:[<col>:] <severity>: <message>' as printed by gcc and clang.
+COMPILER_DIAGNOSTIC_REGEX = re.compile(
+    r'^(.+?):(\d+):(?:(\d+):)? *(fatal error|error|warning|note): *(.*)$')
+# '<path>:<line>: Failure' as printed by gtest, the message follows it.
+GTEST_FAILURE_REGEX = re.compile(r'^(.+?):(\d+): Failure$')
+# Any other '<path>:<line>[:<col>]:<message>' line.
+LOCATION_REGEX = re.compile(r'^([^:\s]+):(\d+)(?::(\d+))?:(.+)$')
+ANSI_ESCAPE_REGEX = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+# Severities of the BuildDiagnostics visited by next/previous build error.
+NAVIGABLE_SEVERITIES = set(('error', 'warning', 'failure'))
 
 
 
@@ -92,6 +248,15 @@ class CmdListener(object):
   def on_stderr(self, line):
     log('stderr: ' + line)
 
+  def on_stdout_lines(self, lines):
+    ''' Called with batches of lines. Override for large outputs. '''
+    for line in lines:
+      self.on_stdout(line)
+
+  def on_stderr_lines(self, lines):
+    for line in lines:
+      self.on_stderr(line)
+
   def on_exit(self, exit_code):
     self.log('Exit code: {0}'.format(exit_code))
 
@@ -99,52 +264,156 @@ class CmdListener(object):
     log(msg, type=CmdListener.__name__)
 
 
+class CancellableListener(CmdListener):
+  ''' Drops all output of a command once its job has been cancelled. '''
+  def __init__(self, listener, token):
+    self._listener = listener
+    self._token = token
+
+  def on_stdout(self, line):
+    if not self._token.is_cancelled():
+      self._listener.on_stdout(line)
+
+  def on_stderr(self, line):
+    if not self._token.is_cancelled():
+      self._listener.on_stderr(line)
+
+  def on_stdout_lines(self, lines):
+    if not self._token.is_cancelled():
+      self._listener.on_stdout_lines(lines)
+
+  def on_stderr_lines(self, lines):
+    if not self._token.is_cancelled():
+      self._listener.on_stderr_lines(lines)
+
+  def on_exit(self, exit_code):
+    if not self._token.is_cancelled():
+      self._listener.on_exit(exit_code)
+
+
+class RemotePgidListener(CmdListener):
+  ''' Picks the REMOTE_PGID_MARKER line out of the stderr of a command. '''
+  def __init__(self, listener, on_pgid):
+    self._listener = listener
+    self._on_pgid = on_pgid
+    self._found = False
+
+  def on_stdout(self, line):
+    self._listener.on_stdout(line)
+
+  def on_stderr(self, line):
+    self.on_stderr_lines([ line ])
+
+  def on_stdout_lines(self, lines):
+    self._listener.on_stdout_lines(lines)
+
+  def on_stderr_lines(self, lines):
+    if not self._found:
+      for index, line in enumerate(lines):
+        if line.startswith(REMOTE_PGID_MARKER):
+          self._found = True
+          self._on_pgid(line[len(REMOTE_PGID_MARKER):].strip())
+          lines = lines[:index] + lines[index + 1:]
+          break
+    if len(lines) > 0:
+      self._listener.on_stderr_lines(lines)
+
+  def on_exit(self, exit_code):
+    self._listener.on_exit(exit_code)
+
+
 class ListFilesListener(CmdListener):
-  def __init__(self, view=None, prefix=''):
+  def __init__(self, view=None, prefix='', settings=None):
     self.last_flush_secs = 0
     self.file_list = []
     self.to_flush = []
     self.prefix = prefix
+    self.exit_code = None
     if view == None:
       self.listener = None
     else:
-      self.listener = AppendToViewListener(view)
+      self.listener = AppendToViewListener(view, settings)
 
   def on_stdout(self, line):
     self.file_list.append(line)
 
+  def on_stdout_lines(self, lines):
+    self.file_list.extend(lines)
+
   def on_stderr(self, line):
     if None != self.listener:
       self.listener.on_stderr(line)
 
   def on_exit(self, exit_code):
+    self.exit_code = exit_code
     self.file_list = normalise_file_list(self.file_list)
+    self.show(exit_code)
+
+  def show(self, exit_code):
     if None != self.listener:
-      filtered_files = []
-      for path in self.file_list:
-        if path.startswith(self.prefix):
-          filtered_files.append(path)
-      self.listener.on_stdout('\n'.join(filtered_files) + '\n')
+      self.listener.on_stdout_lines(
+          [ path + '\n' for path in self.file_list.with_prefix(self.prefix) ])
       self.listener.on_exit(exit_code)
 
 
 class AppendToViewListener(CmdListener):
-  def __init__(self, view):
+  ''' Streams command output into a view without ever flooding Sublime. The
+  view keeps at most s_max_view_lines(): the first half of the output, an
+  elision marker and the latest lines. The full output is always spilled
+  to a local file. Flushes are spaced out by how long inserting takes. Once
+  the token of the job is cancelled, output not shown yet is dropped so it
+  never lands in the output of the job that reuses the view. '''
+
+  # Key of the view region holding the elision marker and the latest lines.
+  TAIL_REGION = 'remote_cpp_tail'
+  # View setting with the path of the full output.
+  OUTPUT_PATH_SETTING = 'remote_cpp_output_path'
+  # Fraction of the time the main thread may spend inserting output.
+  MAX_INSERT_LOAD = 0.1
+  MIN_FLUSH_SECS = 0.05
+  MAX_FLUSH_SECS = 2.0
+
+  def __init__(self, view, settings=None, token=None):
     self._view = view
+    self._token = token
     self._start_secs = time.time()
-    self._last_buffer_refresh = self._start_secs
-    self._last_flush = 0
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
     self._buffer = []
+    self._flush_secs = self.MIN_FLUSH_SECS
+    self._last_flush_secs = 0
+    self._flush_scheduled = False
+    self._max_lines = s_max_view_lines(settings or view)
+    self._head_lines = 0
+    self._tail = None
+    self._elided_lines = 0
+    # (head lines, lines flushed, tail lines, rows of the elision marker)
+    # replaced as a whole after every flush.
+    self._layout = (0, 0, 0, 0)
+    self._spill = self._open_spill_file()
 
   def on_stdout(self, line):
-    self._buffer.append(line)
-    self._try_flush_buffer()
+    self.on_stdout_lines([ line ])
 
   def on_stderr(self, line):
-    Commands.append_text(self._view, line)
+    self.on_stdout_lines([ line ])
+
+  def on_stdout_lines(self, lines):
+    with self._lock:
+      self._buffer.extend(lines)
+      if self._spill != None:
+        self._spill.write(''.join(lines))
+    self._try_flush_buffer()
+
+  def on_stderr_lines(self, lines):
+    self.on_stdout_lines(lines)
 
   def on_exit(self, exit_code):
     self._try_flush_buffer(force=True)
+    with self._lock:
+      if self._spill != None:
+        self._spill.close()
+        self._spill = None
     if exit_code == 0:
       line = ('\n# [{time}] Command finished successfully '
           'in {millis} millis.\n').format(
@@ -160,14 +429,442 @@ class AppendToViewListener(CmdListener):
       )
     Commands.append_text(self._view, line)
 
+  def elided_lines(self):
+    return self._elided_lines
+
+  def row(self, index):
+    ''' The row, counted from the first row of the output, showing the
+    index-th line handed to the listener or None if it is not shown. '''
+    head_lines, flushed_lines, tail_lines, marker_rows = self._layout
+    if index < head_lines:
+      return index
+    tail_start = flushed_lines - tail_lines
+    if tail_start <= index < flushed_lines:
+      return head_lines + marker_rows + index - tail_start
+    return None
+
+  def index(self, row):
+    ''' The inverse of row(). None if the row shows no line of the output. '''
+    head_lines, flushed_lines, tail_lines, marker_rows = self._layout
+    if row < 0:
+      return None
+    if row < head_lines:
+      return row
+    row -= head_lines + marker_rows
+    if 0 <= row < tail_lines:
+      return flushed_lines - tail_lines + row
+    return None
+
   def _try_flush_buffer(self, force=False):
-    now_secs = time.time()
-    if (not force) and (now_secs - self._last_buffer_refresh < 1):
+    with self._lock:
+      wait_secs = self._last_flush_secs + self._flush_secs - time.time()
+      if not force and wait_secs > 0:
+        if not self._flush_scheduled:
+          self._flush_scheduled = True
+          sublime.set_timeout_async(self._on_flush_timeout,
+              int(wait_secs * 1000) + 1)
+        return
+    with self._flush_lock:
+      with self._lock:
+        lines = self._buffer
+        self._buffer = []
+        self._last_flush_secs = time.time()
+      if self._is_cancelled():
+        return
+      if len(lines) > 0:
+        self._flush(lines)
+
+  def _on_flush_timeout(self):
+    with self._lock:
+      self._flush_scheduled = False
+      if self._is_cancelled():
+        self._buffer = []
+        return
+    self._try_flush_buffer()
+
+  def _is_cancelled(self):
+    return self._token != None and self._token.is_cancelled()
+
+  def _flush(self, lines):
+    start_secs = time.time()
+    flushed_lines = self._layout[1] + len(lines)
+    if self._tail == None:
+      room = len(lines)
+      if self._max_lines > 0:
+        room = max(self._max_lines // 2 - self._head_lines, 0)
+      if room > 0:
+        Commands.append_text(self._view, ''.join(lines[:room]))
+        self._head_lines += min(room, len(lines))
+        lines = lines[room:]
+      if len(lines) > 0:
+        self._tail = collections.deque(
+            maxlen=self._max_lines - self._max_lines // 2)
+    if self._tail != None and len(lines) > 0:
+      self._elided_lines += max(
+          len(self._tail) + len(lines) - self._tail.maxlen, 0)
+      self._tail.extend(lines)
+      text = ''.join(self._tail)
+      if self._elided_lines > 0:
+        text = ('\n# [{count} lines elided. Run \'RemoteCpp: Open Full '
+            'Output\' to see them.]\n\n').format(
+                count=self._elided_lines) + text
+      Commands.append_text(self._view, text, tail=True)
+    tail_lines = 0 if self._tail == None else len(self._tail)
+    marker_rows = 3 if self._elided_lines > 0 else 0
+    self._layout = (self._head_lines, flushed_lines, tail_lines, marker_rows)
+    # Keep the main thread mostly free no matter how slow inserting gets.
+    insert_secs = time.time() - start_secs
+    self._flush_secs = min(self.MAX_FLUSH_SECS, max(self.MIN_FLUSH_SECS,
+        insert_secs / self.MAX_INSERT_LOAD))
+
+  def _open_spill_file(self):
+    directory = output_dir()
+    try:
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      path = os.path.join(directory, '{id}-{millis}.txt'.format(
+          id=self._view.id(),
+          millis=int(time.time() * 1000)))
+      spill = codecs.open(path, 'w', 'utf-8')
+    except (IOError, OSError):
+      log_exception('Failed to create the full output file.')
+      return None
+    view = self._view
+    def publish_path():
+      # View settings are only touched on the main thread.
+      previous_path = view.settings().get(self.OUTPUT_PATH_SETTING)
+      view.settings().set(self.OUTPUT_PATH_SETTING, path)
+      if previous_path != None and previous_path != path:
+        try:
+          if os.path.isfile(previous_path):
+            os.remove(previous_path)
+        except OSError:
+          log_exception('Failed to delete the output file [{0}].'.format(
+              previous_path))
+    sublime.set_timeout(publish_path, 0)
+    return spill
+
+
+class GrepListener(CmdListener):
+  ''' Turns the output of a GrepEngine into GrepMatch records, keeps them in
+  matches keyed by the line displayed for them and shows them in the view.
+  At most s_grep_max_matches() are shown at a time: further matches pause
+  the command through its OutputGate until load_more() is called. '''
+
+  MORE_MARKER = '# More matches available.'
+
+  def __init__(self, view, settings, engine, pattern, matches, skip_paths=(),
+      gate=None):
+    self._sink = AppendToViewListener(view, settings)
+    self._settings = settings
+    self._engine = engine
+    self._matches = matches
+    # Paths whose matches were already shown.
+    self._skip_paths = skip_paths
+    self._gate = gate
+    self._lock = threading.Lock()
+    self._page_size = s_grep_max_matches(settings)
+    self._max_per_file = s_grep_max_matches_per_file(settings)
+    self._limit = self._page_size
+    self._count = 0
+    # Matches waiting for the next page.
+    self._pending = collections.deque()
+    self._paused = False
+    # map<path, number of matches>
+    self._file_counts = {}
+    self._capped_files = 0
+    self._cwd = s_cwd(settings)
+    # Paths of the first matches shown, prefetched once there are enough.
+    self._prefetch_paths = []
+    try:
+      self._pattern_regex = re.compile(pattern)
+    except re.error:
+      self._pattern_regex = None
+
+  def on_stdout_lines(self, lines):
+    matches = []
+    for line in lines:
+      match = self._engine.parse(line, self._pattern_regex)
+      if match != None and not match.path in self._skip_paths:
+        matches.append(match)
+    self.on_matches(matches)
+
+  def on_matches(self, matches):
+    with self._lock:
+      for match in matches:
+        count = self._file_counts.get(match.path, 0) + 1
+        self._file_counts[match.path] = count
+        if self._max_per_file > 0 and count > self._max_per_file:
+          if count == self._max_per_file + 1:
+            self._capped_files += 1
+          continue
+        self._pending.append(match)
+      self._show_pending()
+
+  def is_paused(self):
+    return self._paused
+
+  def load_more(self):
+    ''' Shows the next page of matches and resumes the command if the page
+    is not full yet. '''
+    with self._lock:
+      if not self._paused:
+        return
+      self._paused = False
+      self._limit = self._count + self._page_size
+      self._show_pending()
+      gate = None if self._paused else self._gate
+    if gate != None:
+      gate.resume()
+
+  def _show_pending(self):
+    display_lines = []
+    while len(self._pending) > 0 and \
+        (self._page_size <= 0 or self._count < self._limit):
+      match = self._pending.popleft()
+      display = match.display()
+      self._matches[display] = match
+      display_lines.append(display + '\n')
+      self._count += 1
+      if self._prefetch_paths != None and \
+          not match.path in self._prefetch_paths:
+        self._prefetch_paths.append(match.path)
+        if len(self._prefetch_paths) >= PREFETCH_TOP_HITS:
+          self._prefetch()
+    if len(self._pending) > 0 and not self._paused:
+      self._paused = True
+      if self._gate != None:
+        self._gate.pause()
+      display_lines.append(('\n{marker} Run \'RemoteCpp: Grep Load More\' '
+          'or press Enter here to see the next {count}.\n\n').format(
+              marker=self.MORE_MARKER,
+              count=self._page_size))
+    if len(display_lines) > 0:
+      self._sink.on_stdout_lines(display_lines)
+
+  def _prefetch(self):
+    if self._prefetch_paths != None:
+      PREFETCHER.push(self._cwd, self._prefetch_paths, self._settings)
+      self._prefetch_paths = None
+
+  def on_stderr_lines(self, lines):
+    self._sink.on_stderr_lines(lines)
+
+  def on_exit(self, exit_code):
+    with self._lock:
+      self._prefetch()
+      # The command is gone so the remaining pages are all in memory.
+      gate = self._gate
+      self._gate = None
+      count = self._count
+      summary = '\n# Found {0} matches.'.format(count)
+      if len(self._pending) > 0:
+        summary += ' {0} more not shown yet.'.format(len(self._pending))
+      if self._capped_files > 0:
+        summary += ' {files} files had more than {max} matches.'.format(
+            files=self._capped_files,
+            max=self._max_per_file)
+    # grep tools exit with 1 (123 through xargs) when some file had no match.
+    if exit_code in (1, 123) and count > 0:
+      exit_code = 0
+    if gate != None:
+      gate.resume()
+    self._sink.on_stdout_lines([ summary + '\n' ])
+    self._sink.on_exit(exit_code)
+
+
+class BuildDiagnosticsListener(CmdListener):
+  ''' Parses the output of a build into BuildDiagnostic records as it streams
+  into the Build view through sink, its AppendToViewListener. The records
+  drive next/previous build error, Enter in the Build view, the gutter
+  markers of the Build view and of the views of their files, and prefetching
+  the first PREFETCH_TOP_HITS files with diagnostics. '''
+
+  ERRORS_KEY = 'remote_cpp_build_errors'
+  WARNINGS_KEY = 'remote_cpp_build_warnings'
+  MARKERS_DELAY_MILLIS = 500
+
+  def __init__(self, view, sink, build_cwd, cwd, first_row, settings=None):
+    self._view = view
+    self._sink = sink
+    self._settings = settings
+    self._build_cwd = build_cwd
+    self._cwd = cwd
+    # Row of the view showing the first line of the output.
+    self._first_row = first_row
+    self._lock = threading.Lock()
+    # vector<BuildDiagnostic> in output order.
+    self._diagnostics = []
+    # BuildDiagnostic.output_line of every one of self._diagnostics.
+    self._output_lines = array.array('I')
+    # Indexes into self._diagnostics of the navigable ones.
+    self._navigable = array.array('I')
+    # map<path, vector<BuildDiagnostic>>
+    self._by_path = {}
+    # Index into self._navigable of the last one visited.
+    self._position = -1
+    self._lines = 0
+    # The gtest failure whose message is the next line.
+    self._gtest_failure = None
+    # Paths of the first diagnostics, prefetched once there are enough.
+    self._prefetch_paths = []
+    self._markers_scheduled = False
+    # Clears the markers of the previous build.
+    self._schedule_markers()
+
+  def cwd(self):
+    return self._cwd
+
+  def view(self):
+    return self._view
+
+  def on_stdout(self, line):
+    self.on_stdout_lines([ line ])
+
+  def on_stderr(self, line):
+    self.on_stderr_lines([ line ])
+
+  def on_stdout_lines(self, lines):
+    self._parse(lines)
+    self._sink.on_stdout_lines(lines)
+
+  def on_stderr_lines(self, lines):
+    self._parse(lines)
+    self._sink.on_stderr_lines(lines)
+
+  def on_exit(self, exit_code):
+    self._prefetch()
+    with self._lock:
+      warnings = len([ d for d in self._diagnostics
+          if d.severity == 'warning' ])
+      errors = len(self._navigable) - warnings
+    if errors + warnings > 0:
+      self._sink.on_stdout_lines([ ('\n# Found {errors} errors and {warnings} '
+          'warnings. Run \'RemoteCpp: Next Build Error\' to go through '
+          'them.\n').format(errors=errors, warnings=warnings) ])
+    self._sink.on_exit(exit_code)
+    self._schedule_markers()
+
+  def at_row(self, row):
+    ''' The diagnostic shown in the row of the Build view, or the closest one
+    above it. Next/previous build error carry on from it. '''
+    index = self._sink.index(row - self._first_row)
+    if index == None:
+      return None
+    with self._lock:
+      position = bisect.bisect_right(self._output_lines, index) - 1
+      if position < 0:
+        return None
+      self._position = bisect.bisect_right(self._navigable, position) - 1
+      return self._diagnostics[position]
+
+  def step(self, forward=True):
+    ''' Moves to the next, or previous, error, warning or test failure.
+    Returns None when there are no more. '''
+    with self._lock:
+      position = self._position + (1 if forward else -1)
+      if position < 0 or position >= len(self._navigable):
+        return None
+      self._position = position
+      return self._diagnostics[self._navigable[position]]
+
+  def show(self, diagnostic):
+    ''' Puts the cursor of the Build view on the diagnostic. '''
+    row = self._row(diagnostic)
+    if row == None:
       return
-    self._last_buffer_refresh = now_secs
-    text = ''.join(self._buffer)
-    self._buffer = []
-    Commands.append_text(self._view, text)
+    point = self._view.text_point(row, 0)
+    self._view.sel().clear()
+    self._view.sel().add(sublime.Region(point))
+    self._view.show(point)
+
+  def mark(self, view):
+    ''' Marks the diagnostics shown in the view, the Build view or the view
+    of one of their files, in its gutter. '''
+    with self._lock:
+      if view.id() == self._view.id():
+        rows = [ (d, self._row(d)) for d in self._diagnostics ]
+      else:
+        file = STATE.file(view.file_name())
+        if file == None or file.cwd != self._cwd:
+          return
+        rows = [ (d, d.line - 1) for d in self._by_path.get(file.path, []) ]
+    errors = []
+    warnings = []
+    for diagnostic, row in rows:
+      if row == None or not diagnostic.severity in NAVIGABLE_SEVERITIES:
+        continue
+      region = view.line(view.text_point(row, 0))
+      if diagnostic.severity == 'warning':
+        warnings.append(region)
+      else:
+        errors.append(region)
+    flags = sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE
+    view.add_regions(self.ERRORS_KEY, errors, 'invalid', 'circle', flags)
+    view.add_regions(self.WARNINGS_KEY, warnings, 'markup.changed', 'dot',
+        flags)
+
+  def _row(self, diagnostic):
+    row = self._sink.row(diagnostic.output_line)
+    if row == None:
+      return None
+    return self._first_row + row
+
+  def _parse(self, lines):
+    found = False
+    with self._lock:
+      for line in lines:
+        output_line = self._lines
+        self._lines += 1
+        text = ANSI_ESCAPE_REGEX.sub('', line.rstrip('\r\n'))
+        if self._gtest_failure != None:
+          self._gtest_failure.message = text.strip()
+          self._gtest_failure = None
+          continue
+        diagnostic = parse_build_diagnostic(text, output_line,
+            self._build_cwd, self._cwd)
+        if diagnostic == None:
+          continue
+        found = True
+        if diagnostic.severity == 'failure':
+          self._gtest_failure = diagnostic
+        self._diagnostics.append(diagnostic)
+        self._output_lines.append(output_line)
+        if diagnostic.severity in NAVIGABLE_SEVERITIES:
+          self._navigable.append(len(self._diagnostics) - 1)
+        if not os.path.isabs(diagnostic.path):
+          if not diagnostic.path in self._by_path and \
+              self._prefetch_paths != None:
+            self._prefetch_paths.append(diagnostic.path)
+          self._by_path.setdefault(diagnostic.path, []).append(diagnostic)
+    if found:
+      if self._prefetch_paths != None and \
+          len(self._prefetch_paths) >= PREFETCH_TOP_HITS:
+        self._prefetch()
+      self._schedule_markers()
+
+  def _prefetch(self):
+    with self._lock:
+      paths = self._prefetch_paths
+      self._prefetch_paths = None
+    if paths != None:
+      PREFETCHER.push(self._cwd, paths[:PREFETCH_TOP_HITS], self._settings)
+
+  def _schedule_markers(self):
+    with self._lock:
+      if self._markers_scheduled:
+        return
+      self._markers_scheduled = True
+    sublime.set_timeout(self._update_markers, self.MARKERS_DELAY_MILLIS)
+
+  def _update_markers(self):
+    with self._lock:
+      self._markers_scheduled = False
+    window = self._view.window()
+    if window == None:
+      return
+    for view in window.views():
+      self.mark(view)
 
 
 class CaptureCmdListener(CmdListener):
@@ -196,6 +893,28 @@ class CaptureCmdListener(CmdListener):
     return int(self._exit_code)
 
 
+class LineDecoder(object):
+  ''' Turns raw byte chunks into batches of text lines (with line endings).
+  Invalid utf-8 is replaced instead of failing. '''
+  def __init__(self, on_lines):
+    self._on_lines = on_lines
+    self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    self._pending = ''
+
+  def feed(self, chunk):
+    text = self._pending + self._decoder.decode(chunk)
+    end = text.rfind('\n') + 1
+    self._pending = text[end:]
+    if end > 0:
+      self._on_lines(text[:end].splitlines(True))
+
+  def close(self):
+    text = self._pending + self._decoder.decode(b'', final=True)
+    self._pending = ''
+    if len(text) > 0:
+      self._on_lines([ text ])
+
+
 class File(object):
   def __init__(self, cwd, path, row=0, col=0):
     self.cwd = normalise_path(cwd)
@@ -219,8 +938,7 @@ class File(object):
   @staticmethod
   def local_root_for_cwd(cwd):
     local_root = os.path.join(
-        plugin_dir(),
-        'RemoteCpp-Cache',
+        cache_dir(),
         md5(cwd))
     return local_root
 
@@ -239,51 +957,1777 @@ class File(object):
     return args
 
 
-class ThreadPool(object):
-  def __init__(self, number_threads):
+class GrepMatch(object):
+  ''' One line matched by a remote grep. col is 1-based and span holds the
+  [start, end) offsets of the match within text. '''
+  def __init__(self, path, line, col, span, text):
+    self.path = path
+    self.line = line
+    self.col = col
+    self.span = span
+    self.text = text
+
+  def display(self):
+    return '{path}:{line}:{col}:{text}'.format(
+        path=self.path,
+        line=self.line,
+        col=self.col,
+        text=self.text)
+
+
+class BuildDiagnostic(object):
+  ''' One compiler diagnostic or gtest failure in the output of a build.
+  output_line is its 0-based line in the output. path is relative to the
+  cwd, or absolute if the file is not under it. line and col are 1-based
+  with col 0 when unknown. '''
+  def __init__(self, output_line, path, line, col, severity, message):
+    self.output_line = output_line
+    self.path = path
+    self.line = line
+    self.col = col
+    self.severity = severity
+    self.message = message
+
+
+class GrepEngine(object):
+  ''' A remote grep tool and how to parse its output. '''
+  def __init__(self, name, cmd, recursive_args, regex, has_column=True,
+      max_count_args=None):
+    self.name = name
+    # Searches the files appended to it for the {pattern}.
+    self._cmd = cmd
+    # Appended to cmd to search the whole cwd instead. None when cmd already
+    # searches the whole cwd and cannot be restricted to a list of files.
+    self._recursive_args = recursive_args
+    # Groups: path, line, [column,] text.
+    self._regex = re.compile(regex)
+    self._has_column = has_column
+    # Appended to cmd to stop reading a file after {count} matches.
+    self._max_count_args = max_count_args
+
+  def cmd(self, pattern, file_list_path=None, max_count=0):
+    ''' Restricts the search to the paths listed in the remote file
+    file_list_path (one per line after a header line) when it exists. '''
+    cmd = self._files_cmd(pattern, max_count)
+    if self._recursive_args == None:
+      return cmd
+    recursive_cmd = cmd + self._recursive_args
+    if file_list_path == None:
+      return recursive_cmd
+    return ('if [ -f {list} ]; then '
+        'tail -n +2 {list} | tr \'\\n\' \'\\0\' | xargs -0 {cmd} --; '
+        'else {recursive_cmd}; fi').format(
+            list=file_list_path,
+            cmd=cmd,
+            recursive_cmd=recursive_cmd)
+
+  def can_restrict(self):
+    ''' Whether the search can be restricted to a list of files. '''
+    return self._recursive_args != None
+
+  def paths_cmd(self, pattern, paths, max_count=0):
+    ''' Returns (cmd, stdin) searching only paths, which are handed to the
+    command on its stdin. '''
+    cmd = 'tr \'\\n\' \'\\0\' | xargs -0 -r {cmd} --'.format(
+        cmd=self._files_cmd(pattern, max_count))
+    return cmd, ''.join([ p + '\n' for p in paths ]).encode('utf-8')
+
+  def skip_paths_cmd(self, pattern, file_list_path, skip_paths, max_count=0):
+    ''' Returns (cmd, stdin) searching the paths listed in the remote file
+    file_list_path except skip_paths, which are handed to the command on its
+    stdin. Searches the whole cwd when the list does not exist. '''
+    cmd = self._files_cmd(pattern, max_count)
+    cmd = ('if [ -f {list} ]; then '
+        'awk \'NR == FNR {{ skip[$0]; next }} FNR > 1 && !($0 in skip)\' '
+        '- {list} | tr \'\\n\' \'\\0\' | xargs -0 -r {cmd} --; '
+        'else {recursive_cmd}; fi').format(
+            list=file_list_path,
+            cmd=cmd,
+            recursive_cmd=cmd + self._recursive_args)
+    # The leading empty line tells awk where stdin ends even when nothing is
+    # skipped.
+    stdin = ''.join([ '\n' ] + [ p + '\n' for p in skip_paths ])
+    return cmd, stdin.encode('utf-8')
+
+  def _files_cmd(self, pattern, max_count):
+    ''' Searches the files appended to it. '''
+    cmd = self._cmd.format(pattern=shlex.quote(pattern))
+    if max_count > 0 and self._max_count_args != None:
+      cmd += self._max_count_args.format(count=int(max_count))
+    return cmd
+
+  def parse(self, line, pattern_regex):
+    ''' Returns a GrepMatch or None if the line is not a match. '''
+    match = self._regex.match(line.rstrip('\r\n'))
+    if match == None:
+      return None
+    groups = match.groups()
+    text = groups[-1]
+    start = None
+    if self._has_column:
+      # Tools report byte columns but Sublime wants characters.
+      byte_col = int(groups[2]) - 1
+      start = len(text.encode('utf-8')[:byte_col].decode('utf-8', 'ignore'))
+    end = start
+    if pattern_regex != None:
+      found = None
+      if start != None:
+        found = pattern_regex.match(text, start)
+      else:
+        found = pattern_regex.search(text)
+      if found != None:
+        start, end = found.span()
+    if start == None:
+      start = end = 0
+    return GrepMatch(
+        path=normalise_path(groups[0]),
+        line=int(groups[1]),
+        col=start + 1,
+        span=(start, end),
+        text=text)
+
+
+class LocalGrepIndex(object):
+  ''' Trigram index over the local copies of the remote files of one cwd.
+  A search only reads the files that contain every trigram the pattern
+  requires. Trigrams are lowercase so one index serves any pattern. '''
+
+  MAX_FILE_BYTES = 4 * 1024 * 1024
+
+  def __init__(self, cwd):
+    self._cwd = cwd
+    self._lock = threading.Lock()
+    # map<trigram, array<file id>> with ids in increasing order.
+    self._postings = {}
+    # Path of every file id or None once the file changed or disappeared.
+    self._paths = []
+    # map<path, (file id, size, mtime)> of the live files.
+    self._files = {}
+
+  def update(self):
+    ''' Indexes the local copies that changed since the last update. '''
+    with self._lock:
+      start_secs = time.time()
+      root = File.local_root_for_cwd(self._cwd)
+      seen = set()
+      indexed = 0
+      for directory, _, names in os.walk(root):
+        for name in names:
+          local_path = os.path.join(directory, name)
+          path = os.path.relpath(local_path, root).replace(os.sep, '/')
+          try:
+            stat = os.stat(local_path)
+          except OSError:
+            continue
+          seen.add(path)
+          known = self._files.get(path)
+          if known != None and known[1:] == (stat.st_size, stat.st_mtime):
+            continue
+          self._drop(path)
+          if stat.st_size <= self.MAX_FILE_BYTES and \
+              self._add(path, local_path):
+            self._files[path] = (len(self._paths) - 1, stat.st_size,
+                stat.st_mtime)
+            indexed += 1
+      for path in tuple(self._files.keys()):
+        if not path in seen:
+          self._drop(path)
+      if len(self._paths) > 2 * len(self._files) + 1000:
+        self._compact()
+      if indexed > 0:
+        log('Indexed {count} local files of [{cwd}] in {millis} millis.'.format(
+            count=indexed,
+            cwd=self._cwd,
+            millis=delta_millis(start_secs)))
+
+  def paths(self):
+    with self._lock:
+      return set(self._files.keys())
+
+  def search(self, pattern, token=None):
+    ''' Returns the GrepMatch of every line of the indexed files matching the
+    regex pattern. '''
+    regex = re.compile(pattern)
+    with self._lock:
+      ids = None
+      for literal in required_literals(pattern):
+        for index in range(len(literal) - 2):
+          postings = self._postings.get(literal[index:index + 3].lower(), ())
+          ids = set(postings) if ids == None else ids.intersection(postings)
+      if ids == None:
+        ids = range(len(self._paths))
+      paths = sorted([ self._paths[i] for i in ids if self._paths[i] ])
+    matches = []
+    for path in paths:
+      if token != None:
+        token.check()
+      text = self._read(File(cwd=self._cwd, path=path).local_path(False))
+      if text == None:
+        continue
+      for line, line_text in enumerate(text.split('\n')):
+        found = regex.search(line_text)
+        if found == None:
+          continue
+        matches.append(GrepMatch(
+            path=path,
+            line=line + 1,
+            col=found.start() + 1,
+            span=found.span(),
+            text=line_text.rstrip('\r')))
+    return matches
+
+  def _add(self, path, local_path):
+    text = self._read(local_path)
+    if text == None:
+      return False
+    id = len(self._paths)
+    self._paths.append(path)
+    text = text.lower()
+    for trigram in set([ text[i:i + 3] for i in range(len(text) - 2) ]):
+      postings = self._postings.get(trigram)
+      if postings == None:
+        postings = self._postings[trigram] = array.array('I')
+      postings.append(id)
+    return True
+
+  def _drop(self, path):
+    known = self._files.pop(path, None)
+    if known != None:
+      self._paths[known[0]] = None
+
+  def _compact(self):
+    ''' Rebuilds the postings without the ids of dropped files. '''
+    paths = [ p for p in self._paths if p != None ]
+    new_ids = dict([ (path, i) for i, path in enumerate(paths) ])
+    old_to_new = dict([ (i, new_ids[p]) for i, p in enumerate(self._paths)
+        if p != None ])
+    for trigram in tuple(self._postings.keys()):
+      postings = array.array('I', [ old_to_new[i]
+          for i in self._postings[trigram] if i in old_to_new ])
+      if len(postings) > 0:
+        self._postings[trigram] = postings
+      else:
+        del self._postings[trigram]
+    self._paths = paths
+    for path, known in self._files.items():
+      self._files[path] = (new_ids[path],) + known[1:]
+
+  @staticmethod
+  def _read(local_path):
+    ''' Returns None for binary files. '''
+    try:
+      with open(local_path, 'rb') as fp:
+        content = fp.read()
+    except (IOError, OSError):
+      return None
+    if b'\x00' in content[:8192]:
+      return None
+    return content.decode('utf-8', 'replace')
+
+
+class FileList(object):
+  ''' Immutable list of paths sorted by file_list_key(). Sorting that way
+  keeps the files of every directory together so each directory is stored
+  once and all basenames are packed in a single string. '''
+
+  def __init__(self, dirs, dir_starts, names, name_offsets):
+    # vector<dir> in file_list_key() order. The cwd itself is ''.
+    self._dirs = dirs
+    # array<index of the first path of every dir> followed by len(self).
+    self._dir_starts = dir_starts
+    # The basenames of all paths, each one followed by a '\n'.
+    self._names = names
+    # array<offset of every basename in names> followed by len(names).
+    self._name_offsets = name_offsets
+
+  @staticmethod
+  def from_paths(paths):
+    ''' The paths must already be sorted by file_list_key(). '''
+    dirs = []
+    dir_starts = array.array('I')
+    names = []
+    name_offsets = array.array('I')
+    offset = 0
+    for path in paths:
+      dir, _, name = path.rpartition('/')
+      if len(dirs) == 0 or dirs[-1] != dir:
+        dirs.append(dir)
+        dir_starts.append(len(name_offsets))
+      names.append(name)
+      name_offsets.append(offset)
+      offset += len(name) + 1
+    dir_starts.append(len(name_offsets))
+    name_offsets.append(offset)
+    names.append('')
+    return FileList(dirs, dir_starts, '\n'.join(names), name_offsets)
+
+  @staticmethod
+  def from_json(value):
+    ''' Also accepts the plain sorted list of paths of older versions. '''
+    if isinstance(value, list):
+      return FileList.from_paths(value)
+    name_offsets = array.array('I')
+    offset = 0
+    names = value['names']
+    for name in names.split('\n')[:-1]:
+      name_offsets.append(offset)
+      offset += len(name) + 1
+    name_offsets.append(offset)
+    return FileList(value['dirs'], array.array('I', value['dir_starts']),
+        names, name_offsets)
+
+  def to_json(self):
+    return {
+      'dirs': self._dirs,
+      'dir_starts': self._dir_starts.tolist(),
+      'names': self._names,
+    }
+
+  def __len__(self):
+    return len(self._name_offsets) - 1
+
+  def __iter__(self):
+    for dir_id in range(len(self._dirs)):
+      for path in self._paths_of_dir(dir_id):
+        yield path
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if index < 0 or index >= len(self):
+      raise IndexError('FileList index out of range.')
+    dir_id = bisect.bisect_right(self._dir_starts, index) - 1
+    return self._path(self._dirs[dir_id], index)
+
+  def __contains__(self, path):
+    index = self.bisect_left(path)
+    return index < len(self) and self[index] == path
+
+  def bisect_left(self, path):
+    ''' Index where the path is or would be inserted. '''
+    dir, _, name = path.rpartition('/')
+    dir_id = bisect.bisect_left(_FileListDirKeys(self._dirs),
+        _FileListDirKeys.key(dir))
+    if dir_id == len(self._dirs) or self._dirs[dir_id] != dir:
+      return self._dir_starts[dir_id]
+    return bisect.bisect_left(_FileListNames(self), name,
+        self._dir_starts[dir_id], self._dir_starts[dir_id + 1])
+
+  def with_prefix(self, prefix):
+    ''' Iterates in order over the paths starting with prefix. '''
+    dir = prefix.rpartition('/')[0]
+    dir_keys = _FileListDirKeys(self._dirs)
+    dir_id = bisect.bisect_left(dir_keys, _FileListDirKeys.key(dir))
+    if dir_id < len(self._dirs) and self._dirs[dir_id] == dir:
+      for path in self._paths_of_dir(dir_id):
+        if path.startswith(prefix):
+          yield path
+    # All dirs below the prefix are in a single run.
+    dir_id = bisect.bisect_left(dir_keys, prefix)
+    while dir_id < len(self._dirs):
+      if self._dirs[dir_id] != dir:
+        if not (self._dirs[dir_id] + '/').startswith(prefix):
+          return
+        for path in self._paths_of_dir(dir_id):
+          yield path
+      dir_id += 1
+
+  def with_changes(self, paths_to_add, paths_to_rm):
+    ''' Returns a new FileList with the paths added and removed. Only the
+    dirs with changes are rebuilt, the others are copied as they are. '''
+    # map<dir, (set<name> to add, set<name> to remove)>
+    changes = {}
+    for paths, change in ((paths_to_add, 0), (paths_to_rm, 1)):
+      for path in paths:
+        dir, _, name = path.rpartition('/')
+        changes.setdefault(dir, (set(), set()))[change].add(name)
+    dir_ids = dict([ (dir, id) for id, dir in enumerate(self._dirs) ])
+    dirs = []
+    dir_starts = array.array('I')
+    chunks = []
+    name_offsets = array.array('I')
+    offset = 0
+    for dir in sorted(set(dir_ids.keys()) | set(changes.keys()),
+        key=_FileListDirKeys.key):
+      dir_id = dir_ids.get(dir)
+      start = end = 0
+      if dir_id != None:
+        start = self._dir_starts[dir_id]
+        end = self._dir_starts[dir_id + 1]
+      if dir in changes:
+        to_add, to_rm = changes[dir]
+        names = set([ self._name(i) for i in range(start, end) ])
+        names = sorted((names - to_rm) | to_add)
+        if len(names) == 0:
+          continue
+        chunk = '\n'.join(names) + '\n'
+        starts = []
+        for name in names:
+          starts.append(offset)
+          offset += len(name) + 1
+      else:
+        base = self._name_offsets[start]
+        chunk = self._names[base:self._name_offsets[end]]
+        starts = [ o - base + offset for o in self._name_offsets[start:end] ]
+        offset += len(chunk)
+      dirs.append(dir)
+      dir_starts.append(len(name_offsets))
+      name_offsets.extend(starts)
+      chunks.append(chunk)
+    dir_starts.append(len(name_offsets))
+    name_offsets.append(offset)
+    return FileList(dirs, dir_starts, ''.join(chunks), name_offsets)
+
+  def _name(self, index):
+    return self._names[
+        self._name_offsets[index]:self._name_offsets[index + 1] - 1]
+
+  def _path(self, dir, index):
+    if dir == '':
+      return self._name(index)
+    return dir + '/' + self._name(index)
+
+  def _paths_of_dir(self, dir_id):
+    dir = self._dirs[dir_id]
+    for index in range(self._dir_starts[dir_id], self._dir_starts[dir_id + 1]):
+      yield self._path(dir, index)
+
+
+class _FileListDirKeys(object):
+  ''' Read-only view of the sort keys of the dirs of a FileList for bisect. '''
+  def __init__(self, dirs):
+    self._dirs = dirs
+
+  def __len__(self):
+    return len(self._dirs)
+
+  def __getitem__(self, index):
+    return self.key(self._dirs[index])
+
+  @staticmethod
+  def key(dir):
+    # The file_list_key() prefix shared by all files in the dir.
+    return dir + '/\x00' if dir != '' else '\x00'
+
+
+class _FileListNames(object):
+  ''' Read-only view of the basenames of a FileList for bisect. '''
+  def __init__(self, file_list):
+    self._file_list = file_list
+
+  def __len__(self):
+    return len(self._file_list)
+
+  def __getitem__(self, index):
+    return self._file_list._name(index)
+
+
+class FileListIndex(object):
+  ''' Lookup tables derived from the file list of one cwd. '''
+  def __init__(self, file_list):
+    # map<stem, vector<path>> where a stem is a path without its extension.
+    self._stems = {}
+    # map<basename, vector<path>> used to resolve path suffixes.
+    self._names = {}
+    self._search = FileSearchIndex(file_list)
+    for path in file_list:
+      self._add_to_tables(path)
+
+  def with_changes(self, paths_to_add, paths_to_rm):
+    ''' Returns a new FileListIndex with the changes applied and leaves this
+    one untouched, so readers on other threads never see a partial update.
+    Only the tables the changes touch are copied. '''
+    index = FileListIndex(())
+    index._stems = dict(self._stems)
+    index._names = dict(self._names)
+    # Keys whose vector<path> was already copied into the new index.
+    copied = set()
+    for path in paths_to_rm:
+      for table, key in index._keys_of(path):
+        paths = table.get(key)
+        if paths == None or not path in paths:
+          continue
+        if not (id(table), key) in copied:
+          paths = table[key] = list(paths)
+          copied.add((id(table), key))
+        paths.remove(path)
+        if len(paths) == 0:
+          del table[key]
+    for path in paths_to_add:
+      for table, key in index._keys_of(path):
+        if not (id(table), key) in copied:
+          table[key] = list(table.get(key, ()))
+          copied.add((id(table), key))
+        if not path in table[key]:
+          table[key].append(path)
+    index._search = self._search.with_changes(paths_to_add, paths_to_rm)
+    return index
+
+  def _add_to_tables(self, path):
+    for table, key in self._keys_of(path):
+      paths = table.setdefault(key, [])
+      if not path in paths:
+        paths.append(path)
+
+  def _keys_of(self, path):
+    keys = [ (self._stems, stem) for stem in self._stems_of(path) ]
+    keys.append((self._names, os.path.basename(path)))
+    return keys
+
+  def search(self, query, limit, usage=None):
+    return self._search.search(query, limit, usage)
+
+  def resolve_suffix(self, suffix):
+    ''' All paths that are or end with the path components in suffix. '''
+    suffix = os.path.normpath(suffix)
+    matches = []
+    for path in self._names.get(os.path.basename(suffix), ()):
+      if path == suffix or path.endswith('/' + suffix):
+        matches.append(path)
+    return matches
+
+  def resolve_include(self, include, including_path, include_roots=()):
+    ''' Candidates for an #include ranked like a compiler would search them:
+    relative to the including file, then the include roots, then the cwd and
+    finally any other file whose path ends with the include. '''
+    preferred = [ os.path.join(os.path.dirname(including_path), include) ]
+    preferred.extend([ os.path.join(root, include) for root in include_roots ])
+    preferred.append(include)
+    preferred = [ os.path.normpath(path) for path in preferred ]
+    including_dir = os.path.dirname(including_path)
+    def rank(path):
+      if path in preferred:
+        return (preferred.index(path), 0, path)
+      common = os.path.commonprefix([ including_dir, path ])
+      return (len(preferred), -len(common), path)
+    candidates = set(self.resolve_suffix(include))
+    for path in preferred:
+      if path in self._names.get(os.path.basename(path), ()):
+        candidates.add(path)
+    return sorted(candidates, key=rank)
+
+  def siblings(self, path):
+    ''' Files with the same stem but another extension, best match first. '''
+    stems = self._stems_of(path)
+    _, extension = os.path.splitext(path)
+    sibblings = []
+    for stem in stems:
+      for sibbling in self._stems.get(stem, ()):
+        if sibbling in sibblings or \
+            os.path.splitext(sibbling)[1] == extension:
+          continue
+        sibblings.append(sibbling)
+    return sorted(sibblings,
+                  key=lambda sibbling: self._rank(stems, extension, sibbling))
+
+  def counterpart(self, path):
+    ''' Returns the single best sibling or None if there is no clear one. '''
+    sibblings = self.siblings(path)
+    if len(sibblings) == 0:
+      return None
+    if len(sibblings) == 1:
+      return sibblings[0]
+    stems = self._stems_of(path)
+    _, extension = os.path.splitext(path)
+    if self._rank(stems, extension, sibblings[0])[:2] < \
+        self._rank(stems, extension, sibblings[1])[:2]:
+      return sibblings[0]
+    return None
+
+  @staticmethod
+  def _rank(stems, extension, sibbling):
+    ''' Exact stems first, then by preferred extension, then by path. '''
+    stem, sibbling_extension = os.path.splitext(sibbling)
+    if extension in IMPLEMENTATION_EXTENSIONS:
+      preferred = HEADER_EXTENSIONS
+    else:
+      preferred = IMPLEMENTATION_EXTENSIONS
+    if sibbling_extension in preferred:
+      extension_rank = preferred.index(sibbling_extension)
+    else:
+      extension_rank = len(preferred)
+    return (stem != stems[0], extension_rank, sibbling)
+
+  @staticmethod
+  def _stems_of(path):
+    ''' The exact stem plus, if the path goes through any SOURCE_DIRS, a
+    generic stem where those directories are wildcarded so that
+    'include/foo.h' and 'src/foo.cpp' share it. '''
+    stem, _ = os.path.splitext(path)
+    parts = stem.split('/')
+    dirs = [ '\x00' if d in SOURCE_DIRS else d for d in parts[:-1] ]
+    if not '\x00' in dirs:
+      return (stem,)
+    return (stem, '/'.join(dirs + parts[-1:]))
+
+
+class FileSearchIndex(object):
+  ''' Packs the lowercase basenames of a file list into a single string so
+  that Quick Open queries are answered by the regex engine in one scan instead
+  of looping over every path in Python. '''
+
+  # Usage scores are halved every this many seconds without opening a file.
+  USAGE_HALF_LIFE_SECS = 7 * 24 * 3600
+
+  def __init__(self, file_list):
+    # vector<path> indexed by id. Removed paths become None.
+    self._paths = list(file_list)
+    # map<path, id>
+    self._ids = dict([ (path, id) for id, path in enumerate(self._paths) ])
+    self._packed = None
+    self._pack()
+
+  def with_changes(self, paths_to_add, paths_to_rm):
+    ''' Returns a new FileSearchIndex with the changes applied and leaves
+    this one untouched. '''
+    index = FileSearchIndex(())
+    index._paths = list(self._paths)
+    index._ids = dict(self._ids)
+    for path in paths_to_rm:
+      id = index._ids.pop(path, None)
+      if id != None:
+        index._paths[id] = None
+    for path in paths_to_add:
+      if not path in index._ids:
+        index._ids[path] = len(index._paths)
+        index._paths.append(path)
+    # Removed paths keep their ids so only the added names are packed, here
+    # in the background rather than by the next search on the main thread.
+    names, offsets = self._pack()
+    added = [ os.path.basename(path).lower()
+        for path in index._paths[len(self._paths):] ]
+    if len(added) > 0:
+      offsets = array.array('I', offsets)
+      offset = len(names)
+      for name in added:
+        offsets.append(offset)
+        offset += len(name) + 1
+      names += '\n'.join(added) + '\n'
+    index._packed = (names, offsets)
+    return index
+
+  def search(self, query, limit, usage=None):
+    ''' Returns the paths best matching the query. usage maps paths to
+    [open_count, last_open_secs] and ranks frequently and recently opened
+    files first. '''
+    now_secs = time.time()
+    if usage == None:
+      usage = {}
+    query = query.strip().lower()
+    dir_query = ''
+    if '/' in query:
+      dir_query, query = query.rsplit('/', 1)
+    # Stop scanning once this many candidates were found.
+    budget = limit * 20
+    scored = {}
+    for path in usage:
+      id = self._ids.get(path)
+      if id != None and self._is_match(id, dir_query):
+        name = os.path.basename(path).lower()
+        if query in name:
+          scored[id] = self._match_score(name, query, name.find(query))
+    names, offsets = self._pack()
+    if len(query) > 0:
+      # Every name in the packed string is preceded by a '\n' so anchoring
+      # on it keeps the patterns literal, which the regex engine scans fast.
+      escaped = re.escape(query)
+      for regex in ('\n{0}(?=\n)', '\n{0}\\.[^.\n]*(?=\n)', '\n{0}'):
+        self._scan(regex.format(escaped), 1, query, names, offsets,
+                   dir_query, budget, scored)
+      self._scan(escaped, 0, query, names, offsets, dir_query, budget, scored)
+      if len(scored) < limit and len(query) > 1:
+        # Not enough substring matches so try with a fuzzy subsequence.
+        regex = re.escape(query[0])
+        for c in query[1:]:
+          regex += '[^\n{0}]*{0}'.format(re.escape(c))
+        self._scan(regex, 0, query, names, offsets, dir_query, budget,
+                   scored, fuzzy=True)
+    elif len(dir_query) > 0:
+      # Without a directory an empty query only lists the files we have opened
+      # before, which were scored above.
+      for id in range(len(self._paths)):
+        if len(scored) >= budget:
+          break
+        if not id in scored and self._is_match(id, dir_query):
+          scored[id] = 0
+    ranked = []
+    for id, score in scored.items():
+      path = self._paths[id]
+      score += self._usage_score(usage.get(path), now_secs)
+      # Shorter paths win ties.
+      ranked.append((score - len(path) / 1000.0, path))
+    return [ path for _, path in heapq.nlargest(limit, ranked) ]
+
+  def _scan(self, regex, skip, query, names, offsets, dir_query, budget,
+            scored, fuzzy=False):
+    ''' Scores the names matching regex. skip is the number of characters
+    matched before the name starts. '''
+    for match in re.finditer(regex, names):
+      if len(scored) >= budget:
+        return
+      id = bisect.bisect_right(offsets, match.start() + skip) - 1
+      if id in scored or not self._is_match(id, dir_query):
+        continue
+      start = offsets[id]
+      name = names[start:names.index('\n', start)]
+      if fuzzy:
+        # Penalise every character between the ones in the query.
+        scored[id] = 10 - (match.end() - match.start() - len(query))
+      else:
+        scored[id] = self._match_score(name, query,
+                                       match.start() + skip - start)
+
+  def _is_match(self, id, dir_query):
+    path = self._paths[id]
+    if path == None:
+      return False
+    return len(dir_query) == 0 or dir_query in os.path.dirname(path).lower()
+
+  def _pack(self):
+    packed = self._packed
+    if packed == None:
+      names = []
+      offsets = array.array('I')
+      offset = 1
+      for path in self._paths:
+        name = os.path.basename(path or '').lower()
+        names.append(name)
+        offsets.append(offset)
+        offset += len(name) + 1
+      packed = self._packed = ('\n' + '\n'.join(names) + '\n', offsets)
+    return packed
+
+  @staticmethod
+  def _match_score(name, query, position):
+    stem, _ = os.path.splitext(name)
+    if name == query:
+      return 100
+    if stem == query:
+      return 90
+    if position == 0:
+      return 80
+    if not name[position - 1].isalnum():
+      return 60
+    return 40
+
+  @classmethod
+  def _usage_score(cls, usage, now_secs):
+    if usage == None:
+      return 0
+    count, last_secs = usage
+    age = max(0, now_secs - last_secs) / cls.USAGE_HALF_LIFE_SECS
+    return 20 * math.log(1 + count) * math.pow(0.5, age)
+
+
+class CancelledError(Exception):
+  pass
+
+
+class CancellationToken(object):
+  ''' Cooperative cancellation of a background task. Tasks poll
+  is_cancelled() and on_cancel() callbacks run as soon as it is cancelled. '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._cancelled = False
+    self._callbacks = []
+
+  def cancel(self):
+    with self._lock:
+      if self._cancelled:
+        return
+      self._cancelled = True
+      callbacks = self._callbacks
+      self._callbacks = []
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception as e:
+        log_exception('Cancellation callback failed: [{0}]'.format(e))
+
+  def is_cancelled(self):
+    return self._cancelled
+
+  def check(self):
+    if self._cancelled:
+      raise CancelledError()
+
+  def on_cancel(self, callback):
+    with self._lock:
+      if not self._cancelled:
+        self._callbacks.append(callback)
+        return
+    callback()
+
+
+class OutputGate(object):
+  ''' Lets the listener of a streaming command pause it. While paused its
+  output is no longer read so the command blocks once its pipes are full
+  instead of streaming output nobody looks at. '''
+  def __init__(self):
     self._lock = threading.Lock()
-    self._tasks_running = 0
-    self._progress_animation = None
+    self._open = threading.Event()
+    self._open.set()
+    self._callbacks = []
+
+  def pause(self):
+    self._set_paused(True)
+
+  def resume(self):
+    self._set_paused(False)
+
+  def is_paused(self):
+    return not self._open.is_set()
+
+  def wait(self):
+    self._open.wait()
+
+  def on_change(self, callback):
+    ''' callback(paused) runs on every change and right away if paused. '''
+    with self._lock:
+      self._callbacks.append(callback)
+      paused = self.is_paused()
+    if paused:
+      callback(True)
 
-  def run(self, callback):
+  def _set_paused(self, paused):
     with self._lock:
-      self._tasks_running += 1
-      if self._tasks_running == 1:
-        self._progress_animation = ProgressAnimation(self.tasks_running).start()
-    def callback_wrapper():
+      if paused == self.is_paused():
+        return
+      if paused:
+        self._open.clear()
+      else:
+        self._open.set()
+      callbacks = list(self._callbacks)
+    for callback in callbacks:
+      try:
+        callback(paused)
+      except Exception as e:
+        log_exception('Output gate callback failed: [{0}]'.format(e))
+
+
+class ThreadPool(object):
+  ''' Runs background tasks on at most number_threads worker threads. The
+  most urgent priority runs first and tasks of the same priority run in the
+  order they were submitted. '''
+
+  # Opening and saving files the user is waiting on.
+  INTERACTIVE = 0
+  NORMAL = 1
+  # Listing files, grepping and building.
+  BULK = 2
+  # Speculative work nobody is waiting on yet.
+  PREFETCH = 3
+
+  def __init__(self, number_threads):
+    self._number_threads = number_threads
+    self._condition = threading.Condition()
+    # Heap of (priority, sequence, callback, CancellationToken).
+    self._queue = []
+    self._sequence = 0
+    self._threads = []
+    self._idle_threads = 0
+    self._tasks_active = 0
+    # Running tasks that are waiting on the user and so do not count against
+    # number_threads.
+    self._tasks_blocked = 0
+    # map<CancellationToken, priority> of the tasks running right now.
+    self._active_tokens = {}
+    self._closed = False
+    self._progress_animation = ProgressAnimation(
+        self.tasks_running, self.queue_depth)
+
+  def run(self, callback, priority=NORMAL, token=None):
+    ''' Returns the CancellationToken of the task. Tasks cancelled before
+    they start never run. '''
+    if token == None:
+      token = CancellationToken()
+    with self._condition:
+      if self._closed:
+        return token
+      heapq.heappush(self._queue, (priority, self._sequence, callback, token))
+      self._sequence += 1
+      self._start_thread_if_needed()
+      self._condition.notify()
+      tasks = self._tasks_active + len(self._queue)
+    if tasks == 1:
+      self._progress_animation.start()
+    self.log('tasks running = {0}, queued = {1}'.format(
+        self._tasks_active, len(self._queue)))
+    return token
+
+  def set_number_threads(self, number_threads):
+    ''' Called on the main thread when the setting changes so that run(),
+    called from any thread, never reads it through the Sublime API. '''
+    with self._condition:
+      self._number_threads = number_threads
+      if len(self._queue) > 0:
+        self._start_thread_if_needed()
+      # Idle threads beyond the new limit retire.
+      self._condition.notify_all()
+
+  def on_task_blocked(self, blocked):
+    ''' Called by a running task when it starts, or stops, waiting on the user
+    so that the other tasks do not wait on it too. '''
+    with self._condition:
+      self._tasks_blocked += 1 if blocked else -1
+      if len(self._queue) > 0:
+        self._start_thread_if_needed()
+      # Threads started while the task was blocked retire once idle.
+      self._condition.notify_all()
+
+  def _threads_over_limit(self):
+    return len(self._threads) - self._tasks_blocked - \
+        max(1, self._number_threads)
+
+  def _start_thread_if_needed(self):
+    # Idle threads include the ones notified that have not woken up yet so
+    # every queued task has a thread of its own to run on.
+    while self._idle_threads < len(self._queue) and \
+        self._threads_over_limit() < 0:
+      thread = threading.Thread(target=self._work,
+          name='RemoteCpp-{0}'.format(len(self._threads)))
+      thread.daemon = True
+      self._threads.append(thread)
+      # Idle from the moment it is started until it picks up a task.
+      self._idle_threads += 1
+      thread.start()
+
+  def _work(self):
+    while True:
+      with self._condition:
+        while len(self._queue) == 0 and not self._closed and \
+            self._threads_over_limit() <= 0:
+          self._condition.wait()
+        self._idle_threads -= 1
+        if self._closed:
+          return
+        if self._threads_over_limit() > 0:
+          self._threads.remove(threading.current_thread())
+          # Hand any wake up meant for a task over to another thread.
+          self._condition.notify()
+          return
+        task = heapq.heappop(self._queue)
+        priority, _, callback, token = task
+        if token.is_cancelled():
+          self._idle_threads += 1
+          continue
+        self._tasks_active += 1
+        self._active_tokens[token] = priority
       try:
         callback()
+      except CancelledError:
+        self.log('Background task was cancelled.')
       except Exception as e:
         log_exception(
             'Background task failed with exception: [{exception}]'.format(
                 exception=e))
-      with self._lock:
-        self._tasks_running -= 1
-    self.log('tasks running = ' + str(self._tasks_running))
-    sublime.set_timeout_async(callback_wrapper, 0)
+      with self._condition:
+        self._tasks_active -= 1
+        self._active_tokens.pop(token, None)
+        self._idle_threads += 1
 
   def tasks_running(self):
+    with self._condition:
+      return self._tasks_active + len(self._queue)
+
+  def queue_depth(self):
+    with self._condition:
+      return len(self._queue)
+
+  def cancel_all(self):
+    ''' Cancels every queued and running task except the INTERACTIVE ones so
+    that no save is ever lost. Returns the number of tasks cancelled. '''
+    with self._condition:
+      tokens = [ t for p, _, _, t in self._queue if p != self.INTERACTIVE ]
+      tokens.extend([ t for t, p in self._active_tokens.items()
+          if p != self.INTERACTIVE ])
+    tokens = [ t for t in set(tokens) if not t.is_cancelled() ]
+    for token in tokens:
+      token.cancel()
+    return len(tokens)
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._queue = []
+      self._condition.notify_all()
+    self._progress_animation.close()
+
+  def log(self, msg):
+    log(msg, type=type(self).__name__)
+
+
+class UploadQueue(object):
+  ''' Uploads saved files in the order they were saved with at most one
+  upload per file in flight. Saves of a file that is already waiting to be
+  uploaded coalesce into one upload of its latest content. '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # map<(cwd, path), (File, SettingsSnapshot)> of the files waiting to be
+    # uploaded.
+    self._pending = {}
+    # Keys of self._pending in save order.
+    self._order = []
+    # set<(cwd, path)> of the uploads in flight.
+    self._running = set()
+    # map<(cwd, path), (mtime, size, sha1)> of the local file when its latest
+    # upload was queued, for as long as it is pending or in flight.
+    self._fingerprints = {}
+    # vector<[set<(cwd, path)>, vector<File>, callback]> waiting on flush().
+    self._barriers = []
+
+  def push(self, file, settings=None):
+    ''' A save of a file whose upload was queued since it last changed is
+    ignored, so the same save may be pushed more than once. '''
+    key = (file.cwd, file.path)
+    fingerprint = self._fingerprint(file.local_path(False))
+    with self._lock:
+      if key in self._pending:
+        self.log('Coalescing the save of [{0}].'.format(file.remote_path()))
+        return
+      if key in self._running and fingerprint != None and \
+          self._fingerprints.get(key) == fingerprint:
+        self.log('[{0}] is already being uploaded.'.format(
+            file.remote_path()))
+        return
+      self._pending[key] = (file, settings)
+      self._order.append(key)
+      self._fingerprints[key] = fingerprint
+    self._schedule()
+
+  def flush(self, callback):
+    ''' Calls callback(failed_files) once every upload pending right now has
+    finished. Never blocks so it is safe to call from the thread pool. '''
+    with self._lock:
+      keys = set(self._pending.keys()) | self._running
+      if len(keys) > 0:
+        self._barriers.append([ keys, [], callback ])
+        return
+    callback([])
+
+  def files(self):
+    ''' The files waiting to be uploaded or being uploaded right now. '''
+    with self._lock:
+      keys = set(self._pending.keys()) | self._running
+    return [ File(cwd=cwd, path=path) for cwd, path in keys ]
+
+  @staticmethod
+  def _fingerprint(path):
+    ''' Two saves within the mtime resolution of the filesystem, as coarse as
+    a second on some, only match if their content does too. '''
+    try:
+      return (os.path.getmtime(path), os.path.getsize(path),
+          sha1_of_file(path))
+    except OSError:
+      return None
+
+  def _schedule(self):
+    to_run = []
+    with self._lock:
+      for key in list(self._order):
+        if not key in self._running:
+          self._order.remove(key)
+          self._running.add(key)
+          to_run.append(self._pending.pop(key))
+    for file, settings in to_run:
+      THREAD_POOL.run(
+          lambda file=file, settings=settings: self._upload(file, settings),
+          ThreadPool.INTERACTIVE)
+
+  def _upload(self, file, settings):
+    key = (file.cwd, file.path)
+    failed = False
+    try:
+      size = os.path.getsize(file.local_path())
+      sent = upload_file(file, settings)
+      set_status(
+          'Saved [{path}] sending {sent} of {size} bytes ({saved} saved).'
+          .format(
+              path=file.path,
+              sent=sent,
+              size=size,
+              saved=max(size - sent, 0)))
+    except Exception:
+      failed = True
+      log_exception('Failed to upload [{0}].'.format(file.remote_path()))
+      set_status('Failed to save [{0}]. :('.format(file.path))
+    callbacks = []
+    with self._lock:
+      self._running.discard(key)
+      done = not key in self._pending
+      if done:
+        self._fingerprints.pop(key, None)
+      for barrier in self._barriers:
+        if key in barrier[0]:
+          # Only the outcome of the latest upload of a file counts.
+          barrier[1] = [ f for f in barrier[1] if (f.cwd, f.path) != key ]
+          if failed:
+            barrier[1].append(file)
+        if done:
+          barrier[0].discard(key)
+        if len(barrier[0]) == 0:
+          callbacks.append(barrier)
+      self._barriers = [ b for b in self._barriers if len(b[0]) > 0 ]
+    self._schedule()
+    for _, failed_files, callback in callbacks:
+      callback(failed_files)
+
+  def log(self, msg):
+    log(msg, type=type(self).__name__)
+
+
+class Prefetcher(object):
+  ''' Downloads files the user is likely to open next into the local cache at
+  PREFETCH priority. Every push() downloads at most s_prefetch_max_bytes()
+  and newer pushes run first since older ones are less likely to matter. '''
+
+  # Pushes waiting to run beyond this are dropped, oldest first.
+  MAX_PENDING = 8
+  # Files remembered as prefetched beyond this are forgotten, least recently
+  # pushed first.
+  MAX_SEEN = 20000
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # vector<(cwd, vector<path>, SettingsSnapshot)> with the most recent push
+    # last.
+    self._pending = []
+    self._scheduled = False
+    # LRU set<(cwd, path)> of the files already prefetched, or tried to.
+    self._seen = collections.OrderedDict()
+    # set<(cwd, path)> of the prefetched files not opened yet.
+    self._prefetched = set()
+    self._hits = 0
+
+  def push(self, cwd, paths, settings=None):
+    if s_prefetch_max_bytes(settings) <= 0:
+      return
+    with self._lock:
+      fresh_paths = []
+      for path in paths:
+        if (cwd, path) in self._seen:
+          self._seen.move_to_end((cwd, path))
+        elif not os.path.isfile(File(cwd=cwd, path=path).local_path(False)):
+          fresh_paths.append(path)
+      paths = fresh_paths
+      if len(paths) == 0:
+        return
+      self._pending.append((cwd, paths, settings))
+      del self._pending[:-self.MAX_PENDING]
+      if self._scheduled:
+        return
+      self._scheduled = True
+    THREAD_POOL.run(self._run, ThreadPool.PREFETCH)
+
+  def push_related(self, file, settings=None):
+    ''' Prefetches the header/implementation siblings of the file and the
+    files it #includes. '''
+    THREAD_POOL.run(
+        lambda: self.push(file.cwd, related_paths(file, settings), settings),
+        ThreadPool.PREFETCH)
+
+  def forget(self, cwd, paths):
+    ''' Called when the local copies of the files were evicted so that they
+    can be prefetched again. '''
+    with self._lock:
+      for path in paths:
+        self._seen.pop((cwd, path), None)
+        self._prefetched.discard((cwd, path))
+
+  def on_open(self, file):
+    key = (file.cwd, file.path)
+    with self._lock:
+      hit = key in self._prefetched
+      self._prefetched.discard(key)
+    if hit:
+      self._hits += 1
+      self.log('Opened prefetched file [{path}] ({hits} hits so far).'.format(
+          path=file.path,
+          hits=self._hits))
+
+  def _run(self):
+    while True:
+      with self._lock:
+        if len(self._pending) == 0:
+          self._scheduled = False
+          return
+        cwd, paths, settings = self._pending.pop()
+        paths = [ p for p in paths if not (cwd, p) in self._seen ]
+        for path in paths:
+          self._seen[(cwd, path)] = True
+        while len(self._seen) > self.MAX_SEEN:
+          self._seen.popitem(last=False)
+      if len(paths) == 0:
+        continue
+      agent = get_agent(settings)
+      if agent == None:
+        # Only the agent can cap how many bytes a download sends.
+        continue
+      start_secs = time.time()
+      try:
+        entries = _download_with_agent(agent, cwd,
+            [ File(cwd=cwd, path=p) for p in paths ],
+            s_prefetch_max_bytes(settings))
+      except Exception as e:
+        self.log('Failed to prefetch files: [{0}]'.format(e))
+        continue
+      size = sum([ entry[0] for entry in entries.values() ])
+      with self._lock:
+        self._prefetched.update([ (cwd, p) for p in entries.keys() ])
+      self.log('Prefetched {count} of {total} files ({size} bytes) '
+          'in {millis} millis.'.format(
+              count=len(entries),
+              total=len(paths),
+              size=size,
+              millis=delta_millis(start_secs)))
+
+  def log(self, msg):
+    log(msg, type=type(self).__name__)
+
+
+class FileListScheduler(object):
+  ''' Periodically refreshes in the background the file list of every cwd
+  open in any window that uses the plugin. '''
+
+  TICK_MILLIS = 5000
+  # Seconds to wait before retrying a failed refresh (doubles every failure).
+  RETRY_SECS = 30
+  MAX_BACKOFF_SECS = 3600
+  JITTER = 0.1
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._running = set()
+    self._next_secs = {}
+    self._failures = {}
+    self._closed = False
+
+  def start(self):
+    sublime.set_timeout(self._tick, 0)
+    return self
+
+  def close(self):
+    self._closed = True
+
+  def _tick(self):
+    ''' Runs on the main thread and only reads the settings of the windows.
+    Everything else happens in the background. '''
+    if self._closed:
+      return
+    try:
+      settings_per_cwd = self._settings_per_cwd()
+      sublime.set_timeout_async(lambda: self._schedule(settings_per_cwd), 0)
+    except Exception:
+      log_exception('Failed to read the settings of the windows.')
+    sublime.set_timeout(self._tick, self.TICK_MILLIS)
+
+  def _schedule(self, settings_per_cwd):
+    try:
+      for cwd, (settings, is_remote) in settings_per_cwd.items():
+        # Windows that never used the plugin are left alone.
+        if not is_remote and STATE.list(cwd) == None:
+          continue
+        interval_secs = s_file_list_refresh_secs(settings)
+        if interval_secs > 0:
+          self._maybe_refresh(cwd, settings, interval_secs)
+    except Exception:
+      log_exception('Failed to schedule the file list refreshes.')
+
+  def _settings_per_cwd(self):
+    ''' map<cwd, (SettingsSnapshot, is_remote)> where is_remote is set when
+    the window configured a cwd or has views of remote files. '''
+    cwds = {}
+    for window in sublime.windows():
+      view = window.active_view()
+      if view == None:
+        continue
+      settings = settings_snapshot(view)
+      cwd = s_cwd(settings)
+      is_remote = settings.has('remote_cpp_cwd') or \
+          any([ self._is_remote_view(v) for v in window.views() ])
+      if is_remote or not cwd in cwds:
+        cwds[cwd] = (settings, is_remote)
+    return cwds
+
+  @staticmethod
+  def _is_remote_view(view):
+    return RemoteCppListFilesCommand.owns_view(view) or \
+        STATE.file(view.file_name()) != None
+
+  def _maybe_refresh(self, cwd, settings, interval_secs):
+    now_secs = time.time()
+    with self._lock:
+      if cwd in self._running:
+        return
+      if not cwd in self._next_secs:
+        # Spread the first refreshes of lists we already have.
+        delay_secs = 0
+        if STATE.list(cwd) != None:
+          delay_secs = random.uniform(0, self.JITTER * interval_secs)
+        self._next_secs[cwd] = now_secs + delay_secs
+      if now_secs < self._next_secs[cwd]:
+        return
+      self._running.add(cwd)
+    THREAD_POOL.run(lambda: self._refresh(cwd, settings, interval_secs),
+        ThreadPool.BULK)
+
+  def _refresh(self, cwd, settings, interval_secs):
+    start_secs = time.time()
+    try:
+      RemoteCppListFilesCommand.get_file_list(settings)
+    except Exception:
+      log_exception('Failed to refresh the file list for [{0}].'.format(cwd))
+      with self._lock:
+        failures = self._failures.get(cwd, 0) + 1
+        self._failures[cwd] = failures
+        delay_secs = min(self.RETRY_SECS * 2 ** (failures - 1),
+                         self.MAX_BACKOFF_SECS)
+    else:
+      self.log('Refreshed the file list for [{0}] in {1} millis.'.format(
+          cwd, delta_millis(start_secs)))
+      with self._lock:
+        self._failures.pop(cwd, None)
+        delay_secs = interval_secs
+    delay_secs *= random.uniform(1 - self.JITTER, 1 + self.JITTER)
+    with self._lock:
+      self._next_secs[cwd] = time.time() + delay_secs
+      self._running.discard(cwd)
+
+  def log(self, msg):
+    log(msg, type=type(self).__name__)
+
+
+class SshTransport(object):
+  ''' Keeps one long-lived authenticated ssh session (ControlMaster) per
+  (hostname, port) and lets every ssh/scp invocation ride on top of it. '''
+
+  # Seconds to wait for the master socket to show up after starting ssh.
+  CONNECT_TIMEOUT_SECS = 10
+  # Seconds to wait before retrying to start a master that failed.
+  RETRY_SECS = 30
+
+  def __init__(self, ssh, hostname, port):
+    self._ssh = ssh
+    self.hostname = hostname
+    self.port = port
+    self._lock = threading.Lock()
+    self._master = None
+    # Set once the master that is being started is up or failed.
+    self._connecting = None
+    self._multiplexing = True
+    self._last_failure_secs = 0
+    self._agent_lock = threading.Lock()
+    self._agent = None
+    self._agent_failure_secs = 0
+    # Private to this Sublime instance so that no other instance or user can
+    # reuse, or remove, our master connection.
+    self._control_path = os.path.join(
+        self._control_dir(),
+        '{0}-{1}'.format(
+            os.getpid(), md5('{0}:{1}'.format(hostname, port))[:16]))
+
+  def ssh_args(self, cmd_str):
+    args = [ self._ssh, '-p', str(self.port) ]
+    args.extend(self._mux_options())
+    args.extend([ self.hostname, cmd_str ])
+    return args
+
+  def scp_args(self, scp, src, dst):
+    args = [ scp, '-P', str(self.port) ]
+    args.extend(self._mux_options())
+    args.extend([ src, dst ])
+    return args
+
+  def remote(self, path):
+    return '{hostname}:{path}'.format(hostname=self.hostname, path=path)
+
+  def set_multiplexing(self, enabled):
+    with self._lock:
+      self._multiplexing = enabled
+      if not enabled:
+        self._kill_master()
+
+  def on_failure(self):
+    ''' Called when a command failed to reach the remote host. '''
+    with self._lock:
+      if self._connecting != None:
+        return
+      if self._master != None and self._master.poll() == None:
+        check = subprocess.Popen(
+            self._control_args() + [ '-O', 'check', self.hostname ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        if check.wait() == 0:
+          return
+        self.log('Master connection to [{0}] is broken.'.format(
+            self.hostname))
+      self._kill_master()
+
+  def agent(self, python):
+    ''' Returns the running AgentClient or None if it cannot be started. '''
+    with self._agent_lock:
+      if self._agent != None and self._agent.is_alive():
+        return self._agent
+      self._agent = None
+      if time.time() - self._agent_failure_secs < self.RETRY_SECS:
+        return None
+      self.log('Starting the agent on [{0}]...'.format(self.hostname))
+      try:
+        source = AgentClient.load_source()
+        self._agent = AgentClient(
+            self.ssh_args(AgentClient.bootstrap_cmd(python, len(source))),
+            source)
+      except Exception:
+        log_exception('Failed to start the agent so falling back to plain '
+            'ssh commands.')
+        self._agent_failure_secs = time.time()
+      return self._agent
+
+  def close(self):
+    with self._agent_lock:
+      if self._agent != None:
+        self._agent.close()
+        self._agent = None
+    with self._lock:
+      self._kill_master()
+
+  def _mux_options(self):
+    if not self._connect():
+      # Fall back to a brand new connection per command.
+      return []
+    return [
+        '-o', 'ControlMaster=no',
+        '-o', 'ControlPath={0}'.format(self._control_path),
+    ]
+
+  def _control_args(self):
+    return [
+        self._ssh,
+        '-p', str(self.port),
+        '-o', 'ControlPath={0}'.format(self._control_path),
+    ]
+
+  def _connect(self):
+    ''' Returns True when the master connection is up. Only the first caller
+    starts it and the lock is not held while it comes up. Other callers wait
+    for the result. '''
+    with self._lock:
+      if not self._multiplexing:
+        return False
+      connecting = self._connecting
+      if connecting == None:
+        if self._master != None:
+          if self._master.poll() == None and \
+              os.path.exists(self._control_path):
+            return True
+          self.log('Master connection to [{0}] exited with code [{1}].'.format(
+              self.hostname, self._master.poll()))
+          self._kill_master()
+        if time.time() - self._last_failure_secs < self.RETRY_SECS:
+          return False
+        self._master = self._start_master()
+        if self._master == None:
+          self._last_failure_secs = time.time()
+          return False
+        master = self._master
+        self._connecting = threading.Event()
+    if connecting != None:
+      connecting.wait()
+      with self._lock:
+        return self._master != None and self._master.poll() == None
+    connected = self._wait_for_master(master)
+    with self._lock:
+      connecting = self._connecting
+      self._connecting = None
+      if self._master is not master:
+        # Killed by set_multiplexing() or close() in the meantime.
+        connected = False
+      elif not connected:
+        self.log('Failed to start the master connection to [{0}].'.format(
+            self.hostname))
+        self._kill_master()
+        self._last_failure_secs = time.time()
+    connecting.set()
+    return connected
+
+  def _start_master(self):
+    self.log('Starting master connection to [{0}:{1}]...'.format(
+        self.hostname, self.port))
+    self._rm_control_path()
+    args = self._control_args() + [
+        '-M', '-N',
+        '-o', 'ControlPersist=no',
+        '-o', 'BatchMode=yes',
+        '-o', 'ServerAliveInterval=30',
+        self.hostname,
+    ]
+    try:
+      return subprocess.Popen(args,
+          stdin=subprocess.DEVNULL,
+          stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL)
+    except Exception:
+      log_exception('Failed to start the master ssh connection.')
+      return None
+
+  def _wait_for_master(self, master):
+    start_secs = time.time()
+    while time.time() - start_secs < self.CONNECT_TIMEOUT_SECS:
+      if os.path.exists(self._control_path):
+        self.log('Master connection is up after {0} millis.'.format(
+            delta_millis(start_secs)))
+        return True
+      if master.poll() != None:
+        return False
+      time.sleep(0.05)
+    return False
+
+  def _kill_master(self):
+    if self._master != None:
+      if self._master.poll() == None:
+        self._master.terminate()
+        try:
+          self._master.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+          self._master.kill()
+      self._master = None
+    self._rm_control_path()
+
+  @staticmethod
+  def _control_dir():
+    ''' Returns the directory for the control sockets of the user and creates
+    it if needed. Only the user can access it. '''
+    path = os.path.join(tempfile.gettempdir(),
+        'RemoteCpp-{0}'.format(getpass.getuser()))
+    if not os.path.isdir(path):
+      os.makedirs(path, 0o700)
+    if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+      raise Exception('[{0}] is owned by another user.'.format(path))
+    os.chmod(path, 0o700)
+    return path
+
+  def _rm_control_path(self):
+    try:
+      if os.path.exists(self._control_path):
+        os.remove(self._control_path)
+    except OSError:
+      log_exception('Failed to remove [{0}].'.format(self._control_path))
+
+  def log(self, msg):
+    log(msg, type=type(self).__name__)
+
+
+class AgentError(Exception):
+  pass
+
+
+class AgentConnectionError(AgentError):
+  pass
+
+
+class AgentCall(object):
+  ''' One in-flight request to the remote agent. '''
+  def __init__(self, on_frame):
+    self.id = None
+    self._on_frame = on_frame
+    self._done = threading.Event()
+    self._result = None
+    self._error = None
+
+  def on_frame(self, header, payload):
+    frame_type = header.get('type')
+    if frame_type == 'done':
+      self._result = header.get('result')
+      self._done.set()
+    elif frame_type == 'error':
+      self._fail(AgentError(header.get('error')))
+    elif self._on_frame != None:
+      self._on_frame(header, payload)
+
+  def on_disconnect(self):
+    self._fail(AgentConnectionError('Connection to the agent was lost.'))
+
+  def wait(self):
+    self._done.wait()
+    if self._error != None:
+      raise self._error
+    return self._result
+
+  def _fail(self, error):
+    self._error = error
+    self._done.set()
+
+
+class AgentClient(object):
+  ''' Talks to Agent/RemoteCppAgent.py over its stdin/stdout using
+  length-prefixed JSON headers followed by raw binary payloads. '''
+
+  RESOURCE = 'Packages/RemoteCpp/Agent/RemoteCppAgent.py'
+  FRAME = struct.Struct('>II')
+  HELLO_TIMEOUT_SECS = 15
+  DEFAULT_PYTHON = '$(command -v python3 || command -v python)'
+
+  def __init__(self, args, source):
+    self._lock = threading.Lock()
+    self._write_lock = threading.Lock()
+    self._calls = {}
+    self._next_id = 1
+    self._alive = True
+    self._hello = threading.Event()
+    self._proc = subprocess.Popen(args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    for target in (self._read_frames, self._read_stderr):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+    try:
+      self._write(source)
+    except (IOError, OSError):
+      pass
+    if not self._hello.wait(self.HELLO_TIMEOUT_SECS) or not self.is_alive():
+      self.close()
+      raise AgentConnectionError('The agent did not start: {0}'.format(
+          ' '.join(args)))
+
+  @staticmethod
+  def bootstrap_cmd(python, source_size):
+    ''' Shell command that reads the agent source from stdin and runs it. '''
+    if len(python) == 0:
+      python = AgentClient.DEFAULT_PYTHON
+    return ('{python} -c "import sys;b=getattr(sys.stdin,\'buffer\',sys.stdin);'
+        'exec(b.read({size}))"').format(python=python, size=source_size)
+
+  @staticmethod
+  def load_source():
+    return sublime.load_resource(AgentClient.RESOURCE).encode('utf-8')
+
+  def is_alive(self):
+    return self._alive and self._proc.poll() == None
+
+  def call(self, op, args, payload=b'', on_frame=None):
+    call = AgentCall(on_frame)
     with self._lock:
-      return self._tasks_running
+      if not self._alive:
+        raise AgentConnectionError('The agent is not running.')
+      id = self._next_id
+      self._next_id += 1
+      self._calls[id] = call
+      call.id = id
+    raw = json.dumps({ 'id': id, 'op': op, 'args': args }).encode('utf-8')
+    try:
+      self._write(self.FRAME.pack(len(raw), len(payload)) + raw + payload)
+    except (IOError, OSError):
+      self._disconnect()
+      raise AgentConnectionError('Failed to send request to the agent.')
+    return call
+
+  def request(self, op, args, payload=b'', on_frame=None):
+    return self.call(op, args, payload, on_frame).wait()
+
+  def cancel(self, call):
+    ''' Kills the remote processes started by the call without waiting. '''
+    try:
+      self.call('cancel', { 'id': call.id })
+    except AgentConnectionError:
+      pass
+
+  def pause(self, call, paused):
+    ''' Stops, or resumes, reading the output of the call without waiting. '''
+    try:
+      self.call('pause', { 'id': call.id, 'paused': paused })
+    except AgentConnectionError:
+      pass
 
   def close(self):
-    if self._progress_animation:
-      self._progress_animation.close()
-      self._progress_animation = None
+    self._disconnect()
+    if self._proc.poll() == None:
+      self._proc.kill()
+
+  def _write(self, raw):
+    with self._write_lock:
+      self._proc.stdin.write(raw)
+      self._proc.stdin.flush()
+
+  def _read_exactly(self, size):
+    chunks = []
+    missing = size
+    while missing > 0:
+      chunk = self._proc.stdout.read(missing)
+      if not chunk:
+        return None
+      chunks.append(chunk)
+      missing -= len(chunk)
+    return b''.join(chunks)
+
+  def _read_frames(self):
+    try:
+      while True:
+        raw = self._read_exactly(self.FRAME.size)
+        if raw == None:
+          break
+        header_len, payload_len = self.FRAME.unpack(raw)
+        raw = self._read_exactly(header_len)
+        payload = self._read_exactly(payload_len)
+        if raw == None or payload == None:
+          # The agent went away in the middle of a frame.
+          break
+        self._dispatch(json.loads(raw.decode('utf-8')), payload)
+    except Exception:
+      log_exception('Failed to read from the agent.')
+    self._disconnect()
+
+  def _dispatch(self, header, payload):
+    if header.get('type') == 'hello':
+      self.log('Agent version [{0}] is up.'.format(header.get('version')))
+      self._hello.set()
+      return
+    id = header.get('id')
+    with self._lock:
+      call = self._calls.get(id)
+      if header.get('type') in ('done', 'error'):
+        self._calls.pop(id, None)
+    if call != None:
+      call.on_frame(header, payload)
+
+  def _read_stderr(self):
+    for line in iter(self._proc.stderr.readline, b''):
+      self.log('stderr: ' + line.decode('utf-8', 'replace').rstrip())
+
+  def _disconnect(self):
+    with self._lock:
+      self._alive = False
+      calls = list(self._calls.values())
+      self._calls.clear()
+    self._hello.set()
+    for call in calls:
+      call.on_disconnect()
 
   def log(self, msg):
     log(msg, type=type(self).__name__)
 
 
 class ProgressAnimation(object):
-  def __init__(self, tasks_running):
+  def __init__(self, tasks_running, queue_depth=lambda : 0):
     self._len = 35  # Arbitrary value.
     self._pos = self._len
     self._tasks_running = tasks_running
+    self._queue_depth = queue_depth
+    self._lock = threading.Lock()
+    # Whether a cycle is scheduled, so that start() never runs two at once.
+    self._cycling = False
 
   def start(self):
-    self._pos = self._len
+    with self._lock:
+      if self._cycling:
+        return self
+      self._cycling = True
+      self._pos = self._len
     self._schedule_next_cycle()
+    return self
 
   def _schedule_next_cycle(self):
     sublime.set_timeout(self._run_progress_animation, 25)
@@ -294,11 +2738,17 @@ class ProgressAnimation(object):
         self._draw_animation()
         self._pos = (self._pos + 1) % (self._len * 2)
         self._schedule_next_cycle()
-      else:
-        sublime.status_message('')
+        return
+      restart = True
     except Exception as e:
       log_exception('Exception running animation: {0}'.format(e))
-      sublime.status_message('')
+      restart = False
+    sublime.status_message('')
+    with self._lock:
+      self._cycling = False
+    # A task may have started after the check above and found us cycling.
+    if restart and self._tasks_running() > 0:
+      self.start()
 
   def _draw_animation(self):
     water = ' '
@@ -313,29 +2763,166 @@ class ProgressAnimation(object):
     tasks = self._tasks_running()
     if tasks > 1:
       msg += ' x' + str(tasks)
+    queued = self._queue_depth()
+    if queued > 0:
+      msg += ' ({0} queued)'.format(queued)
     sublime.status_message(msg)
 
   def close(self):
     self._tasks_running = lambda : 0
 
 
+class SettingsSnapshot(object):
+  ''' The SETTING_NAMES of a window read once on the main thread. Background
+  jobs are handed one so every read of a job sees the same values and none
+  goes through the Sublime API. '''
+  def __init__(self, settings):
+    self._values = {}
+    for name in SETTING_NAMES:
+      value = settings.get(name)
+      if value != None:
+        self._values[name] = value
+
+  def get(self, setting, default):
+    if not setting in SETTING_NAMES:
+      raise KeyError('Setting [{0}] is not in SETTING_NAMES.'.format(setting))
+    return self._values.get(setting, default)
+
+  def __eq__(self, other):
+    return isinstance(other, SettingsSnapshot) and \
+        self._values == other._values
+
+  def __ne__(self, other):
+    return not self == other
+
+  def has(self, setting):
+    ''' Whether the setting was set rather than left to its default. '''
+    return setting in self._values
+
+
+class CwdRegistry(object):
+  ''' The cwd of every open view keyed by the name of its local cache root,
+  kept up to date by CwdRegistryEventListener so resolving a local path to
+  its File never has to walk the views. A path it does not know is not
+  looked up again until the next refresh. '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Set when settings changed, which may have moved views to other cwds
+    # without an event, so the next refresh_if_stale() walks all views.
+    self._stale = False
+    # map<view_id, cwd>
+    self._views = {}
+    # map<md5(cwd), [cwd, number of views]>
+    self._roots = {}
+
+  def set_view(self, view):
+    cwd = s_cwd(view)
+    with self._lock:
+      self._set(view.id(), cwd)
+
+  def remove_view(self, view_id):
+    with self._lock:
+      self._set(view_id, None)
+
+  def invalidate(self):
+    self._stale = True
+
+  def refresh_if_stale(self):
+    if self._stale:
+      self.refresh()
+
+  def refresh(self):
+    ''' Rebuilds the registry from every view in every window. '''
+    self._stale = False
+    views = {}
+    for window in sublime.windows():
+      for view in window.views():
+        views[view.id()] = s_cwd(view)
+    with self._lock:
+      self._views = {}
+      self._roots = {}
+      for view_id, cwd in views.items():
+        self._set(view_id, cwd)
+
+  def cwd(self, root_name):
+    entry = self._roots.get(root_name)
+    if entry == None:
+      return None
+    return entry[0]
+
+  def _set(self, view_id, cwd):
+    old_cwd = self._views.get(view_id)
+    if old_cwd == cwd:
+      return
+    if old_cwd != None:
+      del self._views[view_id]
+      key = md5(old_cwd)
+      self._roots[key][1] -= 1
+      if self._roots[key][1] == 0:
+        del self._roots[key]
+    if cwd != None:
+      self._views[view_id] = cwd
+      self._roots.setdefault(md5(cwd), [cwd, 0])[1] += 1
+
+
 class PluginState(object):
-  STATE_FILE = 'RemoteCpp.PluginState.json.bz2'
+  ''' Persisted in STATE_DIR with the state of every cwd in its own file,
+  only loaded the first time the cwd is used and only rewritten once it
+  changed. '''
+  STATE_DIR = 'RemoteCpp-State'
+  # Holds the state that does not belong to any cwd.
+  GLOBAL_FILE = 'global.json'
+  # Single file holding the whole state written by older versions.
+  LEGACY_STATE_FILE = 'RemoteCpp.PluginState.json.bz2'
 
   # Latest file_lists per CWD.
-  # new: map<cwd, vector<path>>
+  # new: map<cwd, FileList>
   LISTS = 'file_lists'
+  # Remote snapshot token of the file_list per CWD.
+  # new: map<cwd, token>
+  TOKENS = 'file_list_tokens'
+  # How often and how recently each file was opened per CWD.
+  # new: map<cwd, map<path, [open_count, last_open_secs]>>
+  USAGE = 'file_usage'
+  # Remote version of every file in the local cache per CWD.
+  # new: map<cwd, map<path, [size, mtime, sha1]>>
+  CACHED = 'cached_files'
+  # When every file in the local cache was last downloaded or opened per CWD.
+  # new: map<cwd, map<path, secs>>
+  ACCESSED = 'cached_files_accessed'
   README = 'has_readme_been_shown'
+  # Keys of the state stored in the file of each cwd.
+  CWD_KEYS = (LISTS, TOKENS, USAGE, CACHED, ACCESSED)
+
+  # Maximum number of files with usage stats kept per CWD.
+  MAX_USAGE_PER_CWD = 1000
 
   def __init__(self, state=dict()):
     self.state = state
+    self._lock = threading.RLock()
+    # map<cwd, FileListIndex>, derived from LISTS and never persisted.
+    self._indexes = {}
+    # CWDs whose file has been read, or found not to exist.
+    self._loaded = set()
+    # CWDs changed since they were last saved.
+    self._dirty = set()
+    self._dirty_global = False
     if not self.LISTS in self.state:
       self.state[self.LISTS] = {}
+    if not self.TOKENS in self.state:
+      self.state[self.TOKENS] = {}
+    if not self.USAGE in self.state:
+      self.state[self.USAGE] = {}
+    if not self.CACHED in self.state:
+      self.state[self.CACHED] = {}
+    if not self.ACCESSED in self.state:
+      self.state[self.ACCESSED] = {}
     if not self.README in self.state:
       self.state[self.README] = False
 
   def set_readme(self):
     self.state[self.README] = True
+    self._dirty_global = True
 
   def readme(self):
     return self.state[self.README]
@@ -343,87 +2930,368 @@ class PluginState(object):
   def file(self, local_path):
     if local_path == None:
       return None
-    for cwd in all_cwds():
-      local_root = File.local_root_for_cwd(cwd)
-      if local_path.startswith(local_root):
-        # the +1 is to remove the / (path separator character)
-        return File(cwd=cwd, path=local_path[len(local_root) + 1:])
-    return None
+    cache_root = os.path.join(cache_dir(), '')
+    if not local_path.startswith(cache_root):
+      return None
+    root_name, _, path = local_path[len(cache_root):].partition(os.sep)
+    cwd = CWD_REGISTRY.cwd(root_name)
+    if cwd == None:
+      return None
+    return File(cwd=cwd, path=path)
 
   def list(self, cwd):
+    self._load_cwd(cwd)
     if cwd in self.state[self.LISTS]:
       return self.state[self.LISTS][cwd]
     return None
 
-  def set_list(self, cwd, file_list):
-    self.state[self.LISTS][cwd] = file_list
+  def set_list(self, cwd, file_list, token=None):
+    if not isinstance(file_list, FileList):
+      file_list = FileList.from_paths(file_list)
+    index = None
+    if self._indexes.get(cwd) == None or self.list(cwd) is not file_list:
+      index = FileListIndex(file_list)
+    with self._lock:
+      self.state[self.LISTS][cwd] = file_list
+      self.state[self.TOKENS][cwd] = token
+      self._dirty.add(cwd)
+      if index != None:
+        self._indexes[cwd] = index
+
+  def index(self, cwd):
+    ''' Returns the FileListIndex for the cwd or None if there is no list. '''
+    index = self._indexes.get(cwd)
+    if index == None:
+      file_list = self.list(cwd)
+      if file_list == None:
+        return None
+      index = FileListIndex(file_list)
+      with self._lock:
+        if self.list(cwd) is file_list:
+          self._indexes[cwd] = index
+    return index
+
+  def list_token(self, cwd):
+    if self.list(cwd) == None:
+      return None
+    return self.state[self.TOKENS].get(cwd)
+
+  def usage(self, cwd):
+    self._load_cwd(cwd)
+    return self.state[self.USAGE].get(cwd, {})
+
+  def record_open(self, file):
+    with self._lock:
+      usage = dict(self.usage(file.cwd))
+      count, _ = usage.get(file.path, (0, 0))
+      usage[file.path] = [ count + 1, time.time() ]
+      if len(usage) > self.MAX_USAGE_PER_CWD:
+        # Forget the least recently opened files.
+        for path in sorted(usage, key=lambda p: usage[p][1])[
+            :len(usage) - self.MAX_USAGE_PER_CWD]:
+          del usage[path]
+      self.state[self.USAGE][file.cwd] = usage
+      self._set_accessed(file.cwd, [ file.path ])
+      self._dirty.add(file.cwd)
+
+  def cached(self, file):
+    ''' Returns the [size, mtime, sha1] the local copy was fetched at. '''
+    self._load_cwd(file.cwd)
+    return self.state[self.CACHED].get(file.cwd, {}).get(file.path)
+
+  def set_cached(self, cwd, entries):
+    ''' entries: map<path, [size, mtime, sha1]>. '''
+    if len(entries) == 0:
+      return
+    with self._lock:
+      self._load_cwd(cwd)
+      cached = dict(self.state[self.CACHED].get(cwd, {}))
+      cached.update(entries)
+      self.state[self.CACHED][cwd] = cached
+      self._set_accessed(cwd, entries.keys())
+      self._dirty.add(cwd)
+
+  def drop_cached(self, cwd, paths):
+    ''' Forgets the local copies of the paths. '''
+    with self._lock:
+      self._load_cwd(cwd)
+      for key in (self.CACHED, self.ACCESSED):
+        table = dict(self.state[key].get(cwd, {}))
+        for path in paths:
+          table.pop(path, None)
+        self.state[key][cwd] = table
+      self._dirty.add(cwd)
+
+  def clear_cached(self, cwd):
+    with self._lock:
+      self._load_cwd(cwd)
+      self.state[self.CACHED].pop(cwd, None)
+      self.state[self.ACCESSED].pop(cwd, None)
+      self._dirty.add(cwd)
+
+  def cached_cwds(self):
+    return set(self.state[self.CACHED].keys()) | \
+        set(self.state[self.ACCESSED].keys())
+
+  def cached_tables(self):
+    ''' map<cwd, (map<path, [size, mtime, sha1]>, map<path, secs>)> with the
+    CACHED and ACCESSED tables of every cwd. The cwds not loaded yet are read
+    from their files without being loaded. '''
+    with self._lock:
+      tables = dict([ (cwd, (self.state[self.CACHED].get(cwd, {}),
+          self.state[self.ACCESSED].get(cwd, {})))
+          for cwd in self.cached_cwds() ])
+      loaded_names = set([ self._cwd_file_name(cwd) for cwd in self._loaded ])
+    for name in self._list_files():
+      if name == self.GLOBAL_FILE or name in loaded_names:
+        continue
+      record = self._read_cwd_file(name)
+      if record == None or record.get('cwd') == None:
+        continue
+      with self._lock:
+        if record['cwd'] in self._loaded:
+          # Loaded meanwhile so the tables in memory are newer.
+          continue
+      tables[record['cwd']] = (record.get(self.CACHED, {}),
+          record.get(self.ACCESSED, {}))
+    return tables
+
+  def accessed(self, cwd):
+    ''' map<path, secs> of the local copies of the cwd. '''
+    self._load_cwd(cwd)
+    return self.state[self.ACCESSED].get(cwd, {})
+
+  def _set_accessed(self, cwd, paths):
+    now_secs = time.time()
+    accessed = dict(self.accessed(cwd))
+    for path in paths:
+      accessed[path] = now_secs
+    self.state[self.ACCESSED][cwd] = accessed
+
+  def build_indexes(self, cwds):
+    for cwd in cwds:
+      self.index(cwd)
 
   def update_list(self, cwd, files_to_add = [], files_to_rm = []):
-    old_list = self.list(cwd)
-    if not old_list:
+    if not self.list(cwd):
       return
-    paths_to_rm = set([f.path for f in files_to_rm])
-    new_list = []
-    for path in old_list:
-      if path not in paths_to_rm:
-        new_list.append(path)
-    new_list.extend([f.path for f in files_to_add])
-    new_list = normalise_file_list(new_list)
-    self.set_list(cwd, new_list)
-
-  def gc(self):
+    self._apply_paths(cwd,
+        paths_to_add=[f.path for f in files_to_add],
+        paths_to_rm=[f.path for f in files_to_rm])
+
+  def apply_list_delta(self, cwd, base_token, token, paths_to_add, paths_to_rm):
+    ''' Applies a remote delta computed against base_token. Returns False if
+    the stored list is not the one the delta was computed against. '''
+    with self._lock:
+      if self.list(cwd) == None or self.list_token(cwd) != base_token:
+        return False
+      self._apply_paths(cwd, paths_to_add, paths_to_rm)
+      self.state[self.TOKENS][cwd] = token
+      self._dirty.add(cwd)
+      return True
+
+  def _apply_paths(self, cwd, paths_to_add, paths_to_rm):
+    ''' The new list is only published once it is complete so readers never
+    see a partial update. '''
+    with self._lock:
+      file_list = self.list(cwd)
+      file_index = self._indexes.get(cwd)
+      paths_to_rm = [ p for p in paths_to_rm if p in file_list ]
+      paths_to_add = [ p for p in paths_to_add if not p in file_list ]
+      self.state[self.LISTS][cwd] = file_list.with_changes(
+          paths_to_add, paths_to_rm)
+      if file_index != None:
+        self._indexes[cwd] = file_index.with_changes(paths_to_add, paths_to_rm)
+      self._dirty.add(cwd)
+
+  def gc(self, settings, cwds, open_paths):
+    ''' Deletes the file lists of the cwds not open in any window. Their
+    local cache state is kept and only dropped from memory once saved. cwds
+    and open_paths are the all_cwds() and open_local_paths() of the main
+    thread. '''
     self.log('RemoteCpp is GC\'ing the PluginState...')
     start_secs = time.time()
-    all_local_paths = set()
-    cwds = all_cwds()
-    for cwd in tuple(self.state[self.LISTS].keys()):
-      if not cwd in cwds:
-        log('Deleting file list for cwd [{0}].'.format(cwd))
-        del self.state[self.LISTS][cwd]
+    with self._lock:
+      inactive = set([ cwd for cwd in self._loaded if not cwd in cwds ])
+      loaded_names = set([ self._cwd_file_name(cwd) for cwd in self._loaded ])
+    for name in self._list_files():
+      if name == self.GLOBAL_FILE or name in loaded_names:
+        continue
+      record = self._read_cwd_file(name)
+      if record == None:
+        try:
+          os.remove(os.path.join(self._dir(), name))
+        except OSError:
+          log_exception('Failed to delete the state file [{0}].'.format(name))
+      elif not record.get('cwd') in cwds and \
+          record.get(self.LISTS) != None:
+        self._load_cwd(record['cwd'], record)
+        inactive.add(record['cwd'])
+    with self._lock:
+      for cwd in inactive:
+        if self.state[self.LISTS].pop(cwd, None) != None:
+          log('Deleting file list for cwd [{0}].'.format(cwd))
+          self._dirty.add(cwd)
+        self.state[self.TOKENS].pop(cwd, None)
+        self._indexes.pop(cwd, None)
+    self.save()
+    with self._lock:
+      for cwd in inactive:
+        if not cwd in self._dirty:
+          for key in self.CWD_KEYS:
+            self.state[key].pop(cwd, None)
+          self._loaded.discard(cwd)
+    files, size = evict_local_cache(settings, cwds, open_paths)
     millis = delta_millis(start_secs)
-    self.log('RemoteCpp finished GC in {millis} millis.'.format(millis=millis))
+    self.log(('RemoteCpp finished GC in {millis} millis reclaiming {size} '
+        'bytes from {files} local files.').format(
+            millis=millis,
+            size=size,
+            files=files))
+    return size
 
   def load(self):
+    ''' Only reads the global state. The state of every cwd is read the
+    first time it is used. '''
     start_secs = time.time()
-    path = PluginState._path()
+    legacy_path = os.path.join(plugin_dir(), self.LEGACY_STATE_FILE)
+    if os.path.isfile(legacy_path):
+      self._migrate(legacy_path)
+      return
+    path = os.path.join(self._dir(), self.GLOBAL_FILE)
     if not os.path.isfile(path):
       return
     self.log('Reading RemoteCpp PluginState from [{0}]...'.format(path))
-    with bz2.open(path, 'rt') as fp:
-      new_state = json.load(fp)
+    with open(path, 'rb') as fp:
+      new_state = json.loads(fp.read().decode('utf-8'))
+    with self._lock:
       self.state.update(new_state)
-    size_bytes = os.path.getsize(path)
-    millis = delta_millis(start_secs)
     self.log('Successfully loaded {bytes} bytes in {millis} millis.'.format(
-        bytes=size_bytes,
-        millis=millis))
+        bytes=os.path.getsize(path),
+        millis=delta_millis(start_secs)))
 
   def save(self):
+    ''' Writes the global state and the state of every cwd changed since the
+    last save, each atomically in its own file. '''
     start_secs = time.time()
-    raw = json.dumps(self.state, indent=2)
-    path = self._path()
-    self.log('Writing RemoteCpp PluginState to [{0}]...'.format(path))
-    dir = os.path.dirname(path)
-    if not os.path.isdir(dir):
-      os.makedirs(dir)
-    with bz2.open(path, 'wt') as fp:
-      fp.write(raw)
-    millis = delta_millis(start_secs)
-    size_bytes = os.path.getsize(path)
-    self.log('Successully wrote {bytes} bytes in {millis}.'.format(
-        bytes=size_bytes,
-        millis=millis))
+    with self._lock:
+      dirty = self._dirty
+      self._dirty = set()
+      dirty_global = self._dirty_global
+      self._dirty_global = False
+      if len(dirty) == 0 and not dirty_global:
+        return
+      # Values are replaced, never mutated, so they can be written unlocked.
+      records = {}
+      for cwd in dirty:
+        record = dict([ (key, self.state[key][cwd]) for key in self.CWD_KEYS
+            if cwd in self.state[key] ])
+        if len(record) > 0:
+          record['cwd'] = cwd
+        if record.get(self.LISTS) != None:
+          record[self.LISTS] = record[self.LISTS].to_json()
+        records[cwd] = record
+      global_record = dict([ (key, value) for key, value in self.state.items()
+          if not key in self.CWD_KEYS ])
+    size_bytes = 0
+    try:
+      if dirty_global:
+        raw = json.dumps(global_record, indent=2).encode('utf-8')
+        write_file_atomically(os.path.join(self._dir(), self.GLOBAL_FILE), raw)
+        size_bytes += len(raw)
+      while len(records) > 0:
+        cwd, record = records.popitem()
+        path = os.path.join(self._dir(), self._cwd_file_name(cwd))
+        if len(record) == 0:
+          if os.path.isfile(path):
+            os.remove(path)
+          continue
+        raw = zlib.compress(
+            json.dumps(record, separators=(',', ':')).encode('utf-8'), 1)
+        write_file_atomically(path, raw)
+        size_bytes += len(raw)
+    except:
+      # Whatever was not written is written by the next save.
+      with self._lock:
+        self._dirty.update(records.keys())
+        self._dirty_global = self._dirty_global or dirty_global
+      raise
+    self.log('Successully wrote {bytes} bytes of {count} cwds in {millis}.'
+        .format(
+            bytes=size_bytes,
+            count=len(dirty),
+            millis=delta_millis(start_secs)))
+
+  def _load_cwd(self, cwd, record=None):
+    ''' record is the content of the state file of the cwd if already read. '''
+    if cwd in self._loaded:
+      return
+    with self._lock:
+      if cwd in self._loaded:
+        return
+      self._loaded.add(cwd)
+      start_secs = time.time()
+      if record == None:
+        record = self._read_cwd_file(self._cwd_file_name(cwd))
+      if record == None or record.get('cwd') != cwd:
+        return
+      if record.get(self.LISTS) != None:
+        record[self.LISTS] = FileList.from_json(record[self.LISTS])
+      for key in self.CWD_KEYS:
+        # Whatever was set before loading is newer.
+        if key in record and not cwd in self.state[key]:
+          self.state[key][cwd] = record[key]
+      self.log('Loaded the state of cwd [{cwd}] in {millis} millis.'.format(
+          cwd=cwd,
+          millis=delta_millis(start_secs)))
+
+  def _migrate(self, legacy_path):
+    ''' Splits the single state file of older versions into one per cwd. '''
+    self.log('Migrating RemoteCpp PluginState from [{0}]...'.format(
+        legacy_path))
+    with bz2.open(legacy_path, 'rt') as fp:
+      new_state = json.load(fp)
+    lists = new_state.get(self.LISTS, {})
+    for cwd in lists:
+      lists[cwd] = FileList.from_json(lists[cwd])
+    with self._lock:
+      self.state.update(new_state)
+      for key in self.CWD_KEYS:
+        self._dirty.update(self.state[key].keys())
+      self._loaded.update(self._dirty)
+      self._dirty_global = True
+    self.save()
+    os.remove(legacy_path)
+
+  def _read_cwd_file(self, name):
+    ''' Returns the record stored in the state file or None. '''
+    path = os.path.join(self._dir(), name)
+    if not os.path.isfile(path):
+      return None
+    try:
+      with open(path, 'rb') as fp:
+        return json.loads(zlib.decompress(fp.read()).decode('utf-8'))
+    except Exception:
+      log_exception('Failed to read the state file [{0}].'.format(name))
+      return None
+
+  def _list_files(self):
+    if not os.path.isdir(self._dir()):
+      return []
+    return [ name for name in os.listdir(self._dir())
+        if not name.endswith('.tmp') ]
 
   @staticmethod
   def log(msg):
     log(msg, type=PluginState.__name__)
 
   @staticmethod
-  def _path():
-    path = os.path.join(
-      plugin_dir(),
-      PluginState.STATE_FILE)
-    return path
+  def _dir():
+    return os.path.join(plugin_dir(), PluginState.STATE_DIR)
+
+  @staticmethod
+  def _cwd_file_name(cwd):
+    return '{0}.json.z'.format(md5(cwd))
 
 
 ##############################################################
@@ -437,39 +3305,296 @@ def normalise_file_list(file_list):
     if len(path) == 0:
       continue
     new_list.append(path)
-  def key_generator(path):
-    dir, name = os.path.split(path)
-    # Make sure files always appear before sub-directories.
-    return os.path.join(dir, '\x00' + name)
-  new_list = sorted(new_list,
-                    key=key_generator)
-  return new_list
+  new_list = sorted(set(new_list),
+                    key=file_list_key)
+  return FileList.from_paths(new_list)
+
+def file_list_key(path):
+  dir, name = os.path.split(path)
+  # Make sure files always appear before sub-directories.
+  return os.path.join(dir, '\x00' + name)
+
 
 def set_status(msg):
   msg = "RemoteCpp -> " + msg
   runnable = lambda: sublime.status_message(msg)
   sublime.set_timeout(runnable, 1000)
 
-def clear_local_caches():
-  files = []
-  roots = set()
-  for window in sublime.windows():
-    # All views in a window share the same settings.
-    view = window.views()[0]
-    cwd = s_cwd(view)
-    local_root = File.local_root_for_cwd(cwd)
-    roots.add(local_root)
-  for root in roots:
-      log('Deleting local cache directory [{0}]...'.format(root))
-      if os.path.exists(root):
-        shutil.rmtree(root)
-  for file in files:
-    log("Refreshing open file [{0}]...".format(file.remote_path()))
-    download_file(file)
+def clear_local_caches(cwds):
+  for cwd in cwds:
+    root = File.local_root_for_cwd(cwd)
+    log('Deleting local cache directory [{0}]...'.format(root))
+    STATE.clear_cached(cwd)
+    if os.path.exists(root):
+      shutil.rmtree(root)
+  objects_dir = cache_objects_dir()
+  if os.path.exists(objects_dir):
+    log('Deleting local cache directory [{0}]...'.format(objects_dir))
+    shutil.rmtree(objects_dir)
+
+def cache_dir():
+  return os.path.join(plugin_dir(), 'RemoteCpp-Cache')
+
+def evict_local_cache(settings, cwds, open_paths):
+  ''' Deletes the least recently used local copies of remote files until the
+  cache is within s_cache_max_bytes() and s_cache_max_files(), and every
+  cache object no local copy refers to. Files open in a view or waiting to be
+  uploaded are never deleted. cwds and open_paths are the all_cwds() and
+  open_local_paths() of the main thread. Returns (files, bytes) reclaimed. '''
+  start_secs = time.time()
+  # Includes the cwds not loaded in this session, whose local copies and cache
+  # objects must be accounted for too.
+  tables = STATE.cached_tables()
+  cwds = dict([ (md5(cwd), cwd) for cwd in set(tables.keys()) | set(cwds) ])
+  pinned = set(open_paths)
+  for file in UPLOAD_QUEUE.files():
+    pinned.add(file.local_path(False))
+  # vector<(access_secs, size, local_path, cwd, path)> of evictable files.
+  candidates = []
+  total_files = 0
+  total_bytes = 0
+  root = cache_dir()
+  for name in (os.listdir(root) if os.path.isdir(root) else ()):
+    cwd = cwds.get(name)
+    accessed = tables[cwd][1] if cwd in tables else {}
+    local_root = os.path.join(root, name)
+    for directory, _, names in os.walk(local_root):
+      for file_name in names:
+        local_path = os.path.join(directory, file_name)
+        try:
+          stat = os.stat(local_path)
+        except OSError:
+          continue
+        total_files += 1
+        total_bytes += stat.st_size
+        if local_path in pinned:
+          continue
+        path = os.path.relpath(local_path, local_root).replace(os.sep, '/')
+        candidates.append((accessed.get(path, stat.st_mtime), stat.st_size,
+            local_path, cwd, path))
+  # The objects no local copy refers to are reclaimed no matter what.
+  # map<sha1, number of local copies with that content>.
+  sha1s = {}
+  for cached, _ in tables.values():
+    for entry in cached.values():
+      sha1s[entry[2]] = sha1s.get(entry[2], 0) + 1
+  object_sizes = {}
+  reclaimed_bytes = 0
+  objects_dir = cache_objects_dir()
+  for directory, _, names in os.walk(objects_dir):
+    for sha1 in names:
+      object_path = os.path.join(directory, sha1)
+      try:
+        size = os.path.getsize(object_path)
+        if sha1 in sha1s:
+          object_sizes[sha1] = size
+          total_bytes += size
+        else:
+          os.remove(object_path)
+          reclaimed_bytes += size
+          _remove_empty_dirs(directory, objects_dir)
+      except OSError:
+        continue
+  max_bytes = s_cache_max_bytes(settings)
+  max_files = s_cache_max_files(settings)
+  target_bytes = int(max_bytes * CACHE_EVICTION_TARGET)
+  target_files = int(max_files * CACHE_EVICTION_TARGET)
+  if (max_bytes <= 0 or total_bytes <= max_bytes) and \
+      (max_files <= 0 or total_files <= max_files):
+    target_bytes = target_files = None
+  evicted = {}
+  evicted_files = 0
+  candidates.sort()
+  for _, size, local_path, cwd, path in candidates:
+    if target_bytes == None or \
+        ((max_bytes <= 0 or total_bytes <= target_bytes) and
+            (max_files <= 0 or total_files <= target_files)):
+      break
+    try:
+      os.remove(local_path)
+    except OSError:
+      continue
+    total_files -= 1
+    total_bytes -= size
+    reclaimed_bytes += size
+    evicted_files += 1
+    _remove_empty_dirs(os.path.dirname(local_path), root)
+    if cwd == None:
+      continue
+    evicted.setdefault(cwd, []).append(path)
+    entry = tables[cwd][0].get(path) if cwd in tables else None
+    if entry == None or not entry[2] in sha1s:
+      continue
+    sha1s[entry[2]] -= 1
+    if sha1s[entry[2]] == 0 and entry[2] in object_sizes:
+      try:
+        os.remove(cache_object_path(entry[2]))
+        _remove_empty_dirs(os.path.dirname(cache_object_path(entry[2])),
+            cache_objects_dir())
+        total_bytes -= object_sizes[entry[2]]
+        reclaimed_bytes += object_sizes[entry[2]]
+      except OSError:
+        pass
+  for cwd, paths in evicted.items():
+    STATE.drop_cached(cwd, paths)
+    PREFETCHER.forget(cwd, paths)
+  if reclaimed_bytes > 0:
+    log(('Evicted {files} local files reclaiming {size} bytes in {millis} '
+        'millis. The cache now has {total_files} files and {total_bytes} '
+        'bytes.').format(
+            files=evicted_files,
+            size=reclaimed_bytes,
+            millis=delta_millis(start_secs),
+            total_files=total_files,
+            total_bytes=total_bytes))
+  return evicted_files, reclaimed_bytes
+
+def _remove_empty_dirs(directory, root):
+  while directory != root and directory.startswith(root):
+    try:
+      os.rmdir(directory)
+    except OSError:
+      return
+    directory = os.path.dirname(directory)
+
+def schedule_cache_eviction():
+  ''' Evicts local files in the background every CACHE_EVICTION_SECS. Runs
+  on the main thread to read what is open. '''
+  settings = settings_snapshot()
+  cwds = all_cwds()
+  open_paths = open_local_paths()
+  def evict():
+    try:
+      evict_local_cache(settings, cwds, open_paths)
+    finally:
+      sublime.set_timeout(schedule_cache_eviction, CACHE_EVICTION_SECS * 1000)
+  THREAD_POOL.run(evict, ThreadPool.PREFETCH)
+
+def build_indexes_in_background():
+  ''' Indexes the file lists of every open cwd before they are needed. '''
+  cwds = all_cwds()
+  sublime.set_timeout_async(lambda: STATE.build_indexes(cwds), 0)
+
+def gc_in_background(settings):
+  ''' GCs the PluginState and the local cache. Runs on the main thread to
+  read what is open. '''
+  cwds = all_cwds()
+  open_paths = open_local_paths()
+  def gc():
+    size = STATE.gc(settings, cwds, open_paths)
+    set_status('RemoteCpp GC reclaimed {0} bytes.'.format(size))
+  THREAD_POOL.run(gc, ThreadPool.BULK)
+
+def cache_objects_dir():
+  return os.path.join(plugin_dir(), 'RemoteCpp-Objects')
+
+def cache_object_path(sha1):
+  return os.path.join(cache_objects_dir(), sha1[:2], sha1)
+
+def store_cache_object(content):
+  ''' Keeps a pristine copy of the content under its sha1 and returns it. '''
+  sha1 = hashlib.sha1(content).hexdigest()
+  path = cache_object_path(sha1)
+  if not os.path.isfile(path):
+    write_file_atomically(path, content)
+  return sha1
+
+def write_file_atomically(path, content):
+  ''' Readers, and a crash half way through, see either the old or the new
+  content of the file but never a mix. '''
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  tmp_path = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+  with open(tmp_path, 'wb') as fp:
+    fp.write(content)
+    fp.flush()
+    os.fsync(fp.fileno())
+  os.replace(tmp_path, path)
+
+def cache_file(file, content, size, mtime):
+  ''' Writes the local copy of a remote file and returns its cache entry. '''
+  with open(file.local_path(), 'wb') as fp:
+    fp.write(content)
+  return [ size, mtime, store_cache_object(content) ]
+
+def sha1_of_file(path):
+  ''' Returns None if the file does not exist. '''
+  if not os.path.isfile(path):
+    return None
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(64 * 1024), b''):
+      sha1.update(chunk)
+  return sha1.hexdigest()
 
 def plugin_dir():
   return os.path.join(sublime.cache_path(), 'RemoteCpp')
 
+def output_dir():
+  return os.path.join(plugin_dir(), 'RemoteCpp-Output')
+
+def gc_output_files():
+  ''' Deletes the full outputs of commands older than OUTPUT_MAX_AGE_SECS. '''
+  directory = output_dir()
+  if not os.path.isdir(directory):
+    return
+  now_secs = time.time()
+  for name in os.listdir(directory):
+    path = os.path.join(directory, name)
+    try:
+      if now_secs - os.path.getmtime(path) > OUTPUT_MAX_AGE_SECS:
+        os.remove(path)
+    except OSError:
+      log_exception('Failed to delete the output file [{0}].'.format(path))
+
+def settings_snapshot(view=None):
+  ''' The SettingsSnapshot of the window of the view, or of the active view.
+  It is only read again after the settings of one of its views change. '''
+  if isinstance(view, SettingsSnapshot):
+    return view
+  if view == None:
+    view = sublime.active_window().active_view()
+    if view == None:
+      # A window without views only has the user preferences.
+      return SettingsSnapshot(sublime.load_settings(PREFERENCES_FILE))
+  window = view.window()
+  if window == None:
+    return SettingsSnapshot(view.settings())
+  with SETTINGS_SNAPSHOTS_LOCK:
+    snapshot = SETTINGS_SNAPSHOTS.get(window.id())
+    is_watched = view.id() in SETTINGS_WATCHED
+  if not is_watched:
+    watch_settings(view.id(), view.settings())
+  if snapshot == None:
+    snapshot = SettingsSnapshot(view.settings())
+    with SETTINGS_SNAPSHOTS_LOCK:
+      SETTINGS_SNAPSHOTS[window.id()] = snapshot
+  return snapshot
+
+def watch_settings(key, settings):
+  ''' Invalidates the snapshots whenever one of the SETTING_NAMES in settings
+  changes value. Changes to any other setting, like the word_wrap the plugin
+  sets on its own views, are ignored. '''
+  with SETTINGS_SNAPSHOTS_LOCK:
+    SETTINGS_WATCHED[key] = SettingsSnapshot(settings)
+  def on_change():
+    values = SettingsSnapshot(settings)
+    with SETTINGS_SNAPSHOTS_LOCK:
+      if SETTINGS_WATCHED.get(key) == values:
+        return
+      SETTINGS_WATCHED[key] = values
+    invalidate_settings_snapshots()
+  settings.add_on_change(SETTINGS_ON_CHANGE_KEY, on_change)
+
+def invalidate_settings_snapshots():
+  ''' Called on the main thread whenever settings change. '''
+  with SETTINGS_SNAPSHOTS_LOCK:
+    SETTINGS_SNAPSHOTS.clear()
+  CWD_REGISTRY.invalidate()
+  if THREAD_POOL != None:
+    THREAD_POOL.set_number_threads(s_thread_pool_threads())
+
 def all_cwds():
   cwds = set()
   for window in sublime.windows():
@@ -477,6 +3602,14 @@ def all_cwds():
       cwds.add(s_cwd(view))
   return cwds
 
+def open_local_paths():
+  paths = set()
+  for window in sublime.windows():
+    for view in window.views():
+      if view.file_name() != None:
+        paths.add(view.file_name())
+  return paths
+
 def normalise_path(path):
   path = path.strip()
   if path.startswith('./'):
@@ -512,57 +3645,871 @@ def is_remote_cpp_file(view):
   _, extension = os.path.splitext(file.path)
   return extension.lower() in CPP_EXTENSIONS
 
-def download_file(file):
-  log('Downloading the file [{file}]...'.format(file=file.remote_path()))
-  run_cmd((
-      s_scp(),
-      '-P', str(s_ssh_port()),
-      '{hostname}:{path}'.format(
-          path=file.remote_path(),
-          hostname=s_ssh_hostname()),
-      '{path}'.format(path=file.local_path())
-  ))
-  log('Done downloading the file into [{file}].'.format(file=file.local_path()))
-
-def create_cmd_ssh_args(cmd_str):
-  args = [ s_ssh(), '-p {0}'.format(s_ssh_port()), s_ssh_hostname(), cmd_str ]
-  return args
-
-def ssh_cmd(cmd_str, listener=CmdListener()):
-  args = create_cmd_ssh_args(cmd_str)
-  run_cmd(args, listener)
-
-def run_cmd(cmd_list, listener=CmdListener()):
+def get_transport(settings=None):
+  key = (s_ssh_hostname(settings), s_ssh_port(settings))
+  with TRANSPORTS_LOCK:
+    transport = TRANSPORTS.get(key)
+    if transport == None:
+      transport = SshTransport(s_ssh(settings), key[0], key[1])
+      TRANSPORTS[key] = transport
+  transport.set_multiplexing(s_ssh_multiplexing(settings))
+  return transport
+
+def close_transports():
+  with TRANSPORTS_LOCK:
+    transports = list(TRANSPORTS.values())
+    TRANSPORTS.clear()
+  for transport in transports:
+    transport.close()
+
+def get_agent(settings=None):
+  if not s_agent(settings):
+    return None
+  return get_transport(settings).agent(s_agent_python(settings))
+
+def with_agent(agent_function, fallback_function, settings=None):
+  ''' Runs agent_function(agent) if the agent is available, otherwise (or if
+  the agent connection is lost) runs fallback_function(). '''
+  agent = get_agent(settings)
+  if agent != None:
+    try:
+      return agent_function(agent)
+    except AgentConnectionError:
+      log_exception('Lost the connection to the agent.')
+  return fallback_function()
+
+def related_paths(file, settings=None):
+  ''' Paths the user is likely to open after the file: its siblings and the
+  files it #includes, resolved against the file list. '''
+  index = STATE.index(file.cwd)
+  if index == None:
+    return []
+  paths = index.siblings(file.path)[:2]
+  _, extension = os.path.splitext(file.path)
+  if not extension.lower() in CPP_EXTENSIONS:
+    return paths
+  try:
+    with open(file.local_path(False), 'rb') as fp:
+      text = fp.read().decode('utf-8', 'replace')
+  except (IOError, OSError):
+    return paths
+  include_roots = s_include_roots(settings)
+  for include in INCLUDE_REGEX.findall(text)[:PREFETCH_MAX_INCLUDES]:
+    candidates = index.resolve_include(include, file.path, include_roots)
+    if len(candidates) > 0 and not candidates[0] in paths:
+      paths.append(candidates[0])
+  return paths
+
+def download_file(file, settings=None):
+  failed = download_files([ file ], settings)
+  if len(failed) > 0:
+    raise Exception('Failed to download the file [{0}].'.format(
+        file.remote_path()))
+
+def download_files(files, settings=None):
+  ''' Downloads all files in a single round trip per cwd and returns the list
+  of files that could not be downloaded. '''
+  failed = []
+  files_per_cwd = {}
+  for file in files:
+    files_per_cwd.setdefault(file.cwd, []).append(file)
+  for cwd, cwd_files in files_per_cwd.items():
+    start_secs = time.time()
+    log('Downloading {count} files from [{cwd}]...'.format(
+        count=len(cwd_files),
+        cwd=cwd))
+    downloaded = with_agent(
+        lambda agent: set(_download_with_agent(agent, cwd, cwd_files).keys()),
+        lambda: _download_with_ssh(cwd, cwd_files, settings),
+        settings)
+    for file in cwd_files:
+      if not file.path in downloaded:
+        failed.append(file)
+    log('Downloaded {count} files in {millis} millis.'.format(
+        count=len(downloaded),
+        millis=delta_millis(start_secs)))
+  return failed
+
+def _download_with_agent(agent, cwd, files, max_bytes=None):
+  ''' Returns the cache entries of the downloaded files. With max_bytes the
+  files that would take the download over it are skipped. '''
+  frames = []
+  args = { 'cwd': cwd, 'paths': [ f.path for f in files ] }
+  if max_bytes != None:
+    args['max_bytes'] = max_bytes
+  agent.request('read', args,
+      on_frame=lambda header, payload: frames.append((header, payload)))
+  entries = {}
+  for header, payload in frames:
+    if 'error' in header:
+      log('Failed to read remote file: {0}'.format(header['error']))
+      continue
+    if header.get('skipped'):
+      continue
+    file = File(cwd=cwd, path=header['path'])
+    entries[file.path] = cache_file(
+        file, payload, header['size'], header['mtime'])
+  STATE.set_cached(cwd, entries)
+  return entries
+
+def _download_with_ssh(cwd, files, settings):
+  transport = get_transport(settings)
+  if len(files) == 1:
+    file = files[0]
+    try:
+      scp_cmd(transport, transport.scp_args(
+          s_scp(settings),
+          transport.remote(file.remote_path()),
+          file.local_path()))
+      with open(file.local_path(), 'rb') as fp:
+        content = fp.read()
+    except Exception as e:
+      log_exception('Failed to download [{path}]: [{exception}]'.format(
+          path=file.path,
+          exception=e))
+      return set()
+    # The remote mtime is unknown so the first validation hashes the file.
+    STATE.set_cached(cwd, {
+      file.path: [ len(content), None, store_cache_object(content) ],
+    })
+    return set([ file.path ])
+  # Stream all files in a single tar archive.
+  cmd_str = _cd_cmd(cwd, 'tar cf - -- ' + ' '.join(
+      [ shlex.quote(f.path) for f in files ]))
+  proc = subprocess.Popen(transport.ssh_args(cmd_str),
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE)
+  def read_stderr():
+    for line in iter(proc.stderr.readline, b''):
+      log('stderr: ' + line.decode('utf-8', 'replace').rstrip())
+  stderr_thread = threading.Thread(target=read_stderr)
+  stderr_thread.daemon = True
+  stderr_thread.start()
+  entries = {}
+  try:
+    with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+      for info in tar:
+        if not info.isfile():
+          continue
+        if not _is_safe_member_name(info.name):
+          log('Skipping the tar member [{0}] outside of the cache.'.format(
+              info.name))
+          continue
+        file = File(cwd=cwd, path=info.name)
+        entries[file.path] = cache_file(
+            file, tar.extractfile(info).read(), info.size, info.mtime)
+  except (tarfile.TarError, OSError) as e:
+    # ssh writes nothing at all when it cannot reach the remote host. The
+    # files read so far are kept and the rest are reported as failed.
+    log_exception('Failed to read the remote tar archive: [{0}]'.format(e))
+  # Whatever is left unread would block ssh writing it.
+  proc.stdout.close()
+  stderr_thread.join()
+  if proc.wait() == 255:
+    transport.on_failure()
+  STATE.set_cached(cwd, entries)
+  return set(entries.keys())
+
+def _is_safe_member_name(name):
+  ''' Whether the tar member name stays inside the directory it is
+  extracted to. '''
+  if os.path.isabs(name) or name.startswith('/'):
+    return False
+  path = os.path.normpath(name)
+  return path != os.pardir and not path.startswith(os.pardir + os.sep)
+
+def compute_delta(base, content):
+  ''' rsync-style delta of content against base. Returns (ops, literals)
+  where every op is a [base_offset, length] copy from base, or a
+  [-1, length] run of the next bytes of literals. Returns None as soon as
+  more than half of content would have to be sent as literals. '''
+  prefix = _common_prefix_len(base, content)
+  suffix = _common_suffix_len(base, content, prefix)
+  ops = []
+  if prefix > 0:
+    ops.append([ 0, prefix ])
+  literals = _delta_middle(base, content, prefix, len(base) - suffix,
+      prefix, len(content) - suffix, ops, len(content) // 2)
+  if literals == None:
+    return None
+  if suffix > 0:
+    _append_op(ops, len(base) - suffix, suffix)
+  return ops, literals
+
+def _common_prefix_len(a, b):
+  low, high = 0, min(len(a), len(b))
+  while low < high:
+    middle = (low + high + 1) // 2
+    if a[low:middle] == b[low:middle]:
+      low = middle
+    else:
+      high = middle - 1
+  return low
+
+def _common_suffix_len(a, b, prefix):
+  low, high = 0, min(len(a), len(b)) - prefix
+  while low < high:
+    middle = (low + high + 1) // 2
+    if a[len(a) - middle:len(a) - low] == b[len(b) - middle:len(b) - low]:
+      low = middle
+    else:
+      high = middle - 1
+  return low
+
+def _append_op(ops, offset, length):
+  if len(ops) > 0 and ops[-1][0] >= 0 and offset >= 0 and \
+      ops[-1][0] + ops[-1][1] == offset:
+    ops[-1][1] += length
+  elif len(ops) > 0 and ops[-1][0] < 0 and offset < 0:
+    ops[-1][1] += length
+  else:
+    ops.append([ offset, length ])
+
+def _weak_sum(block):
+  block = bytearray(block)
+  # The sum of the prefix sums weighs every byte by its distance to the end.
+  return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+def _delta_middle(base, content, base_start, base_end, start, end, ops,
+    max_literal_bytes):
+  ''' Matches the blocks of base[base_start:base_end] anywhere in
+  content[start:end] with a rolling checksum. Returns the literal bytes or
+  None if there would be more than max_literal_bytes of them. '''
+  if end - start - (base_end - base_start) > max_literal_bytes:
+    return None
+  size = int(math.sqrt(max(base_end - base_start, 1)))
+  size = max(DELTA_MIN_BLOCK_BYTES, min(DELTA_MAX_BLOCK_BYTES, size))
+  literals = []
+  literal_bytes = 0
+  blocks = {}
+  for offset in range(base_start, base_end - size + 1, size):
+    a, b = _weak_sum(base[offset:offset + size])
+    blocks.setdefault(a | (b << 16), []).append(offset)
+  data = bytearray(content)
+  literal_start = start
+  index = start
+  steps = 0
+  if len(blocks) > 0 and index + size <= end:
+    a, b = _weak_sum(data[index:index + size])
+  while len(blocks) > 0 and index + size <= end:
+    match = None
+    offsets = blocks.get(a | (b << 16))
+    if offsets != None:
+      window = content[index:index + size]
+      for offset in offsets:
+        if base[offset:offset + size] == window:
+          match = offset
+          break
+    if match != None:
+      if literal_start < index:
+        literals.append(content[literal_start:index])
+        literal_bytes += index - literal_start
+        _append_op(ops, -1, index - literal_start)
+      _append_op(ops, match, size)
+      index += size
+      # Unchanged runs match the blocks that follow in the base too.
+      match += size
+      while index + size <= end and match + size <= base_end and \
+          base[match:match + size] == content[index:index + size]:
+        _append_op(ops, match, size)
+        index += size
+        match += size
+      literal_start = index
+      if index + size <= end:
+        a, b = _weak_sum(data[index:index + size])
+      continue
+    if index + size == end:
+      break
+    if literal_bytes + index - literal_start > max_literal_bytes:
+      return None
+    steps += 1
+    if steps > DELTA_MAX_SCAN_STEPS:
+      log('Sending the last {0} bytes of the delta without matching them.'
+          .format(end - index))
+      break
+    out_byte = data[index]
+    in_byte = data[index + size]
+    a = (a - out_byte + in_byte) & 0xffff
+    b = (b - size * out_byte + a) & 0xffff
+    index += 1
+  if literal_bytes + end - literal_start > max_literal_bytes:
+    return None
+  if literal_start < end:
+    literals.append(content[literal_start:end])
+    _append_op(ops, -1, end - literal_start)
+  return b''.join(literals)
+
+def refresh_files(files, settings=None):
+  ''' Brings the local copies up to date with one validation round trip per
+  cwd and downloads only the files that changed. Returns the list of files
+  that could not be refreshed. Files with saves still to be uploaded are left
+  alone as the local copy is the newest one. '''
+  stale = []
+  uploading = set([ (f.cwd, f.path) for f in UPLOAD_QUEUE.files() ])
+  files_per_cwd = {}
+  for file in files:
+    if (file.cwd, file.path) in uploading:
+      continue
+    files_per_cwd.setdefault(file.cwd, {})[file.path] = file
+  for cwd, cwd_files in files_per_cwd.items():
+    known = {}
+    for path, file in cwd_files.items():
+      entry = STATE.cached(file)
+      if entry == None:
+        stale.append(file)
+      else:
+        known[path] = entry
+    if len(known) == 0:
+      continue
+    start_secs = time.time()
+    changed, mtimes = with_agent(
+        lambda agent: _validate_with_agent(agent, cwd, known),
+        lambda: _validate_with_ssh(cwd, known, settings),
+        settings)
+    STATE.set_cached(cwd, dict([
+        (path, [ known[path][0], mtime, known[path][2] ])
+        for path, mtime in mtimes.items() ]))
+    for path, entry in known.items():
+      file = cwd_files[path]
+      if path in changed:
+        stale.append(file)
+        continue
+      local_path = file.local_path()
+      if sha1_of_file(local_path) == entry[2]:
+        continue
+      # The remote is unchanged but the local copy is not pristine anymore.
+      object_path = cache_object_path(entry[2])
+      if os.path.isfile(object_path):
+        shutil.copyfile(object_path, local_path)
+      else:
+        stale.append(file)
+    log('Validated {count} files from [{cwd}] in {millis} millis.'.format(
+        count=len(known),
+        cwd=cwd,
+        millis=delta_millis(start_secs)))
+  if len(stale) == 0:
+    return []
+  return download_files(stale, settings)
+
+def _validate_with_agent(agent, cwd, known):
+  result = agent.request('validate', { 'cwd': cwd, 'files': known })
+  return set(result['changed']), result['mtimes']
+
+def _validate_with_ssh(cwd, known, settings):
+  ''' Without the agent there is no cheap stat so the files are hashed. '''
+  class Sha1Listener(CmdListener):
+    def __init__(self):
+      self.sha1s = {}
+
+    def on_stdout(self, line):
+      parts = line.rstrip('\n').split('  ', 1)
+      if len(parts) == 2:
+        self.sha1s[parts[1]] = parts[0]
+
+  listener = Sha1Listener()
+  paths = sorted(known.keys())
+  ssh_cmd(_cd_cmd(cwd,
+      '(command -v sha1sum >/dev/null && sha1sum -- {paths} || '
+      'shasum -- {paths}) 2>/dev/null'.format(
+          paths=' '.join([ shlex.quote(path) for path in paths ]))),
+      listener, settings)
+  changed = set([ path for path in paths
+      if listener.sha1s.get(path) != known[path][2] ])
+  return changed, {}
+
+def upload_file(file, settings=None):
+  log('Uploading the file [{file}]...'.format(file=file.remote_path()))
+  with open(file.local_path(), 'rb') as fp:
+    content = fp.read()
+  def with_scp():
+    transport = get_transport(settings)
+    scp_cmd(transport, transport.scp_args(
+        s_scp(settings),
+        file.local_path(),
+        transport.remote(file.remote_path())))
+    return None, len(content)
+  def with_the_agent(agent):
+    stat, sent = _upload_delta(agent, file, content)
+    if stat == None:
+      stat = agent.request('write',
+          { 'cwd': file.cwd, 'path': file.path }, content)
+    return stat['mtime'], sent
+  mtime, sent = with_agent(with_the_agent, with_scp, settings)
+  STATE.set_cached(file.cwd, {
+    file.path: [ len(content), mtime, store_cache_object(content) ],
+  })
+  log('Done uploading the file [{file}].'.format(file=file.local_path()))
+  return sent
+
+def _upload_delta(agent, file, content):
+  ''' Patches the remote file against the content it was last known to have.
+  Returns (stat, bytes_sent) or (None, len(content)) when a full write is
+  needed because the base is unknown or the remote file changed since. '''
+  entry = STATE.cached(file)
+  if entry == None or len(content) < DELTA_MIN_FILE_BYTES:
+    return None, len(content)
+  object_path = cache_object_path(entry[2])
+  if not os.path.isfile(object_path):
+    return None, len(content)
+  with open(object_path, 'rb') as fp:
+    base = fp.read()
+  delta = compute_delta(base, content)
+  if delta == None:
+    return None, len(content)
+  ops, literals = delta
+  args = {
+    'cwd': file.cwd,
+    'path': file.path,
+    'base_sha1': entry[2],
+    'sha1': hashlib.sha1(content).hexdigest(),
+    'ops': ops,
+  }
+  sent = len(literals) + len(json.dumps(ops))
+  if sent >= len(content):
+    return None, len(content)
+  stat = agent.request('patch', args, literals)
+  if not stat['patched']:
+    log('The remote file [{0}] changed since it was cached.'.format(
+        file.remote_path()))
+    return None, len(content)
+  return stat, sent
+
+def remote_mv(src_file, dst_file, settings=None):
+  assert src_file.cwd == dst_file.cwd
+  with_agent(
+      lambda agent: agent.request('mv', {
+          'cwd': src_file.cwd,
+          'src': src_file.path,
+          'dst': dst_file.path,
+      }),
+      lambda: check_remote_cmd(src_file.cwd,
+          'mkdir -p {dir} && mv -- {src} {dst}'.format(
+              dir=shlex.quote(os.path.dirname(dst_file.path) or '.'),
+              src=shlex.quote(src_file.path),
+              dst=shlex.quote(dst_file.path)),
+          settings),
+      settings)
+
+def remote_rm(file, settings=None):
+  with_agent(
+      lambda agent: agent.request('rm', {
+          'cwd': file.cwd,
+          'paths': [ file.path ],
+      }),
+      lambda: check_remote_cmd(file.cwd, 'rm -f -- {path}'.format(
+          path=shlex.quote(file.path)), settings),
+      settings)
+
+def remote_touch(file, settings=None):
+  ''' Creates the remote file (and its directory) if it does not exist. '''
+  with_agent(
+      lambda agent: agent.request('touch', {
+          'cwd': file.cwd,
+          'path': file.path,
+      }),
+      lambda: check_remote_cmd(file.cwd,
+          'mkdir -p {dir} && touch -- {path}'.format(
+              dir=shlex.quote(os.path.dirname(file.path) or '.'),
+              path=shlex.quote(file.path)),
+          settings),
+      settings)
+
+def remote_cmd(cwd, cmd_str, listener=CmdListener(), settings=None,
+    token=None, gate=None, stdin=None):
+  ''' Runs the shell command cmd_str in the remote directory cwd. Cancelling
+  the token kills the remote command and silences the listener. Pausing the
+  gate stops reading the output of the remote command. The command reads the
+  bytes stdin on its stdin. '''
+  if token != None:
+    listener = CancellableListener(listener, token)
+    if gate != None:
+      token.on_cancel(gate.resume)
+  agent = get_agent(settings)
+  if agent != None:
+    streamed = []
+    stdout = LineDecoder(listener.on_stdout_lines)
+    stderr = LineDecoder(listener.on_stderr_lines)
+    def on_frame(header, payload):
+      streamed.append(True)
+      if header.get('stream') == 'stderr':
+        stderr.feed(payload)
+      else:
+        stdout.feed(payload)
+    try:
+      call = agent.call('exec', { 'cwd': cwd, 'cmd': cmd_str }, stdin or b'',
+          on_frame=on_frame)
+      if token != None:
+        # Writing to the agent may block so it never runs on the thread that
+        # cancels, which can be the main thread.
+        token.on_cancel(lambda: THREAD_POOL.run(
+            lambda: agent.cancel(call), ThreadPool.INTERACTIVE))
+      if gate != None:
+        gate.on_change(lambda paused: agent.pause(call, paused))
+      exit_code = call.wait()['exit_code']
+    except AgentConnectionError:
+      log_exception('Lost the connection to the agent.')
+      if len(streamed) == 0:
+        return ssh_cmd(_cd_cmd(cwd, cmd_str), listener, settings, token, gate,
+            stdin)
+      listener.on_stderr('\nLost the connection to the remote host.\n')
+      exit_code = 255
+    except AgentError as e:
+      # The remote command could not even start, e.g. the cwd is missing.
+      log_exception('The agent failed to run [{0}].'.format(cmd_str))
+      listener.on_stderr('{0}\n'.format(e))
+      exit_code = 1
+    stdout.close()
+    stderr.close()
+    listener.on_exit(exit_code)
+    return exit_code
+  return ssh_cmd(_cd_cmd(cwd, cmd_str), listener, settings, token, gate,
+      stdin)
+
+def check_remote_cmd(cwd, cmd_str, settings=None):
+  exit_code = ssh_cmd(_cd_cmd(cwd, cmd_str), settings=settings)
+  if exit_code != 0:
+    raise Exception(
+        'Remote command [{cmd}] failed with exit code [{code}].'.format(
+            cmd=cmd_str,
+            code=exit_code))
+
+def _cd_cmd(cwd, cmd_str):
+  return 'cd {cwd} && {cmd}'.format(cwd=cwd, cmd=cmd_str)
+
+def scp_cmd(transport, args):
+  exit_code = run_cmd(args)
+  if exit_code != 0:
+    transport.on_failure()
+    raise Exception('Command [{cmd}] failed with exit code [{code}].'.format(
+        cmd=' '.join(args),
+        code=exit_code))
+
+def _killable_cmd(cmd_str):
+  ''' Runs cmd_str in the shell of the user, without its login profile just
+  like any other ssh command, after printing the id of its process group on
+  stderr. The shell gets a session of its own when the remote setsid
+  supports -w, which util-linux only added in 2.24. '''
+  inner = shlex.quote('echo {marker}$$ >&2; {cmd}'.format(
+      marker=REMOTE_PGID_MARKER,
+      cmd=cmd_str))
+  return ('if setsid -w true >/dev/null 2>&1; '
+      'then exec setsid -w "${{SHELL:-sh}}" -c {inner}; '
+      'else exec "${{SHELL:-sh}}" -c {inner}; fi').format(inner=inner)
+
+def ssh_cmd(cmd_str, listener=CmdListener(), settings=None, token=None,
+    gate=None, stdin=None):
+  transport = get_transport(settings)
+  if token != None:
+    # Killing the local ssh leaves the remote command running so its process
+    # group is killed with a second ssh command. Building its args may have
+    # to connect to the remote host so that happens off the cancelling thread
+    # too, which can be the main thread.
+    def kill_remote(pgid):
+      kill_cmd = 'kill -s TERM -- -{pgid} 2>/dev/null || kill -s TERM {pgid}'
+      kill_cmd = kill_cmd.format(pgid=int(pgid))
+      thread = threading.Thread(
+          target=lambda: run_cmd(transport.ssh_args(kill_cmd)))
+      thread.daemon = True
+      thread.start()
+    def on_pgid(pgid):
+      token.on_cancel(lambda: kill_remote(pgid))
+    listener = RemotePgidListener(listener, on_pgid)
+    cmd_str = _killable_cmd(cmd_str)
+  exit_code = run_cmd(transport.ssh_args(cmd_str), listener, token, gate,
+      stdin)
+  # ssh exits with 255 when it could not talk to the remote host.
+  if exit_code == 255:
+    transport.on_failure()
+  return exit_code
+
+def run_cmd(cmd_list, listener=CmdListener(), token=None, gate=None,
+    stdin=None):
+  ''' Runs the local command and streams its output to the listener in
+  batches of lines. Nothing is read while the gate is paused. The command
+  reads the bytes stdin on its stdin. Returns the exit code. '''
   proc = subprocess.Popen(cmd_list,
-      stdin=None,
+      stdin=None if stdin == None else subprocess.PIPE,
       stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
-      bufsize=1)
-  stdout = proc.stdout
-  stderr = proc.stderr
-  def read_fd(read_function, on_text_callback):
-    text = read_function().decode('utf-8')
-    size = 0
-    for line in text.splitlines(keepends=True):
-      on_text_callback(line)
-      size += len(line)
-    return size
-  while True:
-    ret = select.select([ stdout, stderr ], [], [])
-    for fd in ret[0]:
-      read_bytes = 0
-      if fd == stdout:
-        read_bytes += read_fd(stdout.readline, listener.on_stdout)
-      if fd == stderr:
-        read_bytes += read_fd(stderr.readline, listener.on_stderr)
-    if read_bytes == 0 and proc.poll() != None:
-      # fd.readline() does not return the end of the stream because it does
-      # not end with a newline so we use the fd.read() call that guarantees
-      # all available characters are read.
-      read_fd(stdout.read, listener.on_stdout)
-      read_fd(stderr.read, listener.on_stderr)
-      listener.on_exit(proc.returncode)
-      return
+      stderr=subprocess.PIPE)
+  if stdin != None:
+    def feed():
+      try:
+        proc.stdin.write(stdin)
+        proc.stdin.close()
+      except (IOError, OSError):
+        # The command exited without reading all of it.
+        pass
+    thread = threading.Thread(target=feed)
+    thread.daemon = True
+    thread.start()
+  if token != None:
+    token.on_cancel(proc.terminate)
+  decoders = {
+    proc.stdout.fileno(): LineDecoder(listener.on_stdout_lines),
+    proc.stderr.fileno(): LineDecoder(listener.on_stderr_lines),
+  }
+  chunks = dict([ (fd, []) for fd in decoders ])
+  def flush(fd):
+    if len(chunks[fd]) > 0:
+      decoders[fd].feed(b''.join(chunks[fd]))
+      chunks[fd] = []
+  open_fds = list(decoders.keys())
+  buffered_bytes = 0
+  batch_start_secs = None
+  while len(open_fds) > 0:
+    if gate != None:
+      gate.wait()
+    # Keep reading while more output is ready so that fast commands hand
+    # the listener a few large batches instead of many small ones.
+    timeout = 0 if buffered_bytes > 0 else None
+    ready = select.select(open_fds, [], [], timeout)[0]
+    if len(ready) == 0 or buffered_bytes >= RUN_CMD_BATCH_BYTES or \
+        (batch_start_secs != None and
+            time.time() - batch_start_secs >= RUN_CMD_BATCH_SECS):
+      for fd in open_fds:
+        flush(fd)
+      buffered_bytes = 0
+      batch_start_secs = None
+    for fd in ready:
+      chunk = os.read(fd, RUN_CMD_CHUNK_BYTES)
+      if len(chunk) > 0:
+        chunks[fd].append(chunk)
+        buffered_bytes += len(chunk)
+        if batch_start_secs == None:
+          batch_start_secs = time.time()
+      else:
+        flush(fd)
+        decoders[fd].close()
+        open_fds.remove(fd)
+  proc.stdout.close()
+  proc.stderr.close()
+  exit_code = proc.wait()
+  listener.on_exit(exit_code)
+  return exit_code
+
+def grep_engine(cwd, settings=None):
+  ''' Returns the GrepEngine for the remote cwd. With the 'auto' engine the
+  remote is probed once for the fastest tool available, unless the user
+  changed 'remote_cpp_grep_cmd' which is then used as is. '''
+  name = s_grep_engine(settings)
+  if name == 'auto' and s_grep_cmd(settings) != DEFAULT_GREP_CMD:
+    name = 'custom'
+  if name == 'custom':
+    # The pattern gets shell quoted so any quotes around it are dropped.
+    return GrepEngine('custom',
+        re.sub(r'([\'"])\{pattern\}\1', '{pattern}', s_grep_cmd(settings)),
+        None,
+        r'^([^:]+):(\d+):(.*)$',
+        has_column=False)
+  if name in GREP_ENGINES:
+    return GREP_ENGINES[name]
+  key = (s_ssh_hostname(settings), cwd)
+  with GREP_ENGINES_LOCK:
+    engine = DETECTED_GREP_ENGINES.get(key)
+  if engine != None:
+    return engine
+  class ProbeListener(CmdListener):
+    def __init__(self):
+      self.tools = set()
+
+    def on_stdout(self, line):
+      self.tools.add(line.strip())
+
+  listener = ProbeListener()
+  remote_cmd(cwd, GREP_PROBE_CMD, listener, settings)
+  engine = GREP_ENGINES['grep']
+  for name in ('rg', 'git'):
+    if name in listener.tools:
+      engine = GREP_ENGINES[name]
+      break
+  log('Grepping [{cwd}] with [{engine}].'.format(cwd=cwd, engine=engine.name))
+  with GREP_ENGINES_LOCK:
+    DETECTED_GREP_ENGINES[key] = engine
+  return engine
+
+def required_literals(pattern):
+  ''' Returns literal strings of at least 3 characters that every match of
+  the regex pattern contains. Conservative: may return fewer than exist. '''
+  if '|' in pattern:
+    return []
+  literals = []
+  run = []
+  # Index into literals where each open group started.
+  groups = []
+  def end_run():
+    if len(run) >= 3:
+      literals.append(''.join(run))
+    del run[:]
+  index = 0
+  while index < len(pattern):
+    char = pattern[index]
+    if char == '\\' and index + 1 < len(pattern):
+      escaped = pattern[index + 1]
+      index += 2
+      if escaped.isalnum():
+        # Escapes like \x41 or \N{name} stand for a character so their
+        # arguments are not literal text either.
+        index = _escape_argument_end(pattern, escaped, index)
+        end_run()
+      else:
+        run.append(escaped)
+      continue
+    index += 1
+    if char in '?*{':
+      # The previous character is optional.
+      if len(run) > 0:
+        run.pop()
+      end_run()
+      if char == '{':
+        close = pattern.find('}', index)
+        index = len(pattern) if close < 0 else close + 1
+    elif char == '(':
+      if pattern[index:index + 1] == '?':
+        if pattern[index + 1:index + 2] != ':':
+          # Named groups, lookarounds and flags are not worth parsing.
+          return []
+        index += 2
+      end_run()
+      groups.append(len(literals))
+    elif char == ')':
+      end_run()
+      if len(groups) == 0:
+        return []
+      start = groups.pop()
+      if pattern[index:index + 1] in ('?', '*', '{'):
+        # The whole group is optional so none of its literals are required.
+        del literals[start:]
+    elif char in '.^$+[]':
+      if char == '+':
+        # The previous character is required but may repeat.
+        end_run()
+      elif char == '[':
+        end_run()
+        close = pattern.find(']', index + 1)
+        index = len(pattern) if close < 0 else close + 1
+      else:
+        end_run()
+    else:
+      run.append(char)
+  end_run()
+  return literals
+
+def _escape_argument_end(pattern, escaped, index):
+  ''' Index just past the argument of the escape \\<escaped> whose argument
+  starts at index. '''
+  def skip_braced(open_char, close_char):
+    if pattern[index:index + 1] != open_char:
+      return None
+    close = pattern.find(close_char, index)
+    return len(pattern) if close < 0 else close + 1
+  def skip_chars(chars, max_count):
+    end = index
+    while end < len(pattern) and end - index < max_count and \
+        pattern[end] in chars:
+      end += 1
+    return end
+  if escaped == 'x':
+    end = skip_braced('{', '}')
+    return end if end != None else skip_chars(string.hexdigits, 2)
+  if escaped in 'uU':
+    return skip_chars(string.hexdigits, 4 if escaped == 'u' else 8)
+  if escaped in 'NpP':
+    end = skip_braced('{', '}')
+    return end if end != None else min(index + 1, len(pattern))
+  if escaped == 'k':
+    for open_char, close_char in ('<>', '{}'):
+      end = skip_braced(open_char, close_char)
+      if end != None:
+        return end
+    return index
+  if escaped == 'c':
+    return min(index + 1, len(pattern))
+  if escaped == '0':
+    return skip_chars('01234567', 2)
+  if escaped.isdigit():
+    # Back references like \12 and octal escapes like \101.
+    return skip_chars(string.digits, 2)
+  return index
+
+def local_grep_index(cwd):
+  with LOCAL_GREP_INDEXES_LOCK:
+    index = LOCAL_GREP_INDEXES.get(cwd)
+    if index == None:
+      index = LOCAL_GREP_INDEXES[cwd] = LocalGrepIndex(cwd)
+  return index
+
+def remote_file_list_path(cwd, settings=None):
+  ''' Path of the snapshot of the file list kept by the agent on the remote
+  or None if the file list did not come from the agent. '''
+  if STATE.list_token(cwd) == None:
+    return None
+  return '"$HOME/.cache/RemoteCpp/{0}"'.format(
+      md5(u'{0}\x00{1}'.format(cwd, s_find_cmd(settings))))
+
+def parse_build_diagnostic(text, output_line, build_cwd, cwd):
+  ''' The BuildDiagnostic printed in the line of the output of a build that
+  ran in build_cwd or None. '''
+  match = COMPILER_DIAGNOSTIC_REGEX.match(text)
+  if match != None:
+    path, line, col, severity, message = match.groups()
+    if severity == 'fatal error':
+      severity = 'error'
+  else:
+    match = GTEST_FAILURE_REGEX.match(text)
+    if match != None:
+      path, line = match.groups()
+      col, severity, message = None, 'failure', ''
+    else:
+      match = LOCATION_REGEX.match(text)
+      if match == None:
+        return None
+      path, line, col, message = match.groups()
+      severity = 'info'
+  return BuildDiagnostic(
+      output_line=output_line,
+      path=build_path_in_cwd(path.strip(), build_cwd, cwd),
+      line=int(line),
+      col=int(col or 0),
+      severity=severity,
+      message=message.strip())
+
+def build_path_in_cwd(path, build_cwd, cwd):
+  ''' The path relative to the cwd of a path printed by a build that ran in
+  build_cwd, or its absolute path if it is not under the cwd. '''
+  path = os.path.normpath(os.path.join(build_cwd, path))
+  cwd = os.path.normpath(cwd)
+  if not path.startswith(cwd + '/'):
+    return path
+  return path[len(cwd) + 1:]
+
+def open_build_diagnostic(view, cwd, diagnostic):
+  if os.path.isabs(diagnostic.path):
+    set_status('The file [{0}] is not under the cwd.'.format(diagnostic.path))
+    return
+  set_status('{severity}: {message}'.format(
+      severity=diagnostic.severity,
+      message=diagnostic.message))
+  file = File(cwd=cwd, path=diagnostic.path, row=diagnostic.line,
+      col=diagnostic.col)
+  Commands.open_file(view, file.to_args())
+
+def start_view_job(view):
+  ''' Returns the CancellationToken of a new job writing into the view and
+  cancels the job that was writing into it before. '''
+  token = CancellationToken()
+  with VIEW_JOBS_LOCK:
+    previous = VIEW_JOBS.get(view.id())
+    VIEW_JOBS[view.id()] = token
+  if previous != None:
+    previous.cancel()
+  return token
+
+def cancel_view_job(view):
+  with VIEW_JOBS_LOCK:
+    token = VIEW_JOBS.pop(view.id(), None)
+  if token != None:
+    token.cancel()
 
 def time_str():
   return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -585,13 +4532,13 @@ def md5(msg):
 def show_file_input(view, title, on_done):
   file = STATE.file(view.file_name())
   if file == None:
-    path = s_cwd()
+    path = s_cwd(view)
     path = path + os.sep
   else:
     path = file.remote_path()
   def on_done_callback(new_file):
     log('The user has chosen: ' + new_file)
-    cwd = s_cwd()
+    cwd = s_cwd(view)
     if not new_file.startswith(cwd):
       sublime.error_message('File must be under CWD:\n\n' + cwd)
       return
@@ -615,13 +4562,21 @@ def delta_millis(start_secs):
 ##############################################################
 
 def plugin_loaded():
-  global THREAD_POOL, STATE
-  THREAD_POOL = ThreadPool(1)
+  global THREAD_POOL, STATE, FILE_LIST_SCHEDULER, UPLOAD_QUEUE, PREFETCHER
+  THREAD_POOL = ThreadPool(s_thread_pool_threads())
+  UPLOAD_QUEUE = UploadQueue()
+  PREFETCHER = Prefetcher()
+  CWD_REGISTRY.refresh()
+  watch_settings(PREFERENCES_FILE, sublime.load_settings(PREFERENCES_FILE))
   try:
     STATE.load()
   except:
     log_exception('Critical problem loading the plugin STATE file.')
-  sublime.set_timeout_async(STATE.gc, 5000)
+  sublime.set_timeout(lambda: gc_in_background(settings_snapshot()), 5000)
+  sublime.set_timeout(schedule_cache_eviction, CACHE_EVICTION_SECS * 1000)
+  sublime.set_timeout_async(gc_output_files, 5500)
+  sublime.set_timeout(build_indexes_in_background, 6000)
+  FILE_LIST_SCHEDULER = FileListScheduler().start()
   if not STATE.readme():
     sublime.active_window().run_command(RemoteCppOpenReadmeCommand.NAME)
     STATE.set_readme()
@@ -631,11 +4586,18 @@ def plugin_loaded():
 
 def plugin_unloaded():
   global THREAD_POOL, STATE
+  FILE_LIST_SCHEDULER.close()
   try:
     STATE.save()
   except:
     log_exception("Critical failure saving RemoteCpp plugin STATE.")
   THREAD_POOL.close()
+  close_transports()
+  sublime.load_settings(PREFERENCES_FILE).clear_on_change(
+      SETTINGS_ON_CHANGE_KEY)
+  for window in sublime.windows():
+    for view in window.views():
+      view.settings().clear_on_change(SETTINGS_ON_CHANGE_KEY)
 
 
 class PluginStateEventListener(sublime_plugin.EventListener):
@@ -661,20 +4623,38 @@ class SaveFileEventListener(sublime_plugin.EventListener):
     file = STATE.file(view.file_name())
     if file:
       log('Saving file: ' + str(file.local_path()))
-      runnable = lambda : self._run_in_the_background(file)
-      THREAD_POOL.run(runnable)
+      UPLOAD_QUEUE.push(file, settings_snapshot(view))
+
+
+class CwdRegistryEventListener(sublime_plugin.EventListener):
+  def on_new(self, view):
+    CWD_REGISTRY.set_view(view)
+
+  def on_load(self, view):
+    CWD_REGISTRY.refresh_if_stale()
+    CWD_REGISTRY.set_view(view)
+
+  def on_activated(self, view):
+    # Picks up cwd changes in the project settings.
+    CWD_REGISTRY.refresh_if_stale()
+    CWD_REGISTRY.set_view(view)
+
+  def on_close(self, view):
+    CWD_REGISTRY.remove_view(view.id())
+
+
+class SettingsSnapshotEventListener(sublime_plugin.EventListener):
+  def on_close(self, view):
+    with SETTINGS_SNAPSHOTS_LOCK:
+      if not view.id() in SETTINGS_WATCHED:
+        return
+      del SETTINGS_WATCHED[view.id()]
+    view.settings().clear_on_change(SETTINGS_ON_CHANGE_KEY)
+
 
-  def _run_in_the_background(self, file):
-    log('Saving file [{0}]...'.format(file.remote_path()))
-    run_cmd((
-        s_scp(),
-        '-P', str(s_ssh_port()),
-        '{path}'.format(path=file.local_path()),
-        '{hostname}:{path}'.format(
-            path=file.remote_path(),
-            hostname=s_ssh_hostname()),
-    ))
-    log('Successsfully saved file [{0}].'.format(file.local_path()))
+class CancelJobsEventListener(sublime_plugin.EventListener):
+  def on_close(self, view):
+    cancel_view_job(view)
 
 
 class ListFilesEventListener(sublime_plugin.EventListener):
@@ -687,17 +4667,26 @@ class ListFilesEventListener(sublime_plugin.EventListener):
       for line in all_lines:
         if self._is_valid_path(line):
           paths.append(line)
+      settings = settings_snapshot(view)
       def run_in_background():
-        for path in paths:
-          file = File(cwd=s_cwd(), path=path)
-          Commands.open_file(view, file.to_args())
+        files = [ File(cwd=s_cwd(settings), path=path) for path in paths ]
+        missing = [ f for f in files if not os.path.isfile(f.local_path()) ]
+        failed = set([ f.path for f in download_files(missing, settings) ])
+        if len(failed) > 0:
+          set_status('Failed to download {0} files.'.format(len(failed)))
+        downloaded = [ f for f in files if not f.path in failed ]
+        # Views are only ever opened on the main thread.
+        def open_files():
+          for file in downloaded:
+            Commands.open_file(view, file.to_args())
+        sublime.set_timeout(open_files, 0)
       if len(paths) > 10:
-        msg = ('This will open {0} files which could be slow. \n'
+        msg = ('This will open {0} files in new tabs. \n'
                'Are you sure you want to do that?').format(len(paths),)
         button_text = 'Open {0} Files'.format(len(paths))
         if not sublime.ok_cancel_dialog(msg, button_text):
           return None
-      THREAD_POOL.run(run_in_background)
+      THREAD_POOL.run(run_in_background, ThreadPool.INTERACTIVE)
     return None
 
   def _is_valid_path(self, line):
@@ -714,14 +4703,29 @@ class GotoBuildErrorEventListener(sublime_plugin.EventListener):
       Commands.goto_build_error(view)
     return None
 
+  def on_load(self, view):
+    for listener in list(BUILD_DIAGNOSTICS.values()):
+      listener.mark(view)
+
+  def on_close(self, view):
+    BUILD_DIAGNOSTICS.pop(view.id(), None)
+
 
 class GotoGrepMatchEventListener(sublime_plugin.EventListener):
   def on_text_command(self, view, command_name, args):
-    if RemoteCppGotoGrepMatchCommand.is_valid(view) and \
-        command_name == 'insert' and args['characters'] == '\n':
+    if command_name != 'insert' or args['characters'] != '\n':
+      return None
+    if RemoteCppGotoGrepMatchCommand.is_valid(view):
       Commands.goto_grep_match(view)
+    elif RemoteCppGrepLoadMoreCommand.is_valid(view) and \
+        (get_sel_line(view) or '').startswith(GrepListener.MORE_MARKER):
+      view.run_command(RemoteCppGrepLoadMoreCommand.NAME)
     return None
 
+  def on_close(self, view):
+    GREP_MATCHES.pop(view.id(), None)
+    GREP_LISTENERS.pop(view.id(), None)
+
 
 ##############################################################
 # Sublime Commands
@@ -732,11 +4736,13 @@ class Commands(object):
     raise Exception('Not to be instantiated.')
 
   @staticmethod
-  def append_text(view, text, clean_first=False):
-    ''' Appends the text and moves scroll to the bottom '''
+  def append_text(view, text, clean_first=False, tail=False):
+    ''' Appends the text and moves scroll to the bottom. With tail=True the
+    text replaces whatever the previous tail=True call appended. '''
     view.run_command(RemoteCppAppendTextCommand.NAME, {
         'text': text,
         'clean_first': clean_first,
+        'tail': tail,
     })
 
   @staticmethod
@@ -757,6 +4763,33 @@ class Commands(object):
     view.run_command(RemoteCppGotoGrepMatchCommand.NAME)
 
 
+class RemoteCppCancelAllJobsCommand(sublime_plugin.ApplicationCommand):
+  NAME = 'remote_cpp_cancel_all_jobs'
+
+  def run(self):
+    count = THREAD_POOL.cancel_all()
+    set_status('Cancelled {0} jobs.'.format(count))
+
+
+class RemoteCppOpenFullOutputCommand(sublime_plugin.TextCommand):
+  NAME = 'remote_cpp_open_full_output'
+
+  def is_enabled(self):
+    return self._path() != None
+
+  def is_visible(self):
+    return self._path() != None
+
+  def run(self, edit):
+    self.view.window().open_file(self._path())
+
+  def _path(self):
+    path = self.view.settings().get(AppendToViewListener.OUTPUT_PATH_SETTING)
+    if path == None or not os.path.isfile(path):
+      return None
+    return path
+
+
 class RemoteCppClearLocalCacheCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_clear_local_cache'
 
@@ -765,9 +4798,10 @@ class RemoteCppClearLocalCacheCommand(sublime_plugin.TextCommand):
       for view in window.views():
         if None != STATE.file(view.file_name()):
           view.close()
+    cwds = all_cwds()
     def run_in_background():
       try:
-        clear_local_caches()
+        clear_local_caches(cwds)
       except:
         set_status("Failed to clear the local cache. :(")
       else:
@@ -777,40 +4811,53 @@ class RemoteCppClearLocalCacheCommand(sublime_plugin.TextCommand):
 
 class RemoteCppQuickOpenFileCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_quick_open_file'
+  REFRESH_ITEM = '<<< Refresh Remote File List... >>>'
 
   def run(self, edit):
-    file_list = [ '<<< Refresh Remote File List... >>>' ]
-    file_list.extend(STATE.list(s_cwd()))
+    window = self.view.window()
+    settings = settings_snapshot(self.view)
+    window.show_input_panel(
+        caption='Quick Open Remote File (empty for recent files)',
+        initial_text='',
+        on_done=lambda query: self._show_matches(window, settings, query),
+        on_change=None,
+        on_cancel=None)
+
+  def _show_matches(self, window, settings, query):
+    start_secs = time.time()
+    cwd = s_cwd(settings)
+    matches = []
+    index = STATE.index(cwd)
+    if index != None:
+      matches = index.search(
+          query, s_quick_open_max_results(settings), STATE.usage(cwd))
+    self.log('Found {count} matches for [{query}] in {millis} millis.'.format(
+        count=len(matches),
+        query=query,
+        millis=delta_millis(start_secs)))
+    items = [ self.REFRESH_ITEM ] + matches
     view = self.view
-    window = view.window()
     def on_select(index):
       if index == 0:
         self.log("Refreshing file list...")
         def in_background():
           start_secs = time.time()
-          RemoteCppListFilesCommand.get_file_list(window)
+          RemoteCppListFilesCommand.get_file_list(settings)
           msg = 'File list successfully refreshed in {millis} millis.'.format(
               millis=delta_millis(start_secs))
           set_status(msg)
-        THREAD_POOL.run(in_background)
+        THREAD_POOL.run(in_background, ThreadPool.BULK)
       elif index > 0:
-        self.log('Loading file {0}...'.format(file_list[index]))
-        file = File(cwd=s_cwd(), path=file_list[index])
+        self.log('Loading file {0}...'.format(items[index]))
+        file = File(cwd=cwd, path=items[index])
         Commands.open_file(view, file.to_args())
       else:
         self.log('Nothing selected.')
-    selected_index = 0
-    file = STATE.file(view.file_name())
-    if file != None:
-      for i in range(len(file_list)):
-        if file_list[i] == file.path:
-          selected_index = i
-          break
     window.show_quick_panel(
-        items=file_list,
+        items=items,
         on_select=on_select,
         on_highlight=None,
-        selected_index=selected_index)
+        selected_index=min(1, len(matches)))
 
   def log(self, msg):
     log(msg, type=type(self).__name__)
@@ -821,13 +4868,26 @@ class RemoteCppRefreshAllViewsCommand(sublime_plugin.ApplicationCommand):
 
   def run(self):
     start_secs = time.time()
+    # vector<(vector<File>, SettingsSnapshot)> with the files of every window.
+    files_per_window = []
+    for window in sublime.windows():
+      files = []
+      for view in window.views():
+        file = STATE.file(view.file_name())
+        if file != None:
+          files.append(file)
+        elif RemoteCppRefreshViewCommand.is_view_refreshable(view):
+          view.run_command(RemoteCppRefreshViewCommand.NAME)
+      if len(files) > 0:
+        settings = settings_snapshot(window.active_view())
+        files_per_window.append((files, settings))
     def run_in_background():
-      clear_local_caches()
-      for window in sublime.windows():
-        for view in window.views():
-          if RemoteCppRefreshViewCommand.is_view_refreshable(view) and \
-              None == STATE.file(view.file_name()):
-            view.run_command(RemoteCppRefreshViewCommand.NAME)
+      failed = []
+      for files, settings in files_per_window:
+        failed.extend(refresh_files(files, settings))
+      if len(failed) > 0:
+        set_status('Failed to refresh {0} files. :('.format(len(failed)))
+        return
       msg = 'Successfully refreshed all views in {0} millis.'.format(
           delta_millis(start_secs))
       set_status(msg)
@@ -844,7 +4904,7 @@ class RemoteCppRefreshViewCommand(sublime_plugin.TextCommand):
     start_secs = time.time()
     file = STATE.file(self.view.file_name())
     if file != None:
-      self._refresh_file(file)
+      self._refresh_file(file, settings_snapshot(self.view))
     elif RemoteCppListFilesCommand.owns_view(self.view):
       self._refresh_file_list()
 
@@ -853,13 +4913,13 @@ class RemoteCppRefreshViewCommand(sublime_plugin.TextCommand):
     return None != STATE.file(view.file_name()) or \
         RemoteCppListFilesCommand.owns_view(view)
 
-  def _refresh_file(self, file):
+  def _refresh_file(self, file, settings):
     def run_in_the_background():
       self.log('Refresh remote file!!')
-      if os.path.isfile(file.local_path()):
-        os.remove(file.local_path())
-      download_file(file)
-    THREAD_POOL.run(run_in_the_background)
+      if len(refresh_files([ file ], settings)) > 0:
+        set_status('Failed to refresh the file [{0}]. :('.format(
+            file.remote_path()))
+    THREAD_POOL.run(run_in_the_background, ThreadPool.INTERACTIVE)
 
   def _refresh_file_list(self):
     self.log('Refresh ListView!!!')
@@ -904,25 +4964,49 @@ class RemoteCppDeleteFileCommand(sublime_plugin.TextCommand):
     title = 'Delete file:\n\n{0}'.format(file.remote_path())
     if sublime.ok_cancel_dialog(title, 'Delete'):
       log("Deleting the file...")
-      cmd_str = 'rm -f {remote_path}'.format(remote_path=file.remote_path())
-      ssh_cmd(cmd_str)
-      self.view.close()
-      STATE.update_list(cwd=s_cwd(view), files_to_rm=[file])
+      settings = settings_snapshot(view)
+      runnable = lambda: self._run_in_the_background(view, settings, file)
+      THREAD_POOL.run(runnable, ThreadPool.INTERACTIVE)
+
+  def _run_in_the_background(self, view, settings, file):
+    try:
+      remote_rm(file, settings)
+    except:
+      log_exception('Failed to rm remote file.')
+      sublime.error_message('Failed to delete the remote file.\n\n{0}'.format(
+          file.remote_path()))
+      return
+    sublime.set_timeout(view.close, 0)
+    STATE.update_list(cwd=s_cwd(settings), files_to_rm=[file])
 
 class RemoteCppGcCommand(sublime_plugin.TextCommand):
   def run(self, edit):
-    STATE.gc()
+    gc_in_background(settings_snapshot(self.view))
 
 
 class RemoteCppGotoGrepMatchCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_goto_grep_match'
+  # Only for Grep views restored by Sublime without their GrepMatch records.
   REGEX = re.compile('^([^:]+):(\d+):.+$')
 
   @staticmethod
   def is_valid(view):
     if not view.name().startswith(RemoteCppGrepCommand.VIEW_PREFIX):
       return False
-    return None != RemoteCppGotoGrepMatchCommand.REGEX.match(get_sel_line(view))
+    return None != RemoteCppGotoGrepMatchCommand.match_at_sel(view)
+
+  @staticmethod
+  def match_at_sel(view):
+    line = get_sel_line(view)
+    if line == None:
+      return None
+    matches = GREP_MATCHES.get(view.id())
+    if matches != None:
+      return matches.get(line)
+    match = RemoteCppGotoGrepMatchCommand.REGEX.match(line)
+    if match == None:
+      return None
+    return GrepMatch(match.group(1), int(match.group(2)), 1, (0, 0), '')
 
   def is_enabled(self):
     return RemoteCppGotoGrepMatchCommand.is_valid(self.view)
@@ -931,18 +5015,16 @@ class RemoteCppGotoGrepMatchCommand(sublime_plugin.TextCommand):
     return self.is_enabled()
 
   def run(self, edit):
-    line = get_sel_line(self.view)
-    match = self.REGEX.match(line)
-    path = match.group(1)
-    row = int(match.group(2))
-    col = 0
-    file = File(cwd=s_cwd(), path=path, row=row, col=col)
+    match = self.match_at_sel(self.view)
+    file = File(cwd=s_cwd(self.view), path=match.path, row=match.line,
+        col=match.col)
     Commands.open_file(self.view, file.to_args())
 
 
 class RemoteCppGrepCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_grep'
   VIEW_PREFIX = 'Grep'
+  CAPTION = 'Remote Grep'
 
   def run(self, edit):
     log('Grepping file...')
@@ -954,7 +5036,7 @@ class RemoteCppGrepCommand(sublime_plugin.TextCommand):
       if len(lines) == 1:
         text = view.substr(view.sel()[0])
     view.window().show_input_panel(
-        caption='Remote Grep',
+        caption=self.CAPTION,
         initial_text=text,
         on_done=lambda t: self._on_done(window, t),
         on_change=None,
@@ -972,22 +5054,104 @@ class RemoteCppGrepCommand(sublime_plugin.TextCommand):
     view.set_read_only(True)
     view.set_scratch(True)
     view.settings().set("word_wrap", "false")
+    settings = settings_snapshot(view)
     Commands.append_text(
         view,
         '# Grepping for [{text}] in [{cwd}]...\n\n'.format(
-            cwd=s_cwd(),
+            cwd=s_cwd(settings),
             text=text,))
-    runnable = lambda: self._run_in_the_background(view, text)
-    THREAD_POOL.run(runnable)
-
-  def _run_in_the_background(self, view, text):
-    arg_template = "cd {cwd} && " + s_grep_cmd()
-    arg_str = arg_template.format(
-        cwd=s_cwd(),
-        pattern=text,)
+    # Closing the view kills the grep.
+    token = start_view_job(view)
+    runnable = lambda: self._run_in_the_background(view, settings, text, token)
+    THREAD_POOL.run(runnable, ThreadPool.BULK, token)
+
+  def _run_in_the_background(self, view, settings, text, token):
+    cwd = s_cwd(settings)
+    engine = grep_engine(cwd, settings)
+    arg_str = engine.cmd(text, remote_file_list_path(cwd, settings),
+        s_grep_max_matches_per_file(settings))
     log('Running cmd [{cmd}]...'.format(cmd=arg_str))
-    listener = AppendToViewListener(view)
-    ssh_cmd(arg_str, listener)
+    listener, gate = self._create_listener(view, settings, engine, text)
+    remote_cmd(cwd, arg_str, listener, settings, token, gate)
+
+  @staticmethod
+  def _create_listener(view, settings, engine, text, skip_paths=()):
+    matches = {}
+    GREP_MATCHES[view.id()] = matches
+    gate = OutputGate()
+    # A paused grep waits on the user so it must not hold up other tasks.
+    gate.on_change(THREAD_POOL.on_task_blocked)
+    listener = GrepListener(view, settings, engine, text, matches, skip_paths,
+        gate)
+    GREP_LISTENERS[view.id()] = listener
+    return listener, gate
+
+
+class RemoteCppGrepLocalIndexCommand(RemoteCppGrepCommand):
+  ''' Greps the local copies of remote files through a LocalGrepIndex first
+  and then the remote for the files that are not cached locally. The remote
+  grep only reads those other files unless the engine cannot be restricted
+  to a list of files. '''
+  NAME = 'remote_cpp_grep_local_index'
+  CAPTION = 'Grep Local Index'
+
+  def _run_in_the_background(self, view, settings, text, token):
+    cwd = s_cwd(settings)
+    index = local_grep_index(cwd)
+    start_secs = time.time()
+    index.update()
+    local_paths = index.paths()
+    engine = grep_engine(cwd, settings)
+    listener, gate = self._create_listener(view, settings, engine, text,
+        local_paths)
+    try:
+      local_matches = index.search(text, token)
+    except re.error as e:
+      listener.on_stderr_lines([ 'Invalid pattern: {0}\n'.format(e) ])
+      listener.on_exit(2)
+      return
+    listener.on_matches(local_matches)
+    listener.on_stderr_lines([
+        '# Searched {count} local files in {millis} millis. '
+        'Searching the other remote files...\n'.format(
+            count=len(local_paths),
+            millis=delta_millis(start_secs)) ])
+    max_count = s_grep_max_matches_per_file(settings)
+    file_list_path = remote_file_list_path(cwd, settings)
+    file_list = STATE.list(cwd)
+    stdin = None
+    if not engine.can_restrict():
+      arg_str = engine.cmd(text, file_list_path, max_count)
+    elif file_list_path != None:
+      # Only the cached paths travel as the remote has the file list.
+      arg_str, stdin = engine.skip_paths_cmd(text, file_list_path,
+          sorted(local_paths), max_count)
+    elif file_list != None:
+      arg_str, stdin = engine.paths_cmd(text,
+          [ p for p in file_list if not p in local_paths ], max_count)
+    else:
+      arg_str = engine.cmd(text, None, max_count)
+    remote_cmd(cwd, arg_str, listener, settings, token, gate, stdin)
+
+
+class RemoteCppGrepLoadMoreCommand(sublime_plugin.TextCommand):
+  ''' Shows the next page of matches of a paused grep and resumes it. '''
+  NAME = 'remote_cpp_grep_load_more'
+
+  @staticmethod
+  def is_valid(view):
+    listener = GREP_LISTENERS.get(view.id())
+    return listener != None and listener.is_paused()
+
+  def is_enabled(self):
+    return RemoteCppGrepLoadMoreCommand.is_valid(self.view)
+
+  def is_visible(self):
+    return self.is_enabled()
+
+  def run(self, edit):
+    listener = GREP_LISTENERS.get(self.view.id())
+    sublime.set_timeout_async(listener.load_more, 0)
 
 
 class RemoteCppMoveFileCommand(sublime_plugin.TextCommand):
@@ -1007,14 +5171,14 @@ class RemoteCppMoveFileCommand(sublime_plugin.TextCommand):
     show_file_input(self.view, 'Move Remote File', callback)
 
   def _on_move(self, view, src_file, dst_file):
-    runnable = lambda: self._run_in_the_background(view, src_file, dst_file)
+    settings = settings_snapshot(view)
+    runnable = lambda: self._run_in_the_background(view, settings, src_file,
+        dst_file)
     THREAD_POOL.run(runnable)
 
-  def _run_in_the_background(self, view, src_file, dst_file):
+  def _run_in_the_background(self, view, settings, src_file, dst_file):
     try:
-      ssh_cmd('mv "{src}" "{dst}"'.format(
-          src=src_file.remote_path(),
-          dst=dst_file.remote_path()))
+      remote_mv(src_file, dst_file, settings)
     except:
       log_exception('Failed to mv remote files.')
       sublime.error_message(
@@ -1024,10 +5188,11 @@ class RemoteCppMoveFileCommand(sublime_plugin.TextCommand):
       return
     self._rm_local_file(src_file.local_path())
     self._rm_local_file(dst_file.local_path())
-    Commands.open_file(self.view, dst_file.to_args())
-    log(dir(self.view))
-    view.close()
-    STATE.update_list(cwd=s_cwd(view),
+    def open_dst_file():
+      Commands.open_file(view, dst_file.to_args())
+      view.close()
+    sublime.set_timeout(open_dst_file, 0)
+    STATE.update_list(cwd=s_cwd(settings),
                       files_to_add=[dst_file],
                       files_to_rm=[src_file])
 
@@ -1040,59 +5205,83 @@ class RemoteCppMoveFileCommand(sublime_plugin.TextCommand):
 
 class RemoteCppGotoBuildErrorCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_goto_build_error'
-  REGEX = re.compile('^([^:]+):(\d+)(:\d+)?:.+$')
 
   def run(self, edit):
-    self.log('Going to build error from line...')
     view = self.view
     row = view.rowcol(view.sel()[0].a)[0]
+    listener = BUILD_DIAGNOSTICS.get(view.id())
+    if listener != None:
+      cwd = listener.cwd()
+      diagnostic = listener.at_row(row)
+    else:
+      # Build views restored by Sublime only have their text.
+      cwd = s_cwd(view)
+      diagnostic = self._parse_at_or_above(view, row, cwd)
+    if diagnostic == None:
+      self.log('No build error at or above row [{0}].'.format(row))
+      return
+    self.log('Build error in file [{path}] row=[{row}] col=[{col}].'.format(
+        path=diagnostic.path,
+        row=diagnostic.line,
+        col=diagnostic.col))
+    open_build_diagnostic(view, cwd, diagnostic)
+
+  @staticmethod
+  def _parse_at_or_above(view, row, cwd):
+    ''' The diagnostic in the row or in the closest row above it. '''
     while row >= 0:
-      self.log('Current row is [{0}].'.format(row))
-      line = view.line(view.text_point(row, 0))
-      text = view.substr(line)
-      match = self.REGEX.match(text)
-      if match:
-        self.log('Found build error in line [{0}] => [{1}]'.format(row, text))
-        path = match.group(1)
-        row = int(match.group(2))
-        if match.group(3) == None:
-          col = 0
-        else:
-          col = int(match.group(3)[1:])
-        self.log('Build error in file [{path}] row=[{row}] col=[{col}].'.format(
-            path=path,
-            row=row,
-            col=col))
-        file = File(cwd=s_cwd(), path=path, row=row, col=col)
-        Commands.open_file(self.view, file.to_args())
-        return
+      text = view.substr(view.line(view.text_point(row, 0)))
+      diagnostic = parse_build_diagnostic(ANSI_ESCAPE_REGEX.sub('', text), row,
+          cwd, cwd)
+      if diagnostic != None:
+        return diagnostic
       row -= 1
+    return None
 
   def log(self, msg):
     log(msg, type=type(self).__name__)
 
 
+class RemoteCppNextBuildErrorCommand(sublime_plugin.WindowCommand):
+  ''' Opens the next, or with forward=False the previous, error, warning or
+  test failure of the build in the Build view of the window. '''
+  NAME = 'remote_cpp_next_build_error'
+
+  def is_enabled(self, forward=True):
+    return self._listener() != None
+
+  def run(self, forward=True):
+    listener = self._listener()
+    diagnostic = listener.step(forward)
+    if diagnostic == None:
+      set_status('No more build errors.')
+      return
+    listener.show(diagnostic)
+    open_build_diagnostic(listener.view(), listener.cwd(), diagnostic)
+
+  def _listener(self):
+    for view in self.window.views():
+      if view.id() in BUILD_DIAGNOSTICS:
+        return BUILD_DIAGNOSTICS[view.id()]
+    return None
+
+
 class RemoteCppNewFileCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_new_file'
 
   def run(self, edit):
     view = self.view
+    settings = settings_snapshot(view)
     def on_done(file):
-      runnable = lambda : self._run_in_the_background(view, file)
+      runnable = lambda : self._run_in_the_background(view, settings, file)
       THREAD_POOL.run(runnable)
     show_file_input(self.view, 'New Remote File', on_done)
 
 
-  def _run_in_the_background(self, view, file):
-    new_path = file.remote_path()
-    cmd = ('if [[ ! -f {remote_path} ]]; then mkdir -p {remote_dir}; fi; '
-        ' touch {remote_path};').format(
-            remote_path=new_path,
-            remote_dir=os.path.dirname(new_path),
-    )
-    ssh_cmd(cmd)
-    Commands.open_file(view, file.to_args())
-    STATE.update_list(cwd=s_cwd(view), files_to_add=[file])
+  def _run_in_the_background(self, view, settings, file):
+    remote_touch(file, settings)
+    sublime.set_timeout(lambda: Commands.open_file(view, file.to_args()), 0)
+    STATE.update_list(cwd=s_cwd(settings), files_to_add=[file])
 
 
 class RemoteCppBuildCommand(sublime_plugin.TextCommand):
@@ -1100,9 +5289,10 @@ class RemoteCppBuildCommand(sublime_plugin.TextCommand):
   VIEW_NAME = 'Build'
 
   def run(self, edit):
-    if s_save_all_on_remote_build():
-      self.view.window().run_command('save_all')
-    view = self._find_single_view()
+    settings = settings_snapshot(self.view)
+    if s_save_all_on_remote_build(settings):
+      self._save_all()
+    view = self._find_single_view(settings)
     if view == None:
       view = self.view.window().new_file()
     self.view.window().focus_view(view)
@@ -1112,17 +5302,38 @@ class RemoteCppBuildCommand(sublime_plugin.TextCommand):
         time=time_str()))
     view.set_read_only(True)
     view.set_scratch(True)
+    # A new build supersedes the one still writing into the view.
+    token = start_view_job(view)
+    build_cwd = self._get_build_cwd(settings)
     status = '# [{time}] Building with cmd [{cmd}]...\n\n'.format(
         time=time_str(),
-        cmd=self._build_cmd())
+        cmd=self._build_cmd(build_cwd, settings))
     Commands.append_text(view, status, clean_first=True)
-    THREAD_POOL.run(lambda : self._run_in_the_background(view))
-
-  def _get_build_cwd(self):
+    first_row = status.count('\n')
+    # Only build once the saved sources are on the remote.
+    UPLOAD_QUEUE.flush(lambda failed_files: THREAD_POOL.run(
+        lambda : self._run_in_the_background(
+            view, settings, build_cwd, first_row, failed_files, token),
+        ThreadPool.BULK,
+        token))
+
+  def _save_all(self):
+    ''' Saves every view and queues the uploads of the remote files it saved
+    right away since on_post_save may only run after the build has flushed
+    the UPLOAD_QUEUE. '''
+    window = self.view.window()
+    dirty_views = [ v for v in window.views() if v.is_dirty() ]
+    window.run_command('save_all')
+    for view in dirty_views:
+      file = STATE.file(view.file_name())
+      if file != None and not view.is_dirty():
+        UPLOAD_QUEUE.push(file, settings_snapshot(view))
+
+  def _get_build_cwd(self, settings):
     config = 'remote_cpp_build_path'
-    path_type = _get_or_default(config, 'root')
+    path_type = s_build_path(settings)
     if path_type == 'root':
-      return s_cwd()
+      return s_cwd(settings)
     elif path_type == 'current_file_cwd':
       view = self.view
       current_file = STATE.file(view.file_name())
@@ -1142,25 +5353,34 @@ class RemoteCppBuildCommand(sublime_plugin.TextCommand):
   def log(self, msg):
     log(msg, type=type(self).__name__)
 
-  def _find_single_view(self):
-    if not s_single_build_view():
+  def _find_single_view(self, settings):
+    if not s_single_build_view(settings):
       return None
     for view in self.view.window().views():
       if self.owns_view(view):
         return view
     return None
 
-  def _build_cmd(self):
-    cwd = self._get_build_cwd()
-    build_cmd = s_build_cmd()
+  def _build_cmd(self, build_cwd, settings):
+    build_cmd = s_build_cmd(settings)
     return "cd {cwd} && {build}".format(
-        cwd=cwd,
+        cwd=build_cwd,
         build=build_cmd,
     )
 
-  def _run_in_the_background(self, view):
-    listener = AppendToViewListener(view)
-    ssh_cmd(self._build_cmd(), listener)
+  def _run_in_the_background(self, view, settings, build_cwd, first_row,
+      failed_files, token):
+    listener = AppendToViewListener(view, settings, token)
+    if len(failed_files) > 0:
+      listener.on_stderr('# Not building because uploading {0} failed.\n'
+          .format(', '.join([ f.path for f in failed_files ])))
+      listener.on_exit(1)
+      return
+    cwd = s_cwd(settings)
+    listener = BuildDiagnosticsListener(view, listener, build_cwd, cwd,
+        first_row, settings)
+    BUILD_DIAGNOSTICS[view.id()] = listener
+    remote_cmd(build_cwd, s_build_cmd(settings), listener, settings, token)
 
   @staticmethod
   def owns_view(view):
@@ -1179,8 +5399,30 @@ class RemoteCppGotoIncludeCommand(sublime_plugin.TextCommand):
 
   def run(self, edit):
     path = self._get_sel_path()
-    file = File(cwd=s_cwd(), path=path)
-    Commands.open_file(self.view, file.to_args())
+    cwd = s_cwd(self.view)
+    index = STATE.index(cwd)
+    candidates = []
+    if index != None:
+      current_file = STATE.file(self.view.file_name())
+      candidates = index.resolve_include(
+          path, current_file.path, s_include_roots(self.view))
+    if len(candidates) == 0:
+      log('Include [{0}] is not in the file list so opening it as is.'.format(
+          path))
+      candidates = [ path ]
+    if len(candidates) == 1:
+      file = File(cwd=cwd, path=candidates[0])
+      Commands.open_file(self.view, file.to_args())
+      return
+    def on_select(selected_index):
+      if selected_index == -1:
+        return
+      file = File(cwd=cwd, path=candidates[selected_index])
+      Commands.open_file(self.view, file.to_args())
+    self.view.window().show_quick_panel(
+        items=candidates,
+        on_select=on_select,
+        selected_index=0)
 
   def _get_sel_path(self):
     line = get_sel_line(self.view)
@@ -1204,14 +5446,14 @@ class RemoteCppToggleHeaderImplementationCommand(sublime_plugin.TextCommand):
   def run(self, edit):
     log("Toggling between header and implementation...")
     view = self.view
-    window = view.window()
+    settings = settings_snapshot(view)
     file = STATE.file(view.file_name())
-    file_list = STATE.list(s_cwd())
+    file_list = STATE.list(s_cwd(settings))
     if file_list == None:
       log('No file list found so requesting one...')
       def run_in_the_background():
-        file_list = RemoteCppListFilesCommand.get_file_list(window)
-        if type(file_list) == list:
+        file_list = RemoteCppListFilesCommand.get_file_list(settings)
+        if isinstance(file_list, FileList):
           log('Successfully downloaded the file list for toggle.')
           Commands.toggle_header_implementation(view)
         else:
@@ -1219,24 +5461,17 @@ class RemoteCppToggleHeaderImplementationCommand(sublime_plugin.TextCommand):
       THREAD_POOL.run(run_in_the_background)
       return
     else:
-      self._toggle(file, file_list)
+      self._toggle(file, STATE.index(s_cwd(settings)))
 
-  def _toggle(self, file, file_list):
-    orig_path, orig_extension = os.path.splitext(file.path)
-    sibblings = []
-    log('Into the loop...')
-    for file_path in file_list:
-      path, extension = os.path.splitext(file_path)
-      if orig_extension != extension and orig_path == path:
-        sibblings.append(file_path)
-    sibbling_count = len(sibblings)
-    log('Out of the loop...')
-    if sibbling_count == 0:
+  def _toggle(self, file, index):
+    sibblings = index.siblings(file.path)
+    counterpart = index.counterpart(file.path)
+    if len(sibblings) == 0:
       log('No sibbling files were found.')
       return
-    elif sibbling_count == 1:
-      log('Only one file found so displaying it.')
-      toggle_file = File(cwd=file.cwd, path=sibblings[0])
+    elif counterpart != None:
+      log('Found the preferred counterpart so displaying it.')
+      toggle_file = File(cwd=file.cwd, path=counterpart)
       Commands.open_file(self.view, toggle_file.to_args())
     else:
       log('Multiple matching files found: [{0}].'.format(', '.join(sibblings)))
@@ -1266,28 +5501,34 @@ class RemoteCppOpenFileCommand(sublime_plugin.TextCommand):
       remote_path = file.remote_path()
       local_path = file.local_path()
       window = self.view.window()
+      settings = settings_snapshot(self.view)
       # Shortcut if the file already exists.
       if os.path.isfile(local_path):
-        self._open_file(window, file)
+        self._open_file(window, settings, file)
         return
       # Otherwise let's copy the file locally.
-      THREAD_POOL.run(lambda : self._run_in_the_background(window, file))
+      THREAD_POOL.run(
+          lambda : self._run_in_the_background(window, settings, file),
+          ThreadPool.INTERACTIVE)
 
-    def _run_in_the_background(self, window, file):
+    def _run_in_the_background(self, window, settings, file):
       try:
-        download_file(file)
-        self._open_file(window, file)
+        download_file(file, settings)
+        self._open_file(window, settings, file)
       except:
         msg = 'Failed to open remote file:\n\n{0}'.format(file.remote_path())
         log_exception(msg)
         sublime.error_message(msg)
 
-    def _open_file(self, window, file):
+    def _open_file(self, window, settings, file):
       path_row_col = '{path}:{row}:{col}'.format(
           path=file.local_path(),
           row=file.row,
           col=file.col)
       view = window.open_file(path_row_col, sublime.ENCODED_POSITION)
+      STATE.record_open(file)
+      PREFETCHER.on_open(file)
+      PREFETCHER.push_related(file, settings)
 
     def log(self, msg):
       log(msg, type=type(self).__name__)
@@ -1313,7 +5554,7 @@ class RemoteCppListFilesCommand(sublime_plugin.TextCommand):
   def run(self, edit, prefix='', force_single_view=False):
     window = self.view.window()
     view = None
-    if force_single_view or s_single_file_list_view():
+    if force_single_view or s_single_file_list_view(self.view):
       view = self._find_single_file_list_view(prefix)
     if view == None:
       view = window.new_file()
@@ -1323,7 +5564,9 @@ class RemoteCppListFilesCommand(sublime_plugin.TextCommand):
     view.set_read_only(True)
     view.set_scratch(True)
     view.settings().set("word_wrap", "False")
-    THREAD_POOL.run(lambda: self._get_file_list(window, view, prefix))
+    settings = settings_snapshot(self.view)
+    THREAD_POOL.run(lambda: self._get_file_list(settings, view, prefix),
+        ThreadPool.BULK)
 
   def _get_title(self, prefix):
     if len(prefix) == 0:
@@ -1342,31 +5585,81 @@ class RemoteCppListFilesCommand(sublime_plugin.TextCommand):
     return None
 
   @staticmethod
-  def _get_file_list(window, view, prefix):
-    capture_listener = CaptureCmdListener()
-    if view == None:
-      listener = capture_listener
-    else:
+  def _get_file_list(settings, view, prefix):
+    cwd = s_cwd(settings)
+    if view != None:
       if len(prefix) == 0:
         prefix_text = ''
       else:
         prefix_text = ' in path [{prefix}]'.format(prefix=prefix)
       title = '# [{time}] Listing files for CWD=[{cwd}]{prefix}...\n\n'.format(
-          cwd=s_cwd(),
+          cwd=cwd,
           prefix=prefix_text,
           time=time_str())
       Commands.append_text(view, title, clean_first=True)
-      append_listener = AppendToViewListener(view)
-    cmd_template = 'cd {cwd}; ' + s_find_cmd()
-    cmd_str = cmd_template.format(cwd=s_cwd())
-    listener = ListFilesListener(view=view, prefix=prefix)
-    ssh_cmd(cmd_str, listener)
-    STATE.set_list(s_cwd(), listener.file_list)
-    return listener.file_list
+    listener = ListFilesListener(view=view, prefix=prefix, settings=settings)
+    find_cmd = s_find_cmd(settings)
+    def with_ssh():
+      exit_code = remote_cmd(cwd, find_cmd, listener, settings)
+      if exit_code != 0:
+        # Keep the list we have rather than whatever a failed find printed.
+        raise Exception('Failed to list the files in [{0}] (exit code {1}).'
+            .format(cwd, exit_code))
+      STATE.set_list(cwd, listener.file_list)
+      return listener.file_list
+    def with_the_agent(agent):
+      RemoteCppListFilesCommand._fetch_delta(agent, cwd, find_cmd, listener)
+      listener.file_list = STATE.list(cwd)
+      listener.show(listener.exit_code)
+      return listener.file_list
+    return with_agent(with_the_agent, with_ssh, settings)
+
+  @staticmethod
+  def _fetch_delta(agent, cwd, find_cmd, listener, full=False):
+    ''' Asks the agent only for the paths that changed since our list, or
+    for the whole list when full is set. '''
+    base_token = None if full else STATE.list_token(cwd)
+    chunks = []
+    try:
+      result = agent.request('list', {
+            'cwd': cwd,
+            'cmd': find_cmd,
+            'token': base_token,
+          },
+          on_frame=lambda header, payload: chunks.append(payload))
+    except AgentConnectionError:
+      raise
+    except AgentError as e:
+      # The find command could not even start, e.g. the cwd is missing.
+      listener.on_stderr('{0}\n'.format(e))
+      listener.exit_code = 1
+      listener.on_exit(listener.exit_code)
+      raise Exception('Failed to list the files in [{0}]: [{1}]'.format(
+          cwd, e))
+    for line in result['stderr'].splitlines(True):
+      listener.on_stderr(line)
+    listener.exit_code = result['exit_code']
+    if listener.exit_code != 0:
+      listener.on_exit(listener.exit_code)
+      raise Exception('Failed to list the files in [{0}] (exit code {1}).'
+          .format(cwd, listener.exit_code))
+    if result.get('full'):
+      # The agent already replaced any path that is not valid utf-8.
+      paths = b''.join(chunks).decode('utf-8', 'replace').split('\n')
+      STATE.set_list(cwd, normalise_file_list(paths), result['token'])
+      log('Received the full file list with {0} files.'.format(len(paths)))
+    elif STATE.apply_list_delta(cwd, base_token, result['token'],
+        result['added'], result['removed']):
+      log('Received file list delta with {0} added and {1} removed.'.format(
+          len(result['added']), len(result['removed'])))
+    else:
+      log('File list changed while fetching the delta so fetching it all...')
+      RemoteCppListFilesCommand._fetch_delta(agent, cwd, find_cmd, listener,
+          full=True)
 
   @staticmethod
-  def get_file_list(window):
-    return RemoteCppListFilesCommand._get_file_list(window, None, '')
+  def get_file_list(settings):
+    return RemoteCppListFilesCommand._get_file_list(settings, None, '')
 
   @staticmethod
   def owns_view(view):
@@ -1386,12 +5679,24 @@ class RemoteCppListFilesCommand(sublime_plugin.TextCommand):
 class RemoteCppAppendTextCommand(sublime_plugin.TextCommand):
   NAME = 'remote_cpp_append_text'
 
-  def run(self, edit, text='NO_TEXT_PROVIDED', clean_first=False):
+  def run(self, edit, text='NO_TEXT_PROVIDED', clean_first=False, tail=False):
     view = self.view
     view.set_read_only(False)
     if clean_first and view.size() > 0:
       view.erase(edit, sublime.Region(0, view.size()))
-    view.insert(edit, view.size(), text)
+      view.erase_regions(AppendToViewListener.TAIL_REGION)
+    if tail:
+      regions = view.get_regions(AppendToViewListener.TAIL_REGION)
+      start = view.size()
+      if len(regions) > 0:
+        start = regions[0].begin()
+        view.erase(edit, regions[0])
+      view.insert(edit, start, text)
+      view.add_regions(AppendToViewListener.TAIL_REGION,
+          [ sublime.Region(start, start + len(text)) ], '', '',
+          sublime.HIDDEN)
+    else:
+      view.insert(edit, view.size(), text)
     view.set_read_only(True)
     view.show(view.size() + 1)
 
@@ -1403,9 +5708,80 @@ class RemoteCppAppendTextCommand(sublime_plugin.TextCommand):
 # Initialised in plugin_loaded()
 THREAD_POOL = None
 
+# Initialised in plugin_loaded()
+FILE_LIST_SCHEDULER = None
+
+# Initialised in plugin_loaded()
+UPLOAD_QUEUE = None
+
+# Initialised in plugin_loaded()
+PREFETCHER = None
+
+# Grep engines by the name used in the 'remote_cpp_grep_engine' setting.
+GREP_ENGINES = {
+  'rg': GrepEngine('rg',
+      'rg --no-heading --with-filename --line-number --column --null '
+          '--color never --no-messages --line-buffered -e {pattern}',
+      ' .',
+      '^(.*?)\x00(\\d+):(\\d+):(.*)$',
+      max_count_args=' --max-count {count}'),
+  'git': GrepEngine('git',
+      'git grep -I --null --line-number --column -E -e {pattern}',
+      '',
+      '^(.*?)\x00(\\d+)\x00(\\d+)\x00(.*)$'),
+  'grep': GrepEngine('grep',
+      'grep -I -H -n -Z -E --line-buffered -e {pattern}',
+      ' -R .',
+      '^(.*?)\x00(\\d+):(.*)$',
+      has_column=False,
+      max_count_args=' -m {count}'),
+}
+
+# key is (hostname, cwd) and value the GrepEngine probed for it.
+DETECTED_GREP_ENGINES = {}
+GREP_ENGINES_LOCK = threading.Lock()
+
+# key is the cwd and value its LocalGrepIndex.
+LOCAL_GREP_INDEXES = {}
+LOCAL_GREP_INDEXES_LOCK = threading.Lock()
+
+# key corresponds to View.id() of a Grep view.
+# value is map<displayed line, GrepMatch>.
+GREP_MATCHES = {}
+
+# key corresponds to View.id() of a Grep view.
+# value is the GrepListener writing into it.
+GREP_LISTENERS = {}
+
+# key corresponds to View.id() of a Build view.
+# value is the BuildDiagnosticsListener of its latest build.
+BUILD_DIAGNOSTICS = {}
+
+# key corresponds to View.id().
+# value is the CancellationToken of the job writing into the view.
+VIEW_JOBS = {}
+VIEW_JOBS_LOCK = threading.Lock()
+
+# One SshTransport per (hostname, port).
+TRANSPORTS = {}
+TRANSPORTS_LOCK = threading.Lock()
+
 # key corresponds to View.id().
 # value is an instance of 'class File' defined in this file.
 # remote_files = {}
 
 # An instance of PluginState class. Initialised in plugin_loaded().
 STATE = PluginState()
+
+# key corresponds to Window.id().
+# value is the SettingsSnapshot of the window.
+SETTINGS_SNAPSHOTS = {}
+SETTINGS_SNAPSHOTS_LOCK = threading.Lock()
+# key is the View.id() of a view, or PREFERENCES_FILE, whose settings
+# invalidate SETTINGS_SNAPSHOTS.
+# value is the SettingsSnapshot of those settings as last seen.
+SETTINGS_WATCHED = {}
+SETTINGS_ON_CHANGE_KEY = 'RemoteCpp'
+
+# An instance of CwdRegistry class. Filled in plugin_loaded().
+CWD_REGISTRY = CwdRegistry()
@@ -0,0 +1,62 @@
+#
+# Measures how long PluginState.file() takes to resolve a local path with
+# many views open, for paths of open cwds, for paths in the cache of closed
+# workspaces and for paths outside the cache.
+#
+# Run it from the Sublime Text console with:
+#   exec(open('<path to>/Tools/benchmark_cwd_registry.py').read())
+# or outside Sublime with the plugin on the PYTHONPATH.
+
+import sys
+import time
+
+VIEWS = 500
+CWDS = 20
+CALLS = 20000
+
+
+def plugin_module():
+  ''' The plugin as loaded by Sublime, or imported directly. '''
+  for name in ('RemoteCpp.RemoteCpp', 'RemoteCpp'):
+    module = sys.modules.get(name)
+    if module != None and hasattr(module, 'PluginState'):
+      return module
+  import RemoteCpp
+  return RemoteCpp
+
+
+def micros_per_call(function, arg):
+  start_secs = time.time()
+  for _ in range(CALLS):
+    function(arg)
+  return (time.time() - start_secs) / CALLS * 1e6
+
+
+def main():
+  R = plugin_module()
+  saved = R.CWD_REGISTRY
+  try:
+    R.CWD_REGISTRY = R.CwdRegistry()
+    # Fake view ids so that nothing here depends on the windows open.
+    with R.CWD_REGISTRY._lock:
+      for view_id in range(VIEWS):
+        R.CWD_REGISTRY._set(-1 - view_id,
+            '/RemoteCpp-benchmark/cwd{0}'.format(view_id % CWDS))
+    paths = [
+      ('open cwd', R.File(cwd='/RemoteCpp-benchmark/cwd3',
+          path='src/a/b.cc').local_path(False)),
+      ('closed cwd', R.File(cwd='/RemoteCpp-benchmark/closed',
+          path='src/a/b.cc').local_path(False)),
+      ('not cached', '/tmp/RemoteCpp-benchmark/src/a/b.cc'),
+    ]
+    print('PluginState.file() with {0} views over {1} cwds:'.format(
+        VIEWS, CWDS))
+    for name, path in paths:
+      print('  {name:>10}: {micros:.2f} us per call'.format(
+          name=name,
+          micros=micros_per_call(R.STATE.file, path)))
+  finally:
+    R.CWD_REGISTRY = saved
+
+
+main()
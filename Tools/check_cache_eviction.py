@@ -0,0 +1,79 @@
+#
+# Checks that evict_local_cache() keeps the cache objects referenced by cwds
+# whose PluginState has not been loaded in this session.
+#
+# Run it from the Sublime Text console with:
+#   exec(open('<path to>/Tools/check_cache_eviction.py').read())
+# or outside Sublime with the plugin on the PYTHONPATH.
+#
+# It only touches a temporary directory and restores the plugin afterwards.
+
+import os
+import shutil
+import sys
+import tempfile
+
+
+def plugin_module():
+  ''' The plugin as loaded by Sublime, or imported directly. '''
+  for name in ('RemoteCpp.RemoteCpp', 'RemoteCpp'):
+    module = sys.modules.get(name)
+    if module != None and hasattr(module, 'PluginState'):
+      return module
+  import RemoteCpp
+  return RemoteCpp
+
+
+def check(condition, msg):
+  if not condition:
+    raise AssertionError(msg)
+  print('OK: ' + msg)
+
+
+def main():
+  R = plugin_module()
+  saved = (R.plugin_dir, R.STATE, R.UPLOAD_QUEUE, R.PREFETCHER)
+  root = tempfile.mkdtemp(prefix='RemoteCpp-check-')
+  try:
+    R.plugin_dir = lambda: root
+    R.UPLOAD_QUEUE = R.UploadQueue()
+    R.PREFETCHER = R.Prefetcher()
+    unloaded_cwd = '/RemoteCpp-check/unloaded'
+    file = R.File(cwd=unloaded_cwd, path='src/only_here.cc')
+    os.makedirs(os.path.dirname(file.local_path(False)))
+    state = R.STATE = R.PluginState({})
+    entry = R.cache_file(file, b'only referenced by an unloaded cwd', 34, 1)
+    state.set_cached(unloaded_cwd, { file.path: entry })
+    state.save()
+    object_path = R.cache_object_path(entry[2])
+
+    # A new session where the cwd has not been used yet.
+    R.STATE = R.PluginState({})
+    settings = R.SettingsSnapshot({
+      'remote_cpp_cache_max_bytes': 1 << 30,
+      'remote_cpp_cache_max_files': 1 << 20,
+    })
+    R.evict_local_cache(settings, set(), set())
+    check(os.path.isfile(object_path),
+        'the object of an unloaded cwd survives eviction')
+    check(os.path.isfile(file.local_path(False)),
+        'the local copy of an unloaded cwd survives eviction')
+
+    # Over the limits the file itself goes, and its object with it.
+    settings = R.SettingsSnapshot({
+      'remote_cpp_cache_max_bytes': 1,
+      'remote_cpp_cache_max_files': 0,
+    })
+    R.evict_local_cache(settings, set(), set())
+    check(not os.path.isfile(file.local_path(False)),
+        'the least recently used local copy is evicted')
+    check(not os.path.isfile(object_path),
+        'the object of an evicted local copy is deleted')
+    check(R.STATE.cached(file) == None,
+        'the evicted local copy is dropped from the PluginState')
+  finally:
+    R.plugin_dir, R.STATE, R.UPLOAD_QUEUE, R.PREFETCHER = saved
+    shutil.rmtree(root, ignore_errors=True)
+
+
+main()
@@ -0,0 +1,88 @@
+#
+# Checks that required_literals() only returns literals every match of the
+# pattern contains, so LocalGrepIndex never prunes a file that matches.
+#
+# Run it from the Sublime Text console with:
+#   exec(open('<path to>/Tools/check_required_literals.py').read())
+# or outside Sublime with the plugin on the PYTHONPATH.
+#
+# It only touches a temporary directory and restores the plugin afterwards.
+
+import os
+import shutil
+import sys
+import tempfile
+
+EXPECTED = [
+  ('foobar', ['foobar']),
+  ('foo.*bar', ['foo', 'bar']),
+  ('(abc)?def', ['def']),
+  ('foo(bar)*xyz', ['foo', 'xyz']),
+  ('foo(bar){0,2}xyz', ['foo', 'xyz']),
+  ('foo(bar)+xyz', ['foo', 'bar', 'xyz']),
+  ('foo(?:bar)xyz', ['foo', 'bar', 'xyz']),
+  ('a((bcd)?efg)?hij', ['hij']),
+  ('(abc|def)ghi', []),
+  ('(?P<name>abc)def', []),
+  ('abcd?', ['abc']),
+  ('\\(abc\\)?', ['(abc']),
+  ('\\x41bcd', ['bcd']),
+  ('\\x{41}bcd', ['bcd']),
+  ('\\u00e9bcd', ['bcd']),
+  ('\\U000000e9bcd', ['bcd']),
+  ('\\N{DASH}bcd', ['bcd']),
+  ('\\012bcd', ['bcd']),
+  ('(a)\\1bcd', ['bcd']),
+]
+
+
+def plugin_module():
+  ''' The plugin as loaded by Sublime, or imported directly. '''
+  for name in ('RemoteCpp.RemoteCpp', 'RemoteCpp'):
+    module = sys.modules.get(name)
+    if module != None and hasattr(module, 'PluginState'):
+      return module
+  import RemoteCpp
+  return RemoteCpp
+
+
+def check(condition, msg):
+  if not condition:
+    raise AssertionError(msg)
+  print('OK: ' + msg)
+
+
+def main():
+  R = plugin_module()
+  for pattern, expected in EXPECTED:
+    literals = R.required_literals(pattern)
+    check(literals == expected, 'required_literals({0!r}) == {1!r}'.format(
+        pattern, literals))
+
+  saved = R.plugin_dir
+  root = tempfile.mkdtemp(prefix='RemoteCpp-check-')
+  try:
+    R.plugin_dir = lambda: root
+    cwd = '/RemoteCpp-check/grep'
+    for path, text in (('only_def.cc', 'def\n'), ('neither.cc', 'xyz\n'),
+        ('hex.cc', 'Abcd\n')):
+      local_path = R.File(cwd=cwd, path=path).local_path(False)
+      if not os.path.isdir(os.path.dirname(local_path)):
+        os.makedirs(os.path.dirname(local_path))
+      with open(local_path, 'w') as fp:
+        fp.write(text)
+    index = R.LocalGrepIndex(cwd)
+    index.update()
+    for pattern in ('(abc)?def', 'd(abc)*ef'):
+      paths = [ match.path for match in index.search(pattern) ]
+      check(paths == ['only_def.cc'],
+          'LocalGrepIndex.search({0!r}) finds the file'.format(pattern))
+    paths = [ match.path for match in index.search('\\x41bcd') ]
+    check(paths == ['hex.cc'],
+        'LocalGrepIndex.search({0!r}) finds the file'.format('\\x41bcd'))
+  finally:
+    R.plugin_dir = saved
+    shutil.rmtree(root, ignore_errors=True)
+
+
+main()